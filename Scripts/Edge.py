@@ -15,27 +15,45 @@
 ###############################################################################
 import cv2
 import ellmanager as emanager
+import functools
 import io
 import json
 import logging
-import model
 import numpy as numpy
 import os
 import picamera
+import queue
 import random
 import shutil
 import subprocess
 import sys
+import tempfile
 import termios
+import threading
 import time
 import tty
 import zipfile
 from datetime import datetime, timedelta
+import blobstream
+from blobstream import BlockBlobWriter
+from capturescheduler import CaptureScheduler
+from clipassembler import ClipAssembler, ClipJob
+from eventjournal import EventJournal
+from edgemetrics import MetricsPublisher, MetricsRegistry, MetricsServer
+import imagededup
+from imagearchive import ImageArchiver
+from inferencepool import InferencePool, WorkerLauncher
+import modelpackage
+from modelsession import ModelSession
+from modelwatcher import ModelUpdateWatcher
+from motiongate import MotionGate
+from uploadspool import UploadSpool
 from azure.storage.blob import BlockBlobService, ContentSettings, PublicAccess
 from iothub_client import IoTHubClient, IoTHubClientError, IoTHubTransportProvider, IoTHubClientResult, IoTHubError, DeviceMethodReturnValue
 from iothub_service_client import IoTHubRegistryManager, IoTHubRegistryManagerAuthMethod
 from iothub_service_client import IoTHubDeviceTwin, IoTHubError
 from twilio.rest import Client
+from alertdispatcher import AlertDispatcher
 
 SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
 CONNECTION_STRING = ""
@@ -46,6 +64,19 @@ METHOD_CONTEXT = 0
 SEND_REPORTED_STATE_CALLBACKS = 0
 METHOD_CALLBACKS = 0
 
+# Pipeline Settings: seconds per get_video cycle and the bounded queues between stages
+CYCLE_LENGTH = 60.0
+FRAME_QUEUE_SIZE = 2
+UPLOAD_QUEUE_SIZE = 8
+STOP_SIGNAL = None
+
+# Fields of the event journal, each record is written as an array in this order
+JOURNAL_SCHEMA = ("type", "sysTime", "imageName", "prediction(s)", "predictionConfidence", "videoStartTime", "videoName")
+
+# Stage metrics are served as text on this local port, see edgemetrics.py
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
 class PiImageDetection():
     
     def __init__(self):
@@ -56,14 +87,45 @@ class PiImageDetection():
         self.json_container_name = 'edgejson'
 
         # Intialize Azure IoTHub Config Properties
-        self.capture_rate = 30.0
+        # Classified frames per second, 0 runs as fast as the model allows
+        self.capture_rate = 1.0
+        self.camera_framerate = 30.0
         self.prediction_threshold = 0.2
+        # The model and the motion gate see frames of this size, it also sizes the inference frame slots
         self.camera_res_len = 256
         self.camera_res_wid = 256
+        # Uploaded pictures are taken at this size and encoded by the camera at this quality
+        self.upload_res_len = 1280
+        self.upload_res_wid = 720
+        self.upload_jpeg_quality = 90
         self.video_capture_length = 30
         self.video_preroll = 5
-        self.capture_video = False
+        # Clips made for every event, any of before, after and full
+        self.video_variants = ["before", "after", "full"]
+        # Stream events straight to Azure as raw h264 instead of assembling MP4 clips on the SD card
+        self.stream_video = False
         self.send_twilio_sms = True
+        # Seconds between two checks for a new model on Azure
+        self.model_update_interval = 300.0
+        # Worker processes running the model on frames in shared memory, 0 runs it on a thread of this process
+        self.inference_workers = 2
+        # Fraction of the scene that must change for a frame to be classified, 0 classifies every frame
+        self.motion_sensitivity = 0.01
+        # Seconds after which a frame is classified even if the scene did not change
+        self.motion_heartbeat = 60.0
+        # Pictures for badimages that are within this Hamming distance of a recent one are not uploaded
+        self.dedup_bad_images = True
+        self.dedup_distance = 4
+        # Pictures for badimages are uploaded in tar segments of this many bytes or seconds
+        self.archive_bad_images = True
+        self.archive_segment_bytes = 4 * 1024 * 1024
+        self.archive_segment_age = 600.0
+        # Seconds between two reports of the stage metrics to IoT Hub
+        self.metrics_interval = 300.0
+
+        # Intialize Pipeline Properties
+        self.upload_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        self.event = None
         azure_key_name = os.environ.get('AZURE_BLOBCONTAINER_NAME')
         azure_key = os.environ.get('AZURE_BLOBCONTAINER_KEY')
 
@@ -77,6 +139,58 @@ class PiImageDetection():
 
         self.block_blob_service = BlockBlobService(account_name = azure_key_name, account_key = azure_key)
 
+        # Latency of every stage plus counters and gauges, reported to IoT Hub and served locally
+        self.metrics = MetricsRegistry()
+        self.metrics_publisher = MetricsPublisher(self.metrics, self.report_metrics, self.metrics_interval)
+        self.metrics_server = MetricsServer(self.metrics, METRICS_HOST, METRICS_PORT)
+
+        # Uploads go through a spool on disk that survives network outages and reboots
+        spool_dir = "{0}/{1}".format(SCRIPT_DIR, 'uploadspool')
+        self.upload_spool = UploadSpool(spool_dir, self.azure_upload_from_path, self.azure_upload_from_bytes)
+
+        # One Twilio Client for the life of the process, SMS go out from the Alert Dispatcher
+        self.twilio_client = Client(os.environ.get('TWILIO_ACCOUNT_SID'), os.environ.get('TWILIO_AUTH_TOKEN'))
+        self.twilio_to = os.environ.get('MY_PHONE_NUMBER')
+        self.twilio_from = os.environ.get('TWILIO_PHONE_NUMBER')
+        self.alert_dispatcher = AlertDispatcher(self.twilio_messaging)
+
+        # Event clips are assembled with MP4Box in the background
+        self.clip_assembler = ClipAssembler(self.clip_assembled, metrics=self.metrics)
+
+        # Frames of a static scene skip the model and the upload
+        self.motion_gate = MotionGate(self.motion_sensitivity, heartbeat=self.motion_heartbeat)
+
+        # Hashes of the recently uploaded badimages, kept between runs
+        bad_image_index_path = "{0}/{1}.json".format(SCRIPT_DIR, 'badimagesindex')
+        self.bad_image_index = imagededup.ImageDedupIndex(bad_image_index_path, max_distance=self.dedup_distance)
+
+        # Predictions and events are journaled and shipped as one compressed segment per day
+        journal_dir = "{0}/{1}".format(SCRIPT_DIR, 'eventjournal')
+        self.event_journal = EventJournal(journal_dir, self.journal_segment_closed, JOURNAL_SCHEMA)
+
+        # Pictures for badimages are collected into segments, one upload each
+        archive_dir = "{0}/{1}".format(SCRIPT_DIR, 'imagearchive')
+        self.image_archiver = ImageArchiver(archive_dir, self.image_segment_closed,
+                                            self.archive_segment_bytes, self.archive_segment_age)
+
+        # Load the Model once, updates are swapped in by azure_model_update
+        self.model_session = ModelSession(metrics=self.metrics)
+        # Models swapped in since the start, workers forked later load the current one first
+        self.model_generation = 0
+        # Forks the Inference Workers, started before any background thread runs
+        self.inference_launcher = WorkerLauncher()
+        # Started by ensure_inference_pool once the frame size is known
+        self.inference_pool = None
+
+        self.metrics.register_gauge("upload_queue_size", self.upload_queue.qsize)
+        self.metrics.register_gauge("upload_spool_pending", self.upload_spool.__len__)
+
+        # New models are looked for in the background, see azure_model_update
+        update_json_path = "{0}/{1}.json".format(SCRIPT_DIR, 'updatehistory')
+        model_blob_names = (modelpackage.manifest_blob_name('pi3'), 'zippedpi3')
+        self.model_watcher = ModelUpdateWatcher(self.block_blob_service, update_json_path, self.model_container_name,
+                                                model_blob_names, self.model_update_interval)
+
         
     def run_shell(self, cmd):
         """
@@ -89,108 +203,52 @@ class PiImageDetection():
             sys.exit(1)
         return str(output.rstrip().decode())
 
-    def save_video(self, input_path, output_path, rename_path):
-        # Convert each indivudul .h264 to mp4 
-        mp4_box = "MP4Box -fps {0} -quiet -add {1} {2}".format(self.capture_rate, input_path, output_path)
-        # Call the OS to perform the compressing
-        self.run_shell(mp4_box)
-        # Remove the .h264 file to save space on the RPI
-        os.remove(input_path)
-        # Rename for Better Convention Understanding
-        os.rename(output_path, rename_path)
-        logging.debug('Video Saved')
-
-    def twilio_messaging(self, prediction_word, prediction_value):
-        account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-        auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-        twilio_client = Client(account_sid, auth_token)
-
-        twilio_client.messages.create(
-            to = os.environ.get('MY_PHONE_NUMBER'),
-            from_ = os.environ.get('TWILIO_PHONE_NUMBER'),
-            body = "Prediction(s): {0} & Prediction Confidence: {1}".format(prediction_word, prediction_value)
-                )
+    def twilio_messaging(self, body):
+        # Called from the Alert Dispatcher thread with a summary of the detections
+        with self.metrics.time("alert"):
+            self.twilio_client.messages.create(
+                to = self.twilio_to,
+                from_ = self.twilio_from,
+                body = body
+                    )
 
     def model_predict(self, image):
-        # Open the required categories.txt file used for identify the labels for recognized images
-        with open("categories.txt", "r") as cat_file:
-            categories = cat_file.read().splitlines()
-
-        # Determine the right size and shape that the model wants
-        input_shape = model.get_default_input_shape()
-        # Get the given image ready for use with the model
-        input_data = emanager.prepare_image_for_model(image, input_shape.columns, input_shape.rows)
-        # Make the Model Prediction
-        prediction = model.predict(input_data)
-        # Return the max top 2 predictions if they exits
-        top_2 = emanager.get_top_n(prediction, 2)
-        # Make a decision on what to do based on the return prediction values
-        if (len(top_2) < 1):
-            # If nothing, return nothing
-            return None, None
+        # The session keeps the model, categories and input shape loaded between frames
+        return self.model_session.predict(image, 2)
+
+    def journal_event(self, video_time, word_prediction, predicition_value, video_name):
+        # Description of the video taken, one line of the event journal
+        self.event_journal.append({
+            'type':                  'event',
+            'sysTime':               str(datetime.now().isoformat()) + 'Z',
+            'videoStartTime':        str(video_time.isoformat()) + 'Z',
+            'prediction(s)':         word_prediction,
+            'predictionConfidence':  None if predicition_value is None else float(predicition_value),
+            'videoName':             video_name
+        })
+
+    def journal_segment_closed(self, segment_path):
+        # Called by the Event Journal with the compressed journal of a past day
+        journal_folder = "{0}/journal".format(self.json_container_name)
+        self.upload_spool.enqueue(journal_folder, os.path.basename(segment_path), segment_path, 'application/gzip')
+
+    def azure_model_update(self):
+        # Only called once the watcher found a new model on Azure
+        print ('A new model was published so I will be performing an update now')
+        if os.system('python3 {0}/pisetup.py'.format(SCRIPT_DIR)) != 0:
+            logging.debug('pisetup.py Failed, keeping the current model')
+            self.model_watcher.failed()
+            return
+        # Swap the new model in without restarting Edge.py
+        if self.model_session.reload():
+            self.model_generation += 1
+            # The inference workers load it before their next frame
+            if self.inference_pool is not None:
+                self.inference_pool.reload_model()
+            # Record the installed version in updatehistory.json
+            self.model_watcher.applied()
         else:
-            # Something was recongized, give the name based on the categories file and give the value
-            word = categories[top_2[0][0]]
-            predict_value = top_2[0][1]
-            return word, predict_value
-
-    def write_json_to_file(self, video_time, word_prediction, predicition_value, video_name, json_path):
-        # Template for description of the image and video taken
-        json_message = {
-            'Description': {
-                'sysTime':               str(datetime.now().isoformat()) + 'Z',
-                'videoStartTime':        str(video_time.isoformat()) + 'Z',
-                'prediction(s)':         word_prediction,
-                'predictionConfidence':  str(predicition_value),
-                'videoName':             video_name
-            }
-        }
-        logging.debug("Rewriting Json to File")
-        # Write Json Message to file
-        with open(json_path, 'w') as json_file:
-            json.dump(json_message, json_file)
-
-    def azure_model_update(self, update_json_path): 
-        # List the Models in the blob. There should only be one named zippedpi3
-        model_blob_list = self.block_blob_service.list_blobs(self.model_container_name)
-        found_blob = False
-        for blob in model_blob_list:
-            # Find the given one if there are more than one models
-            if (blob.name == 'zippedpi3'):
-                # Get the Date of the most recent update
-                last_blob_update = str(blob.properties.last_modified)
-                # Leave the loop once we found what we want
-                found_blob = True
-                break
-        # Check to make sure that there is a catch for if there is no zippedpi3 folder on Azure
-        if found_blob == False:
-            logging.debug("No Pi3 was found on Azure. Re-run pi3setup.py and make sure your Azure Blob Storage Account is up to date")
-        
-        # If we don't already got the json just go ahead and create a new one
-        if not os.path.exists(update_json_path) or os.stat(update_json_path).st_size == 0:
-            # Since we did not have the json of infomation about it, go ahead and update to be safe
-            os.system('python3 pisetup.py')
-            # Save the timestamp of the last time things were updated
-            holder = {"lastupdate": last_blob_update}
-            # After updating, make sure we know update the json
-            with open(update_json_path, "w+") as f:
-                f.write(json.dumps(holder))
-
-        # Now that we need know we have it, we need to parse it and decide if we need to update or not
-        with open(update_json_path, "r") as j:
-            json_data = json.load(j)
-            last_model_update = json_data["lastupdate"]
-
-        # If the times are not equal and there has been a change somewhere Update
-        if (last_model_update != last_blob_update):
-            # Check to make sure that we have the pisetup.py script
-            print ('They were not the same so I will be performing an update now')
-            os.system('python3 pisetup.py')
-            
-            # Change the json file to represent the new modified time
-            json_data["lastupdate"] = last_blob_update
-            with open (update_json_path, "w+") as j:
-                json.dump(json_data, j)
+            self.model_watcher.failed()
 
     def iothub_client_init(self):
         if CLIENT.protocol == IoTHubTransportProvider.MQTT or client.protocol == IoTHubTransportProvider.MQTT_WS:
@@ -216,17 +274,60 @@ class PiImageDetection():
                             self.prediction_threshold = float(value)
                         elif key == "captureRate":
                             self.capture_rate = float(value)
+                        elif key == "cameraFramerate":
+                            self.camera_framerate = float(value)
                         elif key == "cameraResolutionLength":
                             self.camera_res_len = int(value)
                         elif key == "cameraResolutionWidth":
                             self.camera_res_wid = int(value)
+                        elif key == "uploadResolutionLength":
+                            self.upload_res_len = int(value)
+                        elif key == "uploadResolutionWidth":
+                            self.upload_res_wid = int(value)
+                        elif key == "uploadJpegQuality":
+                            self.upload_jpeg_quality = int(value)
                         elif key == "captureLength":
                             self.video_capture_length = int(value)
                         elif key == "capturePreroll":
                             self.video_preroll = int(value)
+                        elif key == "videoVariants":
+                            self.video_variants = [variant.strip() for variant in value.split(",")]
+                        elif key == "alertCoalesceWindow":
+                            self.alert_dispatcher.coalesce_window = float(value)
+                        elif key == "alertDedupWindow":
+                            self.alert_dispatcher.dedup_window = float(value)
+                        elif key == "alertRateLimit":
+                            self.alert_dispatcher.max_per_period = int(value)
+                        elif key == "modelUpdateInterval":
+                            self.model_update_interval = float(value)
+                            self.model_watcher.set_interval(self.model_update_interval)
+                        elif key == "inferenceWorkers":
+                            self.inference_workers = int(value)
+                        elif key == "motionSensitivity":
+                            self.motion_sensitivity = float(value)
+                            self.motion_gate.sensitivity = self.motion_sensitivity
+                        elif key == "motionHeartbeat":
+                            self.motion_heartbeat = float(value)
+                            self.motion_gate.heartbeat = self.motion_heartbeat
+                        elif key == "dedupDistance":
+                            self.dedup_distance = int(value)
+                            self.bad_image_index.max_distance = self.dedup_distance
+                        elif key == "archiveSegmentBytes":
+                            self.archive_segment_bytes = int(value)
+                            self.image_archiver.max_bytes = self.archive_segment_bytes
+                        elif key == "archiveSegmentAge":
+                            self.archive_segment_age = float(value)
+                            self.image_archiver.max_age = self.archive_segment_age
+                        elif key == "metricsInterval":
+                            self.metrics_interval = float(value)
+                            self.metrics_publisher.set_interval(self.metrics_interval)
                     elif isinstance(value, bool):
-                        if key == "captureVideo":
-                            self.capture_video = bool(value)
+                        if key == "streamVideo":
+                            self.stream_video = bool(value)
+                        elif key == "dedupBadImages":
+                            self.dedup_bad_images = bool(value)
+                        elif key == "archiveBadImages":
+                            self.archive_bad_images = bool(value)
                     else:
                         logging.debug("The value was a string")
                     
@@ -234,6 +335,10 @@ class PiImageDetection():
             current_time = str(datetime.now().isoformat())
             reported_state = "{\"rebootTime\":\"" + current_time + "\"}"
             CLIENT.send_reported_state(reported_state, len(reported_state), self.send_reported_state_callback, SEND_REPORTED_STATE_CONTEXT)
+        elif method_name == "CheckModelUpdate":
+            # Look for a new model right away instead of waiting for the interval
+            logging.debug( "Checking for a Model Update..." )
+            self.model_watcher.check_now()
         else:
             print("Another Method was called")
 
@@ -246,166 +351,366 @@ class PiImageDetection():
     
     # Function to Upload a specified path to an object to Azure Blob Storage
     def azure_upload_from_path(self,blob_container,blob_name,blob_object,blob_format):
-        self.block_blob_service.create_blob_from_path(blob_container, blob_name,blob_object, content_settings=ContentSettings(content_type=blob_format))
+        with self.metrics.time("upload"):
+            if blob_format == blobstream.STAGED_BLOCKS_TYPE:
+                # A streamed video whose commit failed, most of its blocks are already in storage
+                blobstream.commit_staged(self.block_blob_service, blob_container, blob_name, blob_object)
+                return
+            self.block_blob_service.create_blob_from_path(blob_container, blob_name,blob_object, content_settings=ContentSettings(content_type=blob_format))
+
+    # Function to Upload bytes held in memory to an object to Azure Blob Storage
+    def azure_upload_from_bytes(self,blob_container,blob_name,blob_bytes,blob_format):
+        with self.metrics.time("upload"):
+            self.block_blob_service.create_blob_from_bytes(blob_container, blob_name,blob_bytes, content_settings=ContentSettings(content_type=blob_format))
+
+    def capture_picture(self):
+        # The camera scales and encodes the picture for Azure in memory, it never touches the SD card
+        picture = io.BytesIO()
+        upload_res = None
+        if self.upload_res_len and self.upload_res_wid:
+            upload_res = (self.upload_res_len, self.upload_res_wid)
+        camera_device.capture(picture, 'jpeg', resize=upload_res, quality=self.upload_jpeg_quality, use_video_port=True)
+        return picture.getvalue()
+
+    def ensure_inference_pool(self, camera_res):
+        # The workers share fixed size frame slots, a new size or worker count needs a new pool
+        frame_shape = (camera_res[1], camera_res[0], 3)
+        if self.inference_pool is not None and (self.inference_pool.frame_shape != frame_shape
+                                                or self.inference_pool.workers != self.inference_workers):
+            self.inference_pool.close()
+            self.inference_pool = None
+        if self.inference_pool is None and self.inference_workers > 0:
+            # Enough slots for every frame that can be queued between the stages at once
+            slots = FRAME_QUEUE_SIZE + UPLOAD_QUEUE_SIZE + 2 * self.inference_workers + 2
+            self.inference_launcher.start()
+            self.inference_pool = InferencePool(self.inference_launcher, frame_shape, self.inference_workers, slots,
+                                                self.model_session.categories_path, self.model_session.model_dir,
+                                                self.model_generation)
+            self.inference_pool.start()
+        return self.inference_pool
+
+    def capture_worker(self, frame_queue, event_detected, camera_res, scheduler, inference_pool):
+        """
+        Capture stage: keeps sampling the camera and hands the frames to the
+        inference stage until an event is registered or the cycle is over
+        """
+        try:
+            # A new model also ends the cycle early so main can swap it in
+            while not scheduler.cycle_over() and not event_detected.is_set() \
+                    and not self.model_watcher.update_available.is_set():
+                # Only wait as long as the schedule needs, this also surfaces camera errors
+                camera_device.wait_recording(scheduler.delay())
+                capture_time = datetime.now()
+
+                logging.debug('Analyzing Surroundings')
+                # Take a small Picture for the Model and a JPEG one for Azure. Each frame gets its own buffer as it
+                # is queued, with inference workers a shared memory slot they read it from
+                if inference_pool is not None:
+                    slot, image = inference_pool.acquire()
+                else:
+                    slot, image = None, numpy.empty((camera_res[1], camera_res[0],3), dtype=numpy.uint8)
+                try:
+                    with self.metrics.time("capture"):
+                        camera_device.capture(image,'bgr', resize=camera_res, use_video_port=True)
+                    with self.metrics.time("encode"):
+                        picture = self.capture_picture()
+                except Exception:
+                    # The slot would be lost for good, the pool only has so many
+                    if slot is not None:
+                        inference_pool.release(slot)
+                    raise
+                self.metrics.increment("frames_captured")
+                # Named to the millisecond as several can be taken per second
+                image_name = "image-{0}.jpg".format(capture_time.strftime("%Y%m%d%H%M%S%f")[:-3])
+
+                # Blocks while the inference stage is behind (back-pressure)
+                frame_queue.put((image, picture, image_name, capture_time, slot))
+                scheduler.captured()
+        finally:
+            # Always tell the inference stage that this cycle is over
+            frame_queue.put(STOP_SIGNAL)
+
+    def inference_worker(self, frame_queue, event_detected, scheduler, inference_pool):
+        """
+        Inference stage: classifies the captured frames, or hands them to the
+        inference workers, and passes the results to the upload/notify stage
+        """
+        while True:
+            frame = frame_queue.get()
+            if frame is STOP_SIGNAL:
+                if inference_pool is not None:
+                    # The cycle is only over once the workers returned every frame
+                    inference_pool.wait_idle()
+                return
+            image, picture, image_name, capture_time, slot = frame
+            # Gives the shared memory slot back once nothing needs the frame anymore
+            release = None if slot is None else functools.partial(inference_pool.release, slot)
+
+            # An event was already registered this cycle, the frame is stale
+            if event_detected.is_set():
+                if release is not None:
+                    release()
+                continue
+
+            # Nothing moved since the last frames, neither classify nor upload this one
+            try:
+                with self.metrics.time("motion"):
+                    scene_changed = self.motion_gate.passes(image)
+            except Exception:
+                # E.g. a frame of another size after a resolution change, start over from this one
+                logging.exception('Motion Gate Failed, classifying the frame')
+                self.motion_gate.reset()
+                scene_changed = True
+            if not scene_changed:
+                self.metrics.increment("frames_skipped")
+                if release is not None:
+                    release()
+                continue
+
+            if inference_pool is not None:
+                # The result comes back on the collector thread of the pool, see inference_finished
+                logging.debug('Prediction Captured')
+                inference_pool.submit(slot, functools.partial(self.inference_finished, image, picture, image_name, capture_time,
+                                                              release, event_detected, scheduler))
+                continue
+
+            try:
+                # Make Prediction with the first picture
+                logging.debug('Prediction Captured')
+                word, predict_value = self.model_predict(image)
+            except Exception:
+                logging.exception('Model Prediction Failed')
+                continue
+            self.prediction_ready(word, predict_value, image, picture, image_name, capture_time, release, event_detected, scheduler)
+
+    def inference_finished(self, image, picture, image_name, capture_time, release, event_detected, scheduler, prediction, durations):
+        # Called by the Inference Pool with the result of a worker process
+        for stage, seconds in durations.items():
+            self.metrics.observe(stage, seconds)
+        if prediction is None:
+            logging.debug('Model Prediction Failed for {0}'.format(image_name))
+            release()
+            return
+        word, predict_value = prediction
+        self.prediction_ready(word, predict_value, image, picture, image_name, capture_time, release, event_detected, scheduler)
+
+    def prediction_ready(self, word, predict_value, image, picture, image_name, capture_time, release, event_detected, scheduler):
+        scheduler.predicted()
+        self.metrics.increment("frames_classified")
+        logging.debug('Prediction Returned')
+
+        # Workers may return several events of one cycle, the first one is recorded
+        if word is not None and predict_value >= self.prediction_threshold and not event_detected.is_set():
+            # Stop the capture stage and let get_video record the event
+            self.event = (word, predict_value, capture_time)
+            event_detected.set()
+            self.metrics.increment("events")
+
+        # Blocks while the upload stage is behind (back-pressure)
+        self.upload_queue.put((word, predict_value, image_name, image, picture, release))
+
+    def upload_worker(self):
+        """
+        Upload/notify stage: hands the classified pictures to the upload spool
+        and queues the Twilio alerts so network calls never stall the camera
+        """
+        while True:
+            word, predict_value, image_name, image, picture, release = self.upload_queue.get()
+            try:
+                self.upload_prediction(word, predict_value, image_name, image, picture)
+            except Exception:
+                logging.exception('Uploading {0} Failed'.format(image_name))
+            finally:
+                if release is not None:
+                    release()
+                self.upload_queue.task_done()
+
+    def upload_bad_image(self, word, predict_value, image_name, image, picture):
+        # A picture that looks like a recent one is only counted against it, never uploaded
+        if self.dedup_bad_images:
+            original_name = self.bad_image_index.check(imagededup.dhash(image), image_name)
+            if original_name is not None:
+                logging.debug('{0} Repeats {1}, Not Uploaded'.format(image_name, original_name))
+                self.metrics.increment("bad_images_deduplicated")
+                return
+
+        if self.archive_bad_images:
+            # Goes to Azure with the other pictures of its segment, Host.py expand restores the Bad Folder
+            metadata = {
+                'prediction': word,
+                'confidence': None if predict_value is None else float(predict_value),
+            }
+            self.image_archiver.add("badimages/{0}".format(image_name), picture, metadata)
+            return
+
+        # Format specifically for the Bad Folder
+        bad_image_folder = "{0}/badimages".format(self.picture_container_name)
+        # Queue Picture for the Bad Images Folder on Azure that can be used to retrain
+        self.upload_spool.enqueue_bytes(bad_image_folder, image_name, picture, 'image/jpeg')
+
+    def image_segment_closed(self, segment_path, index_path):
+        # Called by the Image Archiver with a closed segment, the index goes after it
+        archive_folder = "{0}/archives".format(self.picture_container_name)
+        self.upload_spool.enqueue(archive_folder, os.path.basename(segment_path), segment_path, 'application/x-tar')
+        self.upload_spool.enqueue(archive_folder, os.path.basename(index_path), index_path, 'application/json')
+
+    def upload_prediction(self, word, predict_value, image_name, image, picture):
+        # Every classified frame is journaled, whether its picture is uploaded or not
+        self.event_journal.append({
+            'type':                  'prediction',
+            'sysTime':               str(datetime.now().isoformat()) + 'Z',
+            'imageName':             image_name,
+            'prediction(s)':         word,
+            'predictionConfidence':  None if predict_value is None else float(predict_value)
+        })
+
+        # The uploaded picture was taken together with the classified frame, never written to the SD card
+        if word is None:
+            logging.debug('No Event Registered')
+            self.upload_bad_image(word, predict_value, image_name, image, picture)
+        elif predict_value < self.prediction_threshold:
+            logging.debug('Prediction Value Too Low')
+            self.upload_bad_image(word, predict_value, image_name, image, picture)
+        else:
+            # See what we got back from the model
+            logging.debug('Event Registered')
+            print('Prediction(s): {}'.format(word))
+            if self.send_twilio_sms == True:
+                # Never blocks, the dispatcher coalesces and rate limits the SMS
+                self.alert_dispatcher.notify(word, predict_value)
+
+            # Format specifically for the Good Folder
+            good_image_folder = "{0}/goodimages".format(self.picture_container_name)
+            # Queue the Picture for the Good Images Folder on Azure
+            self.upload_spool.enqueue_bytes(good_image_folder, image_name, picture, 'image/jpeg')
+
+    def report_capture_rate(self, achieved_rate):
+        # Let IoT Hub know what captureRate really gets us on this device
+        logging.debug('Achieved {0:.2f} Classified Frames per Second'.format(achieved_rate))
+        self.metrics.set_gauge("achieved_capture_rate", round(achieved_rate, 3))
+        reported_state = json.dumps({"achievedCaptureRate": round(achieved_rate, 3)})
+        CLIENT.send_reported_state(reported_state, len(reported_state), self.send_reported_state_callback, SEND_REPORTED_STATE_CONTEXT)
+
+    def report_metrics(self, reported_state):
+        # Called by the Metrics Publisher with the stage metrics as a reported properties document
+        CLIENT.send_reported_state(reported_state, len(reported_state), self.send_reported_state_callback, SEND_REPORTED_STATE_CONTEXT)
 
     def get_video(self):
         # Define Variables
         capture_time = self.video_capture_length
         preroll = self.video_preroll
-        capture_video = self.capture_video
         camera_res = (self.camera_res_len, self.camera_res_wid)
-        image = numpy.empty((camera_res[1], camera_res[0],3), dtype=numpy.uint8)
-        capture_counter = 0
 
         # Set up Circular Buffer Settings
         video_stream = picamera.PiCameraCircularIO(camera_device, seconds=capture_time)
         camera_device.start_preview()
         camera_device.start_recording(video_stream, format='h264')
-        my_now = datetime.now()
 
-        while True:
-            if capture_counter < 8:
-                # Set up a waiting time difference
-                my_later = datetime.now()
-                difference = my_later-my_now
-                seconds_past = difference.seconds
-                camera_device.wait_recording(1)
-
-                logging.debug('Analyzing Surroundings')
-                if seconds_past > preroll+1:
-                    # Take Picture for the Model
-                    camera_device.capture(image,'bgr', resize=camera_res, use_video_port=True)
-                    camera_device.wait_recording(1)
-                    
-                    # Take Picture for Azure
-                    image_name = "image-{0}.jpg".format(my_later.strftime("%Y%m%d%H%M%S"))
-                    image_path = "{0}/{1}".format(SCRIPT_DIR, image_name)
-                    camera_device.capture(image_path)
-                    camera_device.wait_recording(1)
-
-                    #print("Prediction Threshold: {}".format(self.prediction_threshold))
-                    # Make Prediction with the first picture
-                    logging.debug('Prediction Captured')
-                    word, predict_value = self.model_predict(image)
-                    
-                    # Give time here for model predictions
-                    camera_device.wait_recording(3)
-                    logging.debug('Prediction Returned')
-                    my_now = datetime.now()
-                    
-                    if word is None:
-                        logging.debug('No Event Registered')
-                        if self.send_twilio_sms == True:
-                            self.twilio_messaging(word, predict_value)
-                        capture_video = False
-                        # Format specifically for the Good Folder
-                        bad_image_folder = "{0}/badimages".format(self.picture_container_name)
-                        # Send Picture to the Bad Images Folder on Azure that can be used to retrain
-                        self.azure_upload_from_path(bad_image_folder, image_name, image_path, 'image/jpeg')
-                    elif word is not None and predict_value < self.prediction_threshold:
-                        logging.debug('Prediction Value Too Low')
-                        capture_video = False
-                        # Format Specifically for the Good FOlder
-                        bad_image_folder = "{0}/badimages".format(self.picture_container_name)
-                        # Send Picture to the Bad Images Folder on Azure that can be used to retrain
-                        self.azure_upload_from_path(bad_image_folder, image_name, image_path, 'image/jpeg')
-                        # Send Twilio Message
-                        camera_device.wait_recording(2)
-                    else:
-                        # See what we got back from the model
-                        logging.debug('Event Registered')
-                        capture_video=True
-                        print('Prediction(s): {}'.format(word))
-                        if self.send_twilio_sms == True:
-                            self.twilio_messaging(word, predict_value)
-
-                        # Format specifically for the Good Folder
-                        good_image_folder = "{0}/goodimages".format(self.picture_container_name)
-                        # Send the Picture to the Good Images Folder on Azure
-                        self.azure_upload_from_path(good_image_folder, image_name, image_path, 'image/jpeg')
-                        camera_device.wait_recording(2)
-                        # Once it is uploaded, delete the image
-                        os.remove(image_path)
-                        break
-                    # If we don;t break by finidng the right predicition stay in the loop
-                    seconds_past = 0
-                    capture_counter = capture_counter + 1
-                    # Delete the image from the OS folder to save space
-                    os.remove(image_path)
-            else:
-                camera_device.stop_recording()
-                return
+        # The first frame waits until the circular buffer holds a full preroll
+        scheduler = CaptureScheduler(self.capture_rate, preroll, CYCLE_LENGTH)
+
+        # Capture and inference run as their own stages connected by a bounded queue
+        frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+        event_detected = threading.Event()
+        self.event = None
+        inference_pool = self.ensure_inference_pool(camera_res)
+        capture_thread = threading.Thread(target=self.capture_worker, name='capture',
+                                          args=(frame_queue, event_detected, camera_res, scheduler, inference_pool))
+        inference_thread = threading.Thread(target=self.inference_worker, name='inference',
+                                            args=(frame_queue, event_detected, scheduler, inference_pool))
+        capture_thread.start()
+        inference_thread.start()
+        capture_thread.join()
+        inference_thread.join()
+        self.report_capture_rate(scheduler.achieved_rate())
+
+        # No event this cycle, hand control back to main
+        if self.event is None:
+            camera_device.stop_recording()
+            return
+        word, predict_value, my_later = self.event
 
-        ## Create diretory to save the video that we get if we are told to capture video
         start_time = my_later
-        base_dir = SCRIPT_DIR
-        video_dir = "myvideos"
-        video_dir_path ="{0}/{1}".format(base_dir, video_dir)
+        video_start_time = start_time - timedelta(seconds=preroll)
+        video_stamp = video_start_time.strftime("%Y%m%d%H%M%S")
+        videos_dir_path = "{0}/{1}".format(SCRIPT_DIR, "myvideos")
 
-        if not os.path.exists(video_dir_path):
-            os.makedirs(video_dir_path)
+        if not os.path.exists(videos_dir_path):
+            os.makedirs(videos_dir_path)
 
-        video_start_time = start_time - timedelta(seconds=preroll)
+        # Only stream while the spool is empty, a backlog means the network is not keeping up
+        if self.stream_video and len(self.upload_spool) == 0:
+            self.stream_event(video_stream, preroll, video_stamp, (video_start_time, word, predict_value))
+            return
+
+        ## Each event gets its own diretory, clips of earlier events may still be assembled in theirs
+        video_dir_path = tempfile.mkdtemp(prefix="{0}-".format(video_stamp), dir=videos_dir_path)
 
         ## We will have two seperate files, one for before and after the event had been triggered
-        #Before:
-        before_event =         "video-{0}-{1}.h264".format("before", video_start_time.strftime("%Y%m%d%H%M%S"))
-        before_event_path =    "{0}/{1}/{2}".format(base_dir, video_dir, before_event)
-        before_mp4 =           before_event.replace('.h264', '.mp4')
-        before_mp4_path =      "{0}/{1}/{2}".format(base_dir, video_dir, before_mp4)
-        before_path_temp =      "{0}.tmp".format(before_mp4_path)
-
-        # After:
-        after_event =         "video-{0}-{1}.h264".format("after", video_start_time.strftime("%Y%m%d%H%M%S"))
-        after_event_path =    "{0}/{1}/{2}".format(base_dir, video_dir, after_event)
-        after_mp4 =           after_event.replace('.h264', '.mp4')
-        after_mp4_path =      "{0}/{1}/{2}".format(base_dir, video_dir, after_mp4)
-        after_path_temp =     "{0}.tmp".format(after_mp4_path)
-
-        # Full combined video path
-        full_path =           "video-{0}-{1}.mp4".format("full", video_start_time.strftime("%Y%m%d%H%M%S"))
-        full_video_path =     "{0}/{1}/{2}".format(base_dir, video_dir, full_path)
-
-        # Create a json file to a reference the given event
-        json_file_name = "video-description-{0}.json".format(video_start_time.strftime("%Y%m%d%H%M%S"))
-        json_file_path = "{0}/{1}/{2}".format(base_dir,video_dir, json_file_name)
-
-        if capture_video == True:
-            # Save the video to a file path specified
-            camera_device.split_recording(after_event_path)
-            video_stream.copy_to(before_event_path, seconds=preroll)
-            camera_device.wait_recording(preroll+5)
-                    
-            # Convert to MP4 format for viewing
-            self.save_video(before_event_path, before_path_temp, before_mp4_path)
-            self.save_video(after_event_path, after_path_temp, after_mp4_path)
-
-            # Upload Before Videos to Azure Blob Storage
-            before_video_folder = "{0}/{1}".format(self.video_container_name, 'beforevideo')
-            self.azure_upload_from_path(before_video_folder, before_mp4, before_mp4_path, 'video/mp4')
-
-            # Upload After Videos to Azure Blob Storage
-            after_video_folder = "{0}/{1}".format(self.video_container_name, 'aftervideo')
-            self.azure_upload_from_path(after_video_folder, after_mp4, after_mp4_path, 'video/mp4')
-
-            # Combine the two mp4 videos into one and save it
-            full_video = "MP4Box -cat {0} -cat {1} -new {2}".format(before_mp4_path, after_mp4_path, full_video_path)
-            self.run_shell(full_video)
-            logging.debug('Combining Full Video')
-            
-            # Upload Video to Azure Blob Storage
-            full_video_folder = "{0}/{1}".format(self.video_container_name, 'fullvideo')
-            self.azure_upload_from_path(full_video_folder, full_path, full_video_path, 'video/mp4')
-
-            # Create json and fill it with information
-            self.write_json_to_file(video_start_time, word, predict_value, full_path, json_file_path)
-
-            # Upload Json to Azure Blob Storge
-            self.azure_upload_from_path(self.json_container_name, json_file_name, json_file_path, 'application/json')
-        
-            # End Things
-            shutil.rmtree(video_dir_path)
-            camera_device.stop_recording()
+        before_event_path = "{0}/video-{1}-{2}.h264".format(video_dir_path, "before", video_stamp)
+        after_event_path = "{0}/video-{1}-{2}.h264".format(video_dir_path, "after", video_stamp)
+
+        # Save the video to a file path specified
+        camera_device.split_recording(after_event_path)
+        video_stream.copy_to(before_event_path, seconds=preroll)
+        camera_device.wait_recording(preroll+5)
+        # Stopping closes the after file, the raw segments are now complete
+        camera_device.stop_recording()
+
+        # Convert, combine and upload in the background, detection resumes right away
+        job = ClipJob(video_dir_path, before_event_path, after_event_path, video_stamp, self.camera_framerate,
+                      self.video_variants, (video_start_time, word, predict_value))
+        self.clip_assembler.submit(job)
+
+    def stream_event(self, video_stream, preroll, video_stamp, details):
+        # The pre-roll and the live recording are staged as blocks of one blob while the camera records.
+        # It stays raw h264, named and typed as such: muxing to MP4 needs the whole recording on the SD card
+        video_folder = "{0}/{1}".format(self.video_container_name, 'fullvideo')
+        video_name = "video-{0}-{1}.h264".format("full", video_stamp)
+        videos_dir_path = "{0}/{1}".format(SCRIPT_DIR, "myvideos")
+        writer = BlockBlobWriter(self.block_blob_service, video_folder, video_name, 'video/h264', videos_dir_path)
+        before_segment = writer.open_segment()
+        after_segment = writer.open_segment()
+
+        camera_device.split_recording(after_segment)
+        video_stream.copy_to(before_segment, seconds=preroll)
+        before_segment.close()
+        camera_device.wait_recording(preroll+5)
+        camera_device.stop_recording()
+
+        # The last blocks and the commit finish in the background, detection resumes right away
+        stream_thread = threading.Thread(target=self.stream_finished, name='videostream',
+                                         args=(writer, video_folder, video_name, video_stamp, details), daemon=True)
+        stream_thread.start()
+
+    def stream_finished(self, writer, video_folder, video_name, video_stamp, details):
+        videos_dir_path = "{0}/{1}".format(SCRIPT_DIR, "myvideos")
+        staged_path = "{0}/{1}.staged".format(videos_dir_path, video_name)
+        try:
+            if not writer.commit(staged_path):
+                # The network went away while streaming, the spool stages the missing blocks and commits once it is back
+                logging.debug('Streaming {0} Failed, spooling it'.format(video_name))
+                self.upload_spool.enqueue(video_folder, video_name, staged_path, blobstream.STAGED_BLOCKS_TYPE)
+        except Exception:
+            logging.exception('Streaming {0} Failed'.format(video_name))
+            return
+
+        # Describe the event in the journal
+        video_start_time, word, predict_value = details
+        self.journal_event(video_start_time, word, predict_value, video_name)
+
+    def clip_assembled(self, job, clips):
+        # Called by the Clip Assembler once the clips of an event are ready
+        video_start_time, word, predict_value = job.details
+        for variant, clip_name, clip_path in clips:
+            # Queue each Video for its own folder on Azure Blob Storage
+            video_folder = "{0}/{1}video".format(self.video_container_name, variant)
+            self.upload_spool.enqueue(video_folder, clip_name, clip_path, 'video/mp4')
+
+        # Describe the event in the journal, it refers to the full video when there is one
+        video_names = dict((variant, clip_name) for variant, clip_name, _ in clips)
+        video_name = video_names.get("full", clips[0][1] if clips else None)
+        self.journal_event(video_start_time, word, predict_value, video_name)
 
     def main(self):
         # Define Globals
@@ -417,7 +722,7 @@ class PiImageDetection():
         # Intilize Camera properties 
         camera_device = picamera.PiCamera()
         camera_device.resolution = (1280, 720)
-        camera_device.framerate = self.capture_rate
+        camera_device.framerate = self.camera_framerate
         
         if camera_device is None:
             logging.debug("No Camera Device Found.")
@@ -429,9 +734,36 @@ class PiImageDetection():
         self.block_blob_service.create_container(self.model_container_name)
         self.block_blob_service.create_container(self.json_container_name)
                 
-        # Intialize the updates Json File
-        update_json_path = "{0}/{1}.json".format(SCRIPT_DIR, 'updatehistory')
-        
+        # Fork the Inference Launcher before any background thread runs, it forks the workers from then on
+        self.inference_launcher.start()
+        self.ensure_inference_pool((self.camera_res_len, self.camera_res_wid))
+
+        # Start draining the Upload Spool, including uploads left over from the last run
+        self.upload_spool.start()
+
+        # Start shipping the Event Journal, including the days left over from the last run
+        self.event_journal.start()
+
+        # Start closing the Image Segments, including those left open by the last run
+        self.image_archiver.start()
+
+        # Start the Clip Assembler, event videos are made while detection goes on
+        self.clip_assembler.start()
+
+        # Start the Alert Dispatcher, it sends the SMS for the detected events
+        self.alert_dispatcher.start()
+
+        # Start the Upload/Notify Stage, it lives as long as the process
+        upload_thread = threading.Thread(target=self.upload_worker, name='upload', daemon=True)
+        upload_thread.start()
+
+        # Start looking for Model Updates in the background
+        self.model_watcher.start()
+
+        # Start reporting the Stage Metrics to IoT Hub and serving them locally
+        self.metrics_publisher.start()
+        self.metrics_server.start()
+
         # Intialize IoTHub
         try:
             self.iothub_client_init()
@@ -439,8 +771,9 @@ class PiImageDetection():
             while True:
                 logging.debug('Starting Edge.py')
 
-                # Check and Run Model Updates
-                self.azure_model_update(update_json_path)
+                # Run Model Updates only when the watcher found one
+                if self.model_watcher.update_available.is_set():
+                    self.azure_model_update()
                 
                 # Began running and stay running the entire project.
                 self.get_video()
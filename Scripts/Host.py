@@ -6,37 +6,276 @@
 #  Authors:  David (Seun) Odun-Ayo
 #  Emails:   dodunayo@nd.edu | dave_seun@yahoo.com
 #  Description: User runs this on there host computer to transfer pi3 folder
-#   and its corresponding categories.txt to Azure Blob Storage 
+#   and its corresponding categories.txt to Azure Blob Storage. Each file is
+#   also published by content hash with a manifest so that devices only
+#   download what changed. With --build the Python wrapper is compiled here
+#   and published too, so devices skip cmake and make. Targets whose content
+#   is already in storage are skipped, the others are published concurrently.
+#   Host.py expand restores the single pictures of the image segments the
+#   devices upload to edgeimages/archives.
+#   Usage: python Host.py [--build] [--toolchain-dir DIR] [--connections N]
+#          [--force] [pi3 pi3_64 aarch64]
+#          python Host.py expand [--output DIR] [--all] [segment ...]
 #  Requires: Python 3.x
 #
 ###############################################################################
 
+import argparse
 import json
 import os
 import shutil
+import subprocess
 import sys
+import tempfile
 import time
 import zipfile
+import imagearchive
+import modelpackage
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from azure.common import AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService, ContentSettings, PublicAccess
 
 SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
+# Parallel connections per target, shared by the files uploaded at once
+MAX_CONNECTIONS = 4
+# Where the devices upload their image segments
+ARCHIVE_CONTAINER = 'edgeimages'
+ARCHIVE_FOLDER = 'archives'
+
+def azure_download_manifest(model_container_name, model_dir):
+    # The manifest currently published for the target, if any
+    try:
+        blob = block_blob_service.get_blob_to_bytes(model_container_name, modelpackage.manifest_blob_name(model_dir))
+        return modelpackage.loads(blob.content)
+    except (AzureMissingResourceHttpError, ValueError):
+        return None
+
+def list_objects(model_container_name):
+    # One listing instead of an existence check per file
+    prefix = "{0}/".format(modelpackage.OBJECTS_DIR)
+    return set(blob.name for blob in block_blob_service.list_blobs(model_container_name, prefix=prefix))
+
+def stored_artifacts(manifest, stored_objects):
+    # Wrappers of an earlier build, as long as all of their files are still in storage
+    return dict((toolchain, files) for toolchain, files in manifest.get("artifacts", {}).items()
+                if all(modelpackage.object_blob_name(entry["sha256"]) in stored_objects for entry in files.values()))
+
+def azure_upload_objects(model_container_name, paths, published_objects, connections):
+    # Files are stored under their hash, so unchanged ones are already there
+    missing = [(modelpackage.object_blob_name(digest), path) for digest, path in sorted(paths.items())
+               if modelpackage.object_blob_name(digest) not in published_objects]
+    if not missing:
+        return 0
+    # The connections are shared: files go up side by side, and what is left of them splits each file into parallel blocks
+    workers = max(1, min(connections, len(missing)))
+    blob_connections = max(1, connections // workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        uploads = [executor.submit(block_blob_service.create_blob_from_path, model_container_name, object_name, path, max_connections=blob_connections)
+                   for object_name, path in missing]
+        for upload in uploads:
+            upload.result()
+    published_objects.update(object_name for object_name, _ in missing)
+    return len(missing)
+
+def build_wrapper(model_dir_path, build_dir_path, toolchain_file=None):
+    # Build the Python wrapper out of the source tree, cross compiling with the toolchain file if given
+    cmake_command = ["cmake", model_dir_path, "-DCMAKE_BUILD_TYPE=Release"]
+    if toolchain_file is not None:
+        cmake_command.append("-DCMAKE_TOOLCHAIN_FILE={0}".format(toolchain_file))
+    subprocess.check_call(cmake_command, cwd=build_dir_path)
+    subprocess.check_call(["cmake", "--build", ".", "--config", "Release"], cwd=build_dir_path)
+
+    # Collect the wrapper files wherever the generator put them
+    wrapper_paths = {}
+    for dir_path, _, file_names in os.walk(build_dir_path):
+        for file_name in file_names:
+            if modelpackage.is_wrapper_file(file_name) and file_name not in wrapper_paths:
+                wrapper_paths[file_name] = os.path.join(dir_path, file_name)
+    if "model.py" not in wrapper_paths:
+        raise RuntimeError("Building {0} did not produce a Python wrapper".format(model_dir_path))
+    return wrapper_paths
+
+def azure_upload_zip(model_container_name, model_dir, model_dir_path, connections):
+    # Compress the current model file on the computer, for devices without manifest support
+    compressed_model_name = "zipped{0}".format(model_dir)
+    compressed_model_dir_path = "{0}/{1}.zip".format(tempfile.gettempdir(), compressed_model_name)
+    # zipfile with absolute paths, shutil.make_archive changes the working directory of every thread
+    with zipfile.ZipFile(compressed_model_dir_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for dir_path, dir_names, file_names in os.walk(model_dir_path):
+            dir_names.sort()
+            for name in sorted(dir_names) + sorted(file_names):
+                path = os.path.join(dir_path, name)
+                zf.write(path, os.path.relpath(path, model_dir_path))
+    try:
+        # Upload the Compressed Model File to Azure, devices check its SHA-256 while they download it
+        block_blob_service.create_blob_from_path(model_container_name, compressed_model_name, compressed_model_dir_path, content_settings=ContentSettings(content_type='application/zip'), metadata={"sha256": modelpackage.hash_file(compressed_model_dir_path)}, max_connections=connections)
+    finally:
+        os.remove(compressed_model_dir_path)
+
+def target_toolchain(model_dir, toolchain_dir=None):
+    # Returns the toolchain file to build the wrapper of the target with and the toolchain the result loads on
+    toolchain_file = None
+    if toolchain_dir is not None and os.path.exists("{0}/{1}.cmake".format(toolchain_dir, model_dir)):
+        toolchain_file = os.path.abspath("{0}/{1}.cmake".format(toolchain_dir, model_dir))
+    if toolchain_file is None:
+        # Without a toolchain file cmake builds for this computer, whatever the target is called
+        return None, modelpackage.toolchain_key()
+    if model_dir not in modelpackage.TARGET_TOOLCHAINS:
+        raise ValueError("{0} has a toolchain file but no entry in TARGET_TOOLCHAINS".format(model_dir))
+    return toolchain_file, modelpackage.TARGET_TOOLCHAINS[model_dir]
+
+def publish_target(model_container_name, model_dir, categories_path, published_objects, build=False, toolchain_dir=None, connections=MAX_CONNECTIONS, force=False, stored_objects=None):
+    # Returns a short summary of what was published for the target. published_objects are not uploaded again,
+    # stored_objects are all objects in storage, wrappers of earlier builds are kept if theirs are among them
+    start_time = time.monotonic()
+    model_dir_path = "{0}/{1}".format(SCRIPT_DIR, model_dir)
+    toolchain_file, toolchain = target_toolchain(model_dir, toolchain_dir)
+    if build and toolchain_file is None and toolchain != modelpackage.TARGET_TOOLCHAINS.get(model_dir, toolchain):
+        print("{0}: no {0}.cmake toolchain file, the wrapper is built for {1} and only used by devices with that toolchain".format(model_dir, toolchain))
+
+    # Describe the model folder and categories.txt by the hash of every file
+    manifest = modelpackage.build_manifest(model_dir_path, categories_path)
+    published = azure_download_manifest(model_container_name, model_dir)
+    same_package = not force and published is not None and published["package"] == manifest["package"]
+    if published is not None and modelpackage.source_hash(published) == modelpackage.source_hash(manifest):
+        # Wrappers depend on the sources only, they stay valid when just the categories changed
+        manifest["artifacts"] = stored_artifacts(published, published_objects if stored_objects is None else stored_objects)
+    if same_package and (not build or toolchain in manifest.get("artifacts", {})):
+        return "{0}: already published, skipped".format(model_dir)
+
+    paths = {manifest["categories"]["sha256"]: categories_path}
+    for relative_path, entry in manifest["files"].items():
+        paths[entry["sha256"]] = os.path.join(model_dir_path, relative_path)
+
+    build_dir_path = None
+    try:
+        if build and toolchain not in manifest.get("artifacts", {}):
+            # A toolchain file named after the target cross compiles for it, e.g. toolchains/pi3.cmake,
+            # devices with a matching toolchain download the wrapper instead of building it
+            build_dir_path = tempfile.mkdtemp(prefix="build-{0}-".format(model_dir))
+            artifacts = {}
+            for name, path in build_wrapper(model_dir_path, build_dir_path, toolchain_file).items():
+                entry = modelpackage.file_entry(path)
+                artifacts[name] = entry
+                paths[entry["sha256"]] = path
+            manifest.setdefault("artifacts", {})[toolchain] = artifacts
+
+        uploaded = azure_upload_objects(model_container_name, paths, published_objects, connections)
+    finally:
+        if build_dir_path is not None:
+            shutil.rmtree(build_dir_path, ignore_errors=True)
+
+    if not same_package:
+        azure_upload_zip(model_container_name, model_dir, model_dir_path, connections)
+
+    # The manifest goes last, devices never see it before all of its files are there
+    block_blob_service.create_blob_from_bytes(model_container_name, modelpackage.manifest_blob_name(model_dir), modelpackage.dumps(manifest).encode("utf-8"), content_settings=ContentSettings(content_type='application/json'))
+    return "{0}: uploaded {1} of {2} files in {3:.1f}s".format(model_dir, uploaded, len(paths), time.monotonic() - start_time)
+
+def azure_connect():
+    # Intialize Azure Properties
+    azure_key_name = os.environ.get('AZURE_BLOBCONTAINER_NAME')
+    azure_key = os.environ.get('AZURE_BLOBCONTAINER_KEY')
+
+    if azure_key_name is None:
+        print('Name Error Failed. Exiting....')
+        sys.exit(1)
+
+    if azure_key is None:
+        print('Key Error Failed. Exiting....')
+        sys.exit(1)
+
+    return BlockBlobService(account_name = azure_key_name, account_key = azure_key)
+
+def expand_segment(segment_path, index_path, output_dir):
+    # Restore the pictures and add their metadata to the index of the output folder
+    index = None
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+    entries = imagearchive.expand_segment(segment_path, output_dir, index)
+    with open(os.path.join(output_dir, "index.jsonl"), "a") as output_index:
+        for entry in entries:
+            output_index.write(json.dumps(dict(entry, segment=os.path.basename(segment_path))) + "\n")
+    return len(entries)
+
+def expand_main(argv):
+    # Define Globals
+    global block_blob_service
+
+    parser = argparse.ArgumentParser(prog="Host.py expand", description="Restore the pictures of uploaded image segments")
+    parser.add_argument("segments", nargs="*", help="local .tar segments or segment names in {0}/{1}, all new ones if none are given".format(ARCHIVE_CONTAINER, ARCHIVE_FOLDER))
+    parser.add_argument("--output", default="{0}/{1}".format(SCRIPT_DIR, "expanded"), help="folder the pictures are restored to")
+    parser.add_argument("--all", action="store_true", help="also expand the segments that were expanded before")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    # Segments from Azure are remembered so the next run only fetches new ones
+    expanded_path = os.path.join(args.output, "expanded.json")
+    expanded = set()
+    if os.path.exists(expanded_path):
+        with open(expanded_path, "r") as expanded_file:
+            expanded = set(json.load(expanded_file))
+
+    local_segments = [segment for segment in args.segments if os.path.exists(segment)]
+    for segment_path in local_segments:
+        count = expand_segment(segment_path, imagearchive.index_name(segment_path), args.output)
+        print("{0}: {1} pictures".format(segment_path, count))
+
+    remote_segments = [segment for segment in args.segments if segment not in local_segments]
+    if not args.segments or remote_segments:
+        block_blob_service = azure_connect()
+        if not remote_segments:
+            prefix = "{0}/".format(ARCHIVE_FOLDER)
+            remote_segments = sorted(blob.name[len(prefix):] for blob in block_blob_service.list_blobs(ARCHIVE_CONTAINER, prefix=prefix)
+                                     if blob.name.endswith(imagearchive.SEGMENT_SUFFIX))
+            if not args.all:
+                remote_segments = [segment for segment in remote_segments if segment not in expanded]
+        download_dir = tempfile.mkdtemp()
+        try:
+            for segment in remote_segments:
+                segment_path = os.path.join(download_dir, segment)
+                index_path = imagearchive.index_name(segment_path)
+                block_blob_service.get_blob_to_path(ARCHIVE_CONTAINER, "{0}/{1}".format(ARCHIVE_FOLDER, segment), segment_path)
+                try:
+                    block_blob_service.get_blob_to_path(ARCHIVE_CONTAINER, "{0}/{1}".format(ARCHIVE_FOLDER, imagearchive.index_name(segment)), index_path)
+                except AzureMissingResourceHttpError:
+                    # The index is uploaded after its segment and may still be on its way
+                    index_path = None
+                count = expand_segment(segment_path, index_path, args.output)
+                os.remove(segment_path)
+                expanded.add(segment)
+                with open(expanded_path, "w") as expanded_file:
+                    json.dump(sorted(expanded), expanded_file)
+                print("{0}: {1} pictures".format(segment, count))
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
 
 def main():
     # Define Globals
     global block_blob_service
-    
+
+    # Image segments have their own command, everything else publishes models
+    if sys.argv[1:2] == ["expand"]:
+        expand_main(sys.argv[2:])
+        return
+
+    # Parse the Deployment Targets to publish
+    parser = argparse.ArgumentParser(description="Publish ELL models to Azure Blob Storage")
+    parser.add_argument("targets", nargs="*", default=["pi3"], help="model folders to publish, e.g. pi3 pi3_64 aarch64")
+    parser.add_argument("--build", action="store_true", help="also build and publish the Python wrapper")
+    parser.add_argument("--toolchain-dir", help="folder with a <target>.cmake toolchain file per target")
+    parser.add_argument("--connections", type=int, default=MAX_CONNECTIONS, help="parallel connections per target")
+    parser.add_argument("--force", action="store_true", help="publish even if the content is already in storage")
+    args = parser.parse_args()
+
     # Define categories variables
     categories_dir = "categories.txt"
     categories_path = "{0}/{1}".format(SCRIPT_DIR, categories_dir)
-    
-    # Define model variables
-    model_dir = "pi3"
-    model_dir_path = "{0}/{1}".format(SCRIPT_DIR, model_dir)
-    compressed_model_name = "zipped{0}".format(model_dir)
     model_container_name = 'edgemodels'
-    compressed_model_dir_path ="{0}/{1}.zip".format(SCRIPT_DIR, compressed_model_name)
-    
+
      # Intialize Azure Properties
     azure_key_name = os.environ.get('AZURE_BLOBCONTAINER_NAME')
     azure_key = os.environ.get('AZURE_BLOBCONTAINER_KEY')
@@ -52,29 +291,38 @@ def main():
     if azure_key and azure_key_name is not None:
         print('Everything worked fine')
 
+    for model_dir in args.targets:
+        if not os.path.exists("{0}/{1}".format(SCRIPT_DIR, model_dir)):
+            print("There is no {0} model file in this directory".format(model_dir))
+            sys.exit(1)
+
+    if not os.path.exists(categories_path):
+        print("There is no categories.txt file on this Device")
+        sys.exit(1)
+
     block_blob_service = BlockBlobService(account_name = azure_key_name, account_key = azure_key)
-    
+
     # Create Blob Container if it doesn't already exists
     block_blob_service.create_container(model_container_name)
 
-    # Compress the current model file on the computer
-    if os.path.exists(model_dir_path):
-        shutil.make_archive(compressed_model_name, 'zip', model_dir_path)
-    else:
-        print("There is no model file in this directory")
-        sys.exit(1)
-
-    # Upload the Compressed Model File to Azure
-    block_blob_service.create_blob_from_path(model_container_name, compressed_model_name, compressed_model_dir_path, content_settings=ContentSettings(content_type='application/zip'))
+    # Publish all Deployment Targets at once, they share the objects already in storage.
+    # With --force every file is uploaded again, the listing still tells which earlier wrappers can be kept
+    stored_objects = list_objects(model_container_name)
+    published_objects = set() if args.force else set(stored_objects)
 
-    # Upload the categories.txt for your specific model to Azure
-    if os.path.exists(categories_path):
+    # Upload the categories.txt for your specific model to Azure, for devices without manifest support.
+    # Its object goes up right after it, so a stored object means the categories.txt is current
+    categories_hash = modelpackage.hash_file(categories_path)
+    if modelpackage.object_blob_name(categories_hash) not in published_objects:
         block_blob_service.create_blob_from_path(model_container_name, categories_dir, categories_path)
-    else:
-        print("There is no categories.txt file on this Device")
-        sys.exit(1)
+        azure_upload_objects(model_container_name, {categories_hash: categories_path}, published_objects, args.connections)
 
-    # Upload Categories File to Azure
+    with ThreadPoolExecutor(max_workers=len(args.targets)) as executor:
+        results = [executor.submit(publish_target, model_container_name, model_dir, categories_path, published_objects,
+                                   args.build, args.toolchain_dir, args.connections, args.force, stored_objects)
+                   for model_dir in args.targets]
+        for result in results:
+            print(result.result())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,132 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     alertdispatcher.py
+#  Description: Sends the SMS alerts of Edge.py from a background thread.
+#   Detections are queued without blocking, bursts are coalesced into one
+#   summary message, and every label has its own deduplication window and
+#   rate limit so a busy scene cannot run up the SMS bill.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+MAX_QUEUED_ALERTS = 256
+# The rate limit counts the messages of a label over this many seconds
+RATE_PERIOD = 3600.0
+
+
+class LabelState():
+    """What was sent and what is still unreported for one label."""
+    def __init__(self):
+        self.last_sent = None
+        self.sent = collections.deque()
+        self.count = 0
+        self.best = 0.0
+
+
+class AlertDispatcher():
+    """Queues detections and turns them into rate-limited messages.
+
+    `send_function` is called as `send_function(body)` from the dispatcher
+    thread and may raise.
+
+    `coalesce_window` is the number of seconds detections are gathered after
+    the first one of a burst before a single summary is sent.
+
+    `dedup_window` is the number of seconds a label stays quiet after it was
+    sent. Detections in the meantime are counted into its next message.
+
+    `max_per_period` is the number of messages a label may cause per
+    RATE_PERIOD.
+    """
+    def __init__(self, send_function, coalesce_window=10.0, dedup_window=300.0, max_per_period=6):
+        self.send_function = send_function
+        self.coalesce_window = coalesce_window
+        self.dedup_window = dedup_window
+        self.max_per_period = max_per_period
+        self.alerts = queue.Queue(maxsize=MAX_QUEUED_ALERTS)
+        self.labels = {}
+        self.dropped = 0
+        self.thread = None
+
+    def notify(self, label, confidence):
+        """Queue a detection, never blocks the caller."""
+        try:
+            self.alerts.put_nowait((label, confidence))
+        except queue.Full:
+            self.dropped += 1
+
+    def collect(self):
+        # Gather a burst: the first detection and whatever follows within the window
+        batch = collections.OrderedDict()
+        alert = self.alerts.get()
+        deadline = time.monotonic() + self.coalesce_window
+        while alert is not None:
+            label, confidence = alert
+            count, best = batch.get(label, (0, 0.0))
+            batch[label] = (count + 1, max(best, confidence))
+            remaining = deadline - time.monotonic()
+            try:
+                alert = self.alerts.get(timeout=remaining) if remaining > 0 else self.alerts.get_nowait()
+            except queue.Empty:
+                alert = None
+        return batch
+
+    def select(self, batch, now):
+        """Returns the labels of `batch` to send now with their count and best
+        confidence since they were last sent.
+        """
+        selected = collections.OrderedDict()
+        for label, (count, best) in batch.items():
+            state = self.labels.setdefault(label, LabelState())
+            state.count += count
+            state.best = max(state.best, best)
+            if state.last_sent is not None and now - state.last_sent < self.dedup_window:
+                continue
+            while state.sent and now - state.sent[0] >= RATE_PERIOD:
+                state.sent.popleft()
+            if len(state.sent) >= self.max_per_period:
+                continue
+            selected[label] = (state.count, state.best)
+            state.last_sent = now
+            state.sent.append(now)
+            state.count = 0
+            state.best = 0.0
+        return selected
+
+    def format_message(self, selected):
+        if len(selected) == 1:
+            label, (count, best) = next(iter(selected.items()))
+            if count == 1:
+                return "Prediction(s): {0} & Prediction Confidence: {1}".format(label, best)
+        return "Prediction(s): {0}".format(", ".join(
+            "{0} ({1}x, best {2:.2f})".format(label, count, best) for label, (count, best) in selected.items()))
+
+    def dispatch(self, batch):
+        selected = self.select(batch, time.monotonic())
+        if not selected:
+            return
+        try:
+            self.send_function(self.format_message(selected))
+        except Exception:
+            logging.exception("Sending the alert failed")
+
+    def work(self):
+        """Worker loop, sends the queued detections until the process ends."""
+        while True:
+            self.dispatch(self.collect())
+            if self.dropped:
+                logging.debug("{0} alerts were dropped, the queue was full".format(self.dropped))
+                self.dropped = 0
+
+    def start(self):
+        """Start the dispatcher thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name="alertdispatcher", daemon=True)
+            self.thread.start()
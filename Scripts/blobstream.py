@@ -0,0 +1,365 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     blobstream.py
+#  Description: Streams blobs to and from Azure Blob Storage in chunks. A
+#   background thread fetches the next chunks while the caller writes the
+#   current one to disk, and a SHA-256 is computed on the fly so downloads
+#   can be verified without reading them back from the SD card. Uploads are
+#   staged as blocks while the data is still being produced and committed
+#   at the end, so a recording never has to touch the SD card. Blocks are
+#   held in memory until they are staged; only those the network falls
+#   behind on, or that are left when it goes away, are written to disk.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from azure.storage.blob import BlobBlock, ContentSettings
+
+CHUNK_SIZE = 4 * 1024 * 1024
+PREFETCH_CHUNKS = 2
+PROGRESS_INTERVAL = 5.0
+BLOCK_SIZE = 4 * 1024 * 1024
+PENDING_BLOCKS = 4
+BLOCK_ATTEMPTS = 3
+# Content type of a staged blocks file, see BlockBlobWriter.commit and commit_staged
+STAGED_BLOCKS_TYPE = "application/x-staged-blocks"
+STAGED_BLOCKS_VERSION = 1
+
+
+class ProgressReporter():
+    """Logs the progress and throughput of a transfer of `total` bytes at
+    most every `interval` seconds.
+    """
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        megabytes = self.done / (1024.0 * 1024.0)
+        rate = self.throughput() / (1024.0 * 1024.0)
+        if self.total:
+            logging.debug("{0}: {1:.1f} MB of {2:.1f} MB ({3:.0f}%) at {4:.2f} MB/s".format(
+                self.label, megabytes, self.total / (1024.0 * 1024.0), 100.0 * self.done / self.total, rate))
+        else:
+            logging.debug("{0}: {1:.1f} MB at {2:.2f} MB/s".format(self.label, megabytes, rate))
+
+    def update(self, count):
+        self.done += count
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def finish(self):
+        self.report()
+
+
+class BlobReader():
+    """A read-only file object over a blob, fetched in `chunk_size` ranges
+    by a background thread that keeps up to `prefetch` chunks ahead.
+
+    Every range is requested with the ETag of the first one, so a blob that
+    is replaced halfway through fails the download instead of mixing two
+    versions. `sha256` covers all bytes returned by `read` so far.
+    """
+    def __init__(self, block_blob_service, container, blob_name, chunk_size=CHUNK_SIZE,
+                 prefetch=PREFETCH_CHUNKS, progress=True):
+        self.block_blob_service = block_blob_service
+        self.container = container
+        self.blob_name = blob_name
+        self.chunk_size = chunk_size
+        self.sha256 = hashlib.sha256()
+        properties = block_blob_service.get_blob_properties(container, blob_name)
+        self.size = properties.properties.content_length
+        self.etag = properties.properties.etag
+        self.metadata = properties.metadata or {}
+        self.progress = ProgressReporter(blob_name, self.size) if progress else None
+        self.chunks = queue.Queue(maxsize=prefetch)
+        self.buffer = bytearray()
+        self.position = 0
+        self.fetched = 0
+        self.closed = False
+        self.fetcher = threading.Thread(target=self.fetch, name="blobreader", daemon=True)
+        self.fetcher.start()
+
+    def fetch(self):
+        # Runs ahead of the reader, the bounded queue holds it back
+        start = 0
+        try:
+            while start < self.size and not self.closed:
+                end = min(start + self.chunk_size, self.size) - 1
+                blob = self.block_blob_service.get_blob_to_bytes(
+                    self.container, self.blob_name, start_range=start, end_range=end, if_match=self.etag)
+                self.chunks.put(blob.content)
+                start = end + 1
+            self.chunks.put(b"")
+        except Exception as error:
+            self.chunks.put(error)
+
+    def next_chunk(self):
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def read(self, size=-1):
+        """Returns up to `size` bytes, fewer only at the end of the blob."""
+        while (size < 0 or len(self.buffer) - self.position < size) and self.fetched < self.size:
+            chunk = self.next_chunk()
+            if not chunk:
+                break
+            if self.position:
+                # Drop what was already read before the buffer grows
+                del self.buffer[:self.position]
+                self.position = 0
+            self.buffer += chunk
+            self.fetched += len(chunk)
+        end = len(self.buffer) if size < 0 else min(len(self.buffer), self.position + size)
+        data = bytes(self.buffer[self.position:end])
+        self.position = end
+        self.sha256.update(data)
+        if self.progress is not None:
+            self.progress.update(len(data))
+        return data
+
+    def drain(self):
+        """Read and hash whatever is left of the blob."""
+        while self.read(self.chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def close(self):
+        self.closed = True
+        # Unblock the fetcher if it waits on a full queue
+        while self.fetcher.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if self.progress is not None:
+            self.progress.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BlockSegment():
+    """A writable file object for one part of a BlockBlobWriter blob."""
+    def __init__(self, writer, index):
+        self.writer = writer
+        self.index = index
+        self.buffer = bytearray()
+        self.block_ids = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.writer.block_size:
+            self.writer.stage(self, bytes(self.buffer[:self.writer.block_size]))
+            del self.buffer[:self.writer.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.buffer:
+                self.writer.stage(self, bytes(self.buffer))
+                self.buffer = bytearray()
+
+
+class BlockBlobWriter():
+    """Uploads a blob as staged blocks while it is being written.
+
+    The blob is written through one or more segments from `open_segment`,
+    each a file object. The segments may be written at the same time from
+    different threads, e.g. the camera thread and the thread copying the
+    pre-roll, and are joined in the order they were opened on `commit`.
+
+    A background thread stages each full `block_size` block with put_block
+    and drops its data once it is staged. Writing never waits for it: up to
+    `pending` blocks are held in memory, blocks beyond that go to a spill
+    file in `spill_dir` and are read back from there. If a block cannot be
+    staged after BLOCK_ATTEMPTS tries, the blocks not staged yet are spilled
+    too and `commit` fails.
+    """
+    def __init__(self, block_blob_service, container, blob_name, content_type, spill_dir,
+                 block_size=BLOCK_SIZE, pending=PENDING_BLOCKS):
+        self.block_blob_service = block_blob_service
+        self.container = container
+        self.blob_name = blob_name
+        self.content_type = content_type
+        self.spill_path = os.path.join(spill_dir, "{0}.spill".format(blob_name))
+        self.block_size = block_size
+        self.pending = pending
+        self.segments = []
+        self.blocks = queue.Queue()
+        self.lock = threading.Lock()
+        self.blocks_in_memory = 0
+        # (offset, size) in the spill file of the blocks that are not staged yet
+        self.spilled = {}
+        self.spill_file = None
+        self.failed = False
+        self.staged_bytes = 0
+        self.uploader = threading.Thread(target=self.upload, name="blockblobwriter", daemon=True)
+        self.uploader.start()
+
+    def open_segment(self):
+        segment = BlockSegment(self, len(self.segments))
+        self.segments.append(segment)
+        return segment
+
+    def spill(self, block_id, data):
+        # Called with the lock held
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_path, "w+b")
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spilled[block_id] = (self.spill_file.tell(), len(data))
+        self.spill_file.write(data)
+
+    def read_spilled(self, block_id):
+        with self.lock:
+            offset, size = self.spilled[block_id]
+            self.spill_file.seek(offset)
+            return self.spill_file.read(size)
+
+    def stage(self, segment, data):
+        # Block ids must all have the same length, they sort by segment and position
+        block_id = "{0:04d}{1:08d}".format(segment.index, len(segment.block_ids))
+        segment.block_ids.append(block_id)
+        with self.lock:
+            keep = self.blocks_in_memory < self.pending and not self.failed
+            if keep:
+                self.blocks_in_memory += 1
+            else:
+                # The network is behind or gone, the camera must not wait for it
+                self.spill(block_id, data)
+        self.blocks.put((block_id, data if keep else None))
+
+    def upload(self):
+        while True:
+            block = self.blocks.get()
+            try:
+                if block is None:
+                    return
+                block_id, data = block
+                if not self.failed:
+                    self.put_block(block_id, data if data is not None else self.read_spilled(block_id))
+                with self.lock:
+                    if data is not None:
+                        self.blocks_in_memory -= 1
+                    if not self.failed:
+                        self.spilled.pop(block_id, None)
+                    elif data is not None:
+                        # Not staged, it has to survive until the next attempt
+                        self.spill(block_id, data)
+            finally:
+                self.blocks.task_done()
+
+    def put_block(self, block_id, data):
+        for attempt in range(BLOCK_ATTEMPTS):
+            try:
+                self.block_blob_service.put_block(self.container, self.blob_name, data, block_id)
+                self.staged_bytes += len(data)
+                return
+            except Exception as error:
+                logging.debug("Staging a block of {0} failed ({1})".format(self.blob_name, error))
+                time.sleep(2 ** attempt)
+        self.failed = True
+
+    def block_ids(self):
+        return [block_id for segment in self.segments for block_id in segment.block_ids]
+
+    def commit(self, staged_path):
+        """Close the segments and commit the blob. Returns True once it is
+        in storage. Otherwise writes a staged blocks file to `staged_path`,
+        with the block list and the data of the blocks that are not staged
+        yet, and returns False. commit_staged finishes the blob from it.
+        """
+        for segment in self.segments:
+            segment.close()
+        self.blocks.put(None)
+        self.uploader.join()
+        if not self.failed:
+            try:
+                put_block_list(self.block_blob_service, self.container, self.blob_name, self.block_ids(),
+                               self.content_type)
+                logging.debug("Streamed {0} ({1} bytes)".format(self.blob_name, self.staged_bytes))
+                self.remove_spill()
+                return True
+            except Exception:
+                logging.exception("Committing {0} failed".format(self.blob_name))
+        self.write_staged(staged_path)
+        self.remove_spill()
+        return False
+
+    def write_staged(self, staged_path):
+        blocks = []
+        offset = 0
+        for block_id in self.block_ids():
+            if block_id in self.spilled:
+                blocks.append([block_id, offset, self.spilled[block_id][1]])
+                offset += self.spilled[block_id][1]
+            else:
+                blocks.append([block_id, None, None])
+        header = {"version": STAGED_BLOCKS_VERSION, "contentType": self.content_type, "blocks": blocks}
+        with open(staged_path, "wb") as staged_file:
+            staged_file.write(json.dumps(header).encode("utf-8") + b"\n")
+            for block_id, block_offset, _ in blocks:
+                if block_offset is not None:
+                    staged_file.write(self.read_spilled(block_id))
+
+    def remove_spill(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+            os.remove(self.spill_path)
+
+
+def put_block_list(block_blob_service, container, blob_name, block_ids, content_type):
+    block_list = [BlobBlock(id=block_id) for block_id in block_ids]
+    block_blob_service.put_block_list(container, blob_name, block_list,
+                                      content_settings=ContentSettings(content_type=content_type))
+
+
+def commit_staged(block_blob_service, container, blob_name, staged_path):
+    """Finish a blob from the staged blocks file a failed commit left:
+    stage the blocks it holds the data of and commit the block list. The
+    blocks staged before stay uncommitted in storage for up to a week.
+    Raises if the blob cannot be committed yet.
+    """
+    with open(staged_path, "rb") as staged_file:
+        header = json.loads(staged_file.readline().decode("utf-8"))
+        if header.get("version") != STAGED_BLOCKS_VERSION:
+            raise ValueError("Unknown staged blocks version {0}".format(header.get("version")))
+        data_start = staged_file.tell()
+        for block_id, offset, size in header["blocks"]:
+            if offset is not None:
+                staged_file.seek(data_start + offset)
+                block_blob_service.put_block(container, blob_name, staged_file.read(size), block_id)
+    put_block_list(block_blob_service, container, blob_name, [block[0] for block in header["blocks"]],
+                   header["contentType"])
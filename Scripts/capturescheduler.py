@@ -0,0 +1,65 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     capturescheduler.py
+#  Description: Paces the capture stage of Edge.py. Frames are taken at a
+#   target rate of classified frames per second, or as fast as the model
+#   keeps up, instead of after fixed sleeps. The rate that was actually
+#   achieved is measured from the finished predictions.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import collections
+import time
+
+
+class CaptureScheduler():
+    """Decides when the next frame is due.
+
+    `target_rate` is the number of frames per second to classify. 0 means as
+    fast as the model allows; the capture stage is then only held back by
+    the bounded queue in front of the model.
+
+    `preroll` is the number of seconds of video the circular buffer has to
+    hold before the first frame is taken.
+
+    `cycle_length` is the number of seconds after which `cycle_over` reports
+    that the current get_video cycle should end.
+
+    `window` is the number of recent predictions the achieved rate is
+    measured over.
+    """
+    def __init__(self, target_rate=0.0, preroll=0, cycle_length=60.0, window=30):
+        self.target_rate = target_rate
+        self.start_time = time.monotonic()
+        self.next_due = self.start_time + preroll
+        self.cycle_end = self.next_due + cycle_length
+        self.predictions = collections.deque(maxlen=window)
+
+    def delay(self):
+        """Seconds to wait before the next frame is due."""
+        return max(0.0, self.next_due - time.monotonic())
+
+    def cycle_over(self):
+        return time.monotonic() >= self.cycle_end
+
+    def captured(self):
+        """Called after every frame to schedule the next one."""
+        now = time.monotonic()
+        interval = 1.0 / self.target_rate if self.target_rate > 0 else 0.0
+        # Frames missed while the pipeline stalled are not made up in a burst
+        self.next_due = max(self.next_due + interval, now)
+
+    def predicted(self):
+        """Called by the inference stage after every prediction."""
+        self.predictions.append(time.monotonic())
+
+    def achieved_rate(self):
+        """Classified frames per second over the recent predictions."""
+        if len(self.predictions) < 2:
+            return 0.0
+        elapsed = self.predictions[-1] - self.predictions[0]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.predictions) - 1) / elapsed
@@ -0,0 +1,132 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     clipassembler.py
+#  Description: Turns the raw h264 segments of an event into MP4 clips in the
+#   background. Edge.py hands over the segments as soon as they are on disk
+#   and goes back to detecting while MP4Box runs here.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+# The clips that can be produced for an event
+VARIANTS = ("before", "after", "full")
+
+
+class ClipJob():
+    """The raw segments of one event.
+
+    `work_dir` holds the segments and the produced clips and is removed once
+    the job is done. `before_path` and `after_path` are the h264 segments
+    recorded before and after the event. Clips are named
+    video-<variant>-<stamp>.mp4.
+
+    `variants` are the clips to produce, a subset of VARIANTS.
+
+    `details` is handed back untouched to the callback.
+    """
+    def __init__(self, work_dir, before_path, after_path, stamp, framerate, variants=VARIANTS, details=None):
+        self.work_dir = work_dir
+        self.before_path = before_path
+        self.after_path = after_path
+        self.stamp = stamp
+        self.framerate = framerate
+        self.variants = [variant for variant in VARIANTS if variant in variants]
+        self.details = details
+
+    def clip_name(self, variant):
+        return "video-{0}-{1}.mp4".format(variant, self.stamp)
+
+    def clip_path(self, variant):
+        return os.path.join(self.work_dir, self.clip_name(variant))
+
+
+def run_command(command):
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+
+
+class ClipAssembler():
+    """Bounded pool of workers running MP4Box for queued ClipJobs.
+
+    `on_assembled` is called from a worker as `on_assembled(job, clips)`
+    with `clips` a list of (variant, name, path) in VARIANTS order. The
+    files may be moved away; anything left in the job's `work_dir`
+    afterwards is deleted.
+
+    `workers` is the number of MP4Box processes run at once.
+
+    `max_jobs` bounds the jobs waiting for a worker. `submit` blocks while
+    it is reached, so a slow SD card holds back new recordings instead of
+    filling up.
+
+    `metrics` is an optional edgemetrics.MetricsRegistry the MP4Box runs are
+    timed in as the transcode stage.
+    """
+    def __init__(self, on_assembled, workers=1, max_jobs=4, run_command=run_command, metrics=None):
+        self.on_assembled = on_assembled
+        self.metrics = metrics
+        self.workers = workers
+        self.run_command = run_command
+        self.jobs = queue.Queue(maxsize=max_jobs)
+        self.threads = []
+
+    def mux(self, job, segment_paths, output_path):
+        # MP4Box appends every further raw segment to the first one, no intermediate MP4s
+        temp_path = "{0}.tmp".format(output_path)
+        command = ["MP4Box", "-fps", str(job.framerate), "-quiet", "-add", segment_paths[0]]
+        for segment_path in segment_paths[1:]:
+            command += ["-cat", segment_path]
+        if self.metrics is None:
+            self.run_command(command + ["-new", temp_path])
+        else:
+            with self.metrics.time("transcode"):
+                self.run_command(command + ["-new", temp_path])
+        os.replace(temp_path, output_path)
+
+    def assemble(self, job):
+        clips = []
+        segments = {
+            "before": [job.before_path],
+            "after": [job.after_path],
+            "full": [job.before_path, job.after_path],
+        }
+        for variant in job.variants:
+            path = job.clip_path(variant)
+            self.mux(job, segments[variant], path)
+            clips.append((variant, job.clip_name(variant), path))
+        logging.debug("Assembled {0} clip(s) for {1}".format(len(clips), job.stamp))
+        return clips
+
+    def work(self):
+        """Worker loop, assembles the queued jobs until the process ends."""
+        while True:
+            job = self.jobs.get()
+            try:
+                self.on_assembled(job, self.assemble(job))
+            except Exception:
+                logging.exception("Assembling the clips for {0} failed".format(job.stamp))
+            finally:
+                shutil.rmtree(job.work_dir, ignore_errors=True)
+                self.jobs.task_done()
+
+    def submit(self, job):
+        """Queue `job`, blocks while `max_jobs` jobs are already waiting."""
+        self.jobs.put(job)
+
+    def join(self):
+        """Wait until every queued job is done."""
+        self.jobs.join()
+
+    def start(self):
+        """Start the background workers."""
+        for index in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.work, name="clipassembler", daemon=True)
+            thread.start()
+            self.threads.append(thread)
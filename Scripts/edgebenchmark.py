@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     edgebenchmark.py
+#  Description: Runs the PiImageDetection pipeline of Edge.py off-device.
+#   The camera, the ELL model, IoT Hub and Twilio are replaced by stand-ins
+#   and Azure Blob Storage by a folder, everything else is the real code.
+#   Reports per-stage latency percentiles, frames per second, bytes written
+#   and memory high-water marks, e.g. to compare two commits:
+#   python3 edgebenchmark.py --cycles 5 --model-latency 0.05
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import cv2
+import numpy as np
+
+STAGES = ("capture", "preprocess", "predict", "encode", "upload", "transcode", "alert")
+PERCENTILES = (50, 95, 99)
+NUM_CATEGORIES = 10
+EVENT_CATEGORY = 3
+# Bytes per second of the synthetic h264 recording
+VIDEO_BITRATE = 2 * 1024 * 1024
+# Seconds to wait for the background stages once the last cycle is over
+DRAIN_TIMEOUT = 120.0
+
+
+class StageTimer():
+    """Collects the latency of every call per stage, from any thread."""
+    def __init__(self):
+        self.samples = dict((stage, []) for stage in STAGES)
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, function):
+        """Returns `function` timed under `stage`."""
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        summary = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            values = np.array(samples) * 1000.0
+            summary[stage] = dict(count=len(samples), max=float(values.max()),
+                                  **dict(("p{0}".format(p), float(np.percentile(values, p))) for p in PERCENTILES))
+        return summary
+
+
+class SyntheticCamera():
+    """Stands in for picamera.PiCamera. Frames are a fixed background with
+    sensor noise and a square moving across it. The h264 recording is random
+    data at VIDEO_BITRATE, written in scaled time: waiting for `t` seconds
+    takes `t * time_scale`.
+    """
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+        self.resolution = (1280, 720)
+        self.framerate = 30
+        self.output = None
+        self.frame_count = 0
+        self.random_state = np.random.RandomState(0)
+        self.backgrounds = {}
+
+    def background(self, shape):
+        if shape not in self.backgrounds:
+            rows, columns = shape[:2]
+            gradient = np.add.outer(np.arange(rows) * 120 // rows, np.arange(columns) * 120 // columns)
+            self.backgrounds[shape] = np.repeat(gradient[:, :, None], shape[2], axis=2).astype(np.uint8)
+        return self.backgrounds[shape]
+
+    def start_preview(self):
+        pass
+
+    def start_recording(self, output, format=None, **kwargs):
+        self.output = output
+
+    def write_video(self, output, seconds):
+        data = os.urandom(int(VIDEO_BITRATE * seconds))
+        if isinstance(output, str):
+            with open(output, "ab") as video_file:
+                video_file.write(data)
+        elif output is not None:
+            output.write(data)
+
+    def split_recording(self, output, **kwargs):
+        self.output = output
+
+    def wait_recording(self, timeout=0, **kwargs):
+        # The circular buffer is only read through copy_to, it does not need to fill up
+        if timeout and not isinstance(self.output, SyntheticCircularIO):
+            self.write_video(self.output, timeout)
+        if timeout:
+            time.sleep(timeout * self.time_scale)
+
+    def stop_recording(self, **kwargs):
+        self.output = None
+
+    def capture(self, output, format=None, resize=None, use_video_port=False, **kwargs):
+        if format == "jpeg":
+            self.capture_picture(output, resize, kwargs.get("quality", 85))
+        else:
+            self.capture_frame(output)
+            self.frame_count += 1
+
+    def draw(self, frame):
+        np.copyto(frame, self.background(frame.shape))
+        # A little sensor noise keeps the JPEGs from getting unrealistically small
+        frame += self.random_state.randint(0, 8, frame.shape, dtype=np.uint8)
+        size = frame.shape[0] // 4
+        left = (self.frame_count * 16) % max(1, frame.shape[1] - size)
+        frame[size:2 * size, left:left + size] = 255
+
+    def capture_frame(self, output):
+        self.draw(output)
+
+    def capture_picture(self, output, resize, quality):
+        # The camera encodes on its GPU, here OpenCV stands in for it
+        columns, rows = resize or self.resolution
+        frame = np.empty((rows, columns, 3), dtype=np.uint8)
+        self.draw(frame)
+        encoded, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        output.write(jpeg.tobytes())
+
+
+class SyntheticCircularIO(io.BytesIO):
+    """Stands in for picamera.PiCameraCircularIO."""
+    def __init__(self, camera, seconds=None, **kwargs):
+        super().__init__()
+        self.camera = camera
+
+    def copy_to(self, output, seconds=None, **kwargs):
+        self.camera.write_video(output, seconds or 1)
+
+
+class LocalBlockBlobService():
+    """Stands in for azure.storage.blob.BlockBlobService with a folder per
+    container under `root`. Every request takes `latency` seconds.
+    """
+    def __init__(self, root, latency=0.0, timer=None):
+        self.root = root
+        self.latency = latency
+        self.timer = timer
+        self.bytes_written = 0
+        self.requests = 0
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def blob_path(self, container, blob_name):
+        path = os.path.join(self.root, container, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def request(self, size):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.bytes_written += size
+
+    def create_container(self, container, **kwargs):
+        os.makedirs(os.path.join(self.root, container), exist_ok=True)
+        return True
+
+    def exists(self, container, blob_name=None, **kwargs):
+        return os.path.exists(os.path.join(self.root, container, blob_name or ""))
+
+    def create_blob_from_bytes(self, container, blob_name, blob, content_settings=None, metadata=None, **kwargs):
+        start = time.perf_counter()
+        self.request(len(blob))
+        with open(self.blob_path(container, blob_name), "wb") as blob_file:
+            blob_file.write(blob)
+        self.timer.record("upload", time.perf_counter() - start)
+
+    def create_blob_from_path(self, container, blob_name, file_path, **kwargs):
+        with open(file_path, "rb") as source_file:
+            self.create_blob_from_bytes(container, blob_name, source_file.read(), **kwargs)
+
+    def create_blob_from_stream(self, container, blob_name, stream, **kwargs):
+        self.create_blob_from_bytes(container, blob_name, stream.read(), **kwargs)
+
+    def put_block(self, container, blob_name, block, block_id, **kwargs):
+        start = time.perf_counter()
+        self.request(len(block))
+        with self.lock:
+            self.blocks[(container, blob_name, block_id)] = bytes(block)
+        self.timer.record("upload", time.perf_counter() - start)
+
+    def put_block_list(self, container, blob_name, block_list, **kwargs):
+        self.request(0)
+        with open(self.blob_path(container, blob_name), "wb") as blob_file:
+            for block in block_list:
+                with self.lock:
+                    blob_file.write(self.blocks.pop((container, blob_name, block.id)))
+
+
+def install_stand_ins(timer, blob_dir, upload_latency, model_latency, event_every):
+    """Register the stand-in modules Edge.py imports in place of the device
+    and cloud SDKs. Must run before Edge is imported.
+    """
+    class AzureHttpError(Exception):
+        def __init__(self, message, status_code):
+            super().__init__(message)
+            self.status_code = status_code
+
+    class AzureMissingResourceHttpError(AzureHttpError):
+        pass
+
+    class ContentSettings():
+        def __init__(self, content_type=None, **kwargs):
+            self.content_type = content_type
+
+    class BlobBlock():
+        def __init__(self, id=None, state=None):
+            self.id = id
+
+    class PublicAccess():
+        Container = "container"
+        Blob = "blob"
+
+    azure = types.ModuleType("azure")
+    azure.common = types.ModuleType("azure.common")
+    azure.common.AzureHttpError = AzureHttpError
+    azure.common.AzureMissingResourceHttpError = AzureMissingResourceHttpError
+    azure.storage = types.ModuleType("azure.storage")
+    azure.storage.blob = types.ModuleType("azure.storage.blob")
+    azure.storage.blob.BlockBlobService = lambda **kwargs: LocalBlockBlobService(blob_dir, upload_latency, timer)
+    azure.storage.blob.ContentSettings = ContentSettings
+    azure.storage.blob.BlobBlock = BlobBlock
+    azure.storage.blob.PublicAccess = PublicAccess
+
+    class IoTHubClient():
+        def __init__(self, connection_string, protocol):
+            self.reported_states = []
+
+        def set_device_method_callback(self, callback, context):
+            pass
+
+        def send_reported_state(self, reported_state, size, callback, context):
+            self.reported_states.append(reported_state)
+
+    class IoTHubTransportProvider():
+        MQTT = 1
+
+    iothub_client = types.ModuleType("iothub_client")
+    iothub_client.IoTHubClient = IoTHubClient
+    iothub_client.IoTHubTransportProvider = IoTHubTransportProvider
+    iothub_client.IoTHubClientError = iothub_client.IoTHubError = Exception
+    iothub_client.IoTHubClientResult = iothub_client.DeviceMethodReturnValue = object
+    iothub_service_client = types.ModuleType("iothub_service_client")
+    iothub_service_client.IoTHubRegistryManager = object
+    iothub_service_client.IoTHubRegistryManagerAuthMethod = object
+    iothub_service_client.IoTHubDeviceTwin = object
+    iothub_service_client.IoTHubError = Exception
+
+    class Messages():
+        def __init__(self):
+            self.sent = []
+
+        def create(self, **kwargs):
+            self.sent.append(kwargs)
+
+    class Client():
+        def __init__(self, account_sid=None, auth_token=None):
+            self.messages = Messages()
+
+    twilio = types.ModuleType("twilio")
+    twilio.rest = types.ModuleType("twilio.rest")
+    twilio.rest.Client = Client
+
+    picamera = types.ModuleType("picamera")
+    picamera.PiCamera = SyntheticCamera
+    picamera.PiCameraCircularIO = SyntheticCircularIO
+
+    class InputShape():
+        rows = 224
+        columns = 224
+        channels = 3
+
+    model = types.ModuleType("model")
+    model.frame_count = 0
+
+    def predict(input_data):
+        # Every `event_every`th frame is an event, the others stay below the threshold
+        start = time.perf_counter()
+        time.sleep(model_latency)
+        model.frame_count += 1
+        prediction = np.zeros(NUM_CATEGORIES, dtype=np.float32)
+        if event_every and model.frame_count % event_every == 0:
+            prediction[EVENT_CATEGORY] = 0.9
+        else:
+            prediction[1] = 0.1
+        timer.record("predict", time.perf_counter() - start)
+        return prediction
+
+    model.get_default_input_shape = InputShape
+    model.predict = predict
+
+    sys.modules.update({
+        "azure": azure, "azure.common": azure.common, "azure.storage": azure.storage,
+        "azure.storage.blob": azure.storage.blob, "iothub_client": iothub_client,
+        "iothub_service_client": iothub_service_client, "twilio": twilio, "twilio.rest": twilio.rest,
+        "picamera": picamera, "model": model,
+    })
+
+
+def concatenate_segments(command):
+    """Stands in for MP4Box when it is not installed: writes the segments of
+    an `-add a -cat b -new out` command one after the other.
+    """
+    inputs = [command[index + 1] for index, arg in enumerate(command) if arg in ("-add", "-cat")]
+    with open(command[command.index("-new") + 1], "wb") as output_file:
+        for path in inputs:
+            with open(path, "rb") as input_file:
+                shutil.copyfileobj(input_file, output_file)
+
+
+def local_bytes_written():
+    """Bytes this process wrote through system calls so far, None where
+    /proc is not available.
+    """
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            for line in io_file:
+                key, value = line.split(":")
+                if key == "wchar":
+                    return int(value)
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run(args, work_dir):
+    timer = StageTimer()
+    install_stand_ins(timer, os.path.join(work_dir, "blobs"), args.upload_latency,
+                      args.model_latency, args.event_every)
+    os.environ.setdefault("AZURE_BLOBCONTAINER_NAME", "benchmark")
+    os.environ.setdefault("AZURE_BLOBCONTAINER_KEY", "benchmark")
+
+    import Edge
+    import modelsession
+
+    # Everything Edge.py writes next to itself goes to the work directory instead
+    Edge.SCRIPT_DIR = work_dir
+    modelsession.SCRIPT_DIR = work_dir
+    Edge.CYCLE_LENGTH = args.cycle_length
+    with open(os.path.join(work_dir, "categories.txt"), "w") as cat_file:
+        cat_file.write("\n".join("category{0}".format(i) for i in range(NUM_CATEGORIES)))
+
+    detection = Edge.PiImageDetection()
+    detection.capture_rate = args.capture_rate
+    detection.video_preroll = args.preroll
+    detection.stream_video = args.stream_video
+    detection.inference_workers = args.inference_workers
+    detection.alert_dispatcher.coalesce_window *= args.time_scale
+
+    camera = Edge.picamera.PiCamera(args.time_scale)
+    camera.capture_frame = timer.wrap("capture", camera.capture_frame)
+    camera.capture_picture = timer.wrap("encode", camera.capture_picture)
+    Edge.camera_device = camera
+    preprocessor = detection.model_session.state.preprocessor
+    preprocessor.prepare = timer.wrap("preprocess", preprocessor.prepare)
+    detection.clip_assembler.mux = timer.wrap("transcode", detection.clip_assembler.mux)
+    if shutil.which("MP4Box") is None:
+        detection.clip_assembler.run_command = concatenate_segments
+    detection.alert_dispatcher.send_function = timer.wrap("alert", detection.alert_dispatcher.send_function)
+
+    # Forked before the pipeline starts its threads, like Edge.main does
+    detection.inference_launcher.start()
+    detection.clip_assembler.start()
+    detection.alert_dispatcher.start()
+    detection.upload_spool.start()
+    upload_thread = threading.Thread(target=detection.upload_worker, name="upload", daemon=True)
+    upload_thread.start()
+
+    wchar_before = local_bytes_written()
+    start = time.perf_counter()
+    for _ in range(args.cycles):
+        detection.get_video()
+    detection_seconds = time.perf_counter() - start
+
+    # Let the background stages finish what the cycles handed them
+    detection.upload_queue.join()
+    detection.clip_assembler.join()
+    for thread in threading.enumerate():
+        if thread.name == "videostream":
+            thread.join()
+    if detection.inference_pool is not None:
+        detection.inference_pool.close()
+        # The workers timed the model in their own processes and sent the durations back
+        for stage in ("preprocess", "predict"):
+            histogram = detection.metrics.histogram(stage)
+            if not timer.samples.get(stage):
+                timer.samples[stage] = list(histogram.values[:min(histogram.count, len(histogram.values))])
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while len(detection.upload_spool) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    total_seconds = time.perf_counter() - start
+    wchar_after = local_bytes_written()
+
+    frames = camera.frame_count
+    service = detection.block_blob_service
+    _, traced_peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, None)
+    return {
+        "stages": timer.summary(),
+        "frames": frames,
+        "detection_seconds": detection_seconds,
+        "total_seconds": total_seconds,
+        "fps": frames / detection_seconds if detection_seconds > 0 else 0.0,
+        "blob_requests": service.requests,
+        "blob_bytes": service.bytes_written,
+        "local_bytes": None if wchar_before is None else wchar_after - wchar_before,
+        "pending_uploads": len(detection.upload_spool),
+        "traced_peak_bytes": traced_peak,
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def format_bytes(count):
+    if count is None:
+        return "n/a"
+    return "{0:.1f} MB".format(count / (1024.0 * 1024.0))
+
+
+def print_results(results):
+    print("{0:>10} {1:>7} {2}".format("stage", "count", " ".join(
+        "{0:>9}".format(name) for name in ["p{0}".format(p) for p in PERCENTILES] + ["max"])))
+    for stage in STAGES:
+        stats = results["stages"].get(stage)
+        if stats is None:
+            continue
+        print("{0:>10} {1:>7} {2}".format(stage, stats["count"], " ".join(
+            "{0:>7.2f}ms".format(stats[name]) for name in ["p{0}".format(p) for p in PERCENTILES] + ["max"])))
+    print("frames: {0} in {1:.2f}s ({2:.2f} fps), {3:.2f}s until all uploads were done".format(
+        results["frames"], results["detection_seconds"], results["fps"], results["total_seconds"]))
+    print("written: {0} to blob storage in {1} requests, {2} locally".format(
+        format_bytes(results["blob_bytes"]), results["blob_requests"], format_bytes(results["local_bytes"])))
+    print("memory: {0} peak traced, {1} max rss".format(
+        format_bytes(results["traced_peak_bytes"]), format_bytes(results["max_rss_bytes"])))
+    if results["pending_uploads"]:
+        print("warning: {0} uploads were still pending".format(results["pending_uploads"]))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the Edge.py pipeline without a device or network.")
+    arg_parser.add_argument("--cycles", type=int, default=3, help="get_video cycles to run")
+    arg_parser.add_argument("--cycle-length", type=float, default=5.0, help="seconds per cycle without an event")
+    arg_parser.add_argument("--capture-rate", type=float, default=0.0,
+                            help="classified frames per second, 0 runs as fast as the model allows")
+    arg_parser.add_argument("--model-latency", type=float, default=0.05, help="seconds per model prediction")
+    arg_parser.add_argument("--event-every", type=int, default=20,
+                            help="every n-th frame of a model is an event, 0 for none")
+    arg_parser.add_argument("--inference-workers", type=int, default=2,
+                            help="processes running the model, 0 to run it on the inference thread")
+    arg_parser.add_argument("--upload-latency", type=float, default=0.0, help="seconds per blob storage request")
+    arg_parser.add_argument("--preroll", type=int, default=5, help="seconds of video before an event")
+    arg_parser.add_argument("--time-scale", type=float, default=0.01,
+                            help="factor applied to the time the camera spends recording")
+    arg_parser.add_argument("--stream-video", action="store_true", help="stream events instead of making clips")
+    arg_parser.add_argument("--no-tracemalloc", action="store_true",
+                            help="skip tracing allocations, it slows the pipeline down")
+    arg_parser.add_argument("--json", help="also write the results to this file")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    arg_parser.add_argument("--verbose", action="store_true", help="log what the pipeline does")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+    work_dir = tempfile.mkdtemp(prefix="edgebenchmark-")
+    try:
+        results = run(args, work_dir)
+    finally:
+        if args.keep:
+            print("work directory: {0}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     edgemetrics.py
+#  Description: Latency histograms, counters and gauges for the stages of
+#   Edge.py. Every histogram keeps the most recent durations in a fixed
+#   size ring buffer, so recording is O(1) and memory does not grow on a
+#   device that runs for months. The metrics are published as IoT Hub
+#   reported properties and served as plain text on a local HTTP port.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import contextlib
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+import numpy as np
+
+# The stages of Edge.py that are timed
+STAGES = ("capture", "motion", "preprocess", "predict", "upload", "transcode", "alert")
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW_SIZE = 1024
+
+
+class Histogram():
+    """The last `window` durations of a stage in seconds, plus the count,
+    sum and maximum since the start.
+    """
+    def __init__(self, window=WINDOW_SIZE):
+        self.values = np.zeros(window, dtype=np.float64)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.values[self.count % len(self.values)] = seconds
+            self.count += 1
+            self.total += seconds
+            self.maximum = max(self.maximum, seconds)
+
+    def quantiles(self, quantiles=QUANTILES):
+        """Returns the `quantiles` of the recent durations, None when there
+        are none yet.
+        """
+        with self.lock:
+            recent = self.values[:min(self.count, len(self.values))].copy()
+        if not len(recent):
+            return [None for _ in quantiles]
+        return [float(value) for value in np.percentile(recent, [100.0 * q for q in quantiles])]
+
+    def snapshot(self):
+        summary = dict(("p{0}".format(int(q * 100)), value) for q, value in zip(QUANTILES, self.quantiles()))
+        summary.update(count=self.count, sum=self.total, max=self.maximum)
+        return summary
+
+
+class MetricsRegistry():
+    """Named histograms, counters and gauges. All methods may be called from
+    any thread.
+
+    Gauges are either set to a value or registered as a function that is
+    called whenever the metrics are read, e.g. the length of a queue.
+    """
+    def __init__(self, stages=STAGES, window=WINDOW_SIZE):
+        self.window = window
+        self.histograms = dict((stage, Histogram(window)) for stage in stages)
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram(self.window))
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).record(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """Records the duration of the with block under `stage`, also when
+        it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def register_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def gauge_values(self):
+        values = {}
+        for name, gauge in list(self.gauges.items()):
+            try:
+                values[name] = gauge() if callable(gauge) else gauge
+            except Exception:
+                logging.debug("Reading the gauge {0} failed".format(name))
+        return values
+
+    def snapshot(self):
+        """All metrics as one json serializable dict."""
+        with self.lock:
+            histograms = list(self.histograms.items())
+            counters = dict(self.counters)
+        return {
+            "stages": dict((stage, histogram.snapshot()) for stage, histogram in histograms if histogram.count),
+            "counters": counters,
+            "gauges": self.gauge_values(),
+        }
+
+    def render_text(self):
+        """The metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = []
+        for stage, summary in sorted(snapshot["stages"].items()):
+            for quantile in QUANTILES:
+                value = summary["p{0}".format(int(quantile * 100))]
+                lines.append('{0}_seconds{{quantile="{1}"}} {2}'.format(stage, quantile, value))
+            lines.append("{0}_seconds_sum {1}".format(stage, summary["sum"]))
+            lines.append("{0}_seconds_count {1}".format(stage, summary["count"]))
+            lines.append("{0}_seconds_max {1}".format(stage, summary["max"]))
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("{0}_total {1}".format(name, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("{0} {1}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def reported_state(self):
+        """The metrics as an IoT Hub reported properties document."""
+        return json.dumps({"metrics": self.snapshot()})
+
+
+class MetricsPublisher():
+    """Sends the metrics of `registry` every `interval` seconds.
+
+    `report_function` is called as `report_function(reported_state)` with
+    the json document from `MetricsRegistry.reported_state`.
+    """
+    def __init__(self, registry, report_function, interval=300.0):
+        self.registry = registry
+        self.report_function = report_function
+        self.interval = interval
+        self.wake = threading.Event()
+        self.thread = None
+
+    def set_interval(self, interval):
+        """Takes effect right away, the next publish is `interval` seconds
+        after the last one.
+        """
+        self.interval = interval
+        self.wake.set()
+
+    def publish(self):
+        try:
+            self.report_function(self.registry.reported_state())
+        except Exception:
+            logging.exception("Publishing the metrics failed")
+
+    def work(self):
+        last_publish = time.monotonic()
+        while True:
+            remaining = self.interval - (time.monotonic() - last_publish)
+            if remaining > 0:
+                # Woken early by set_interval, the wait is worked out again
+                self.wake.wait(remaining)
+                self.wake.clear()
+                continue
+            self.publish()
+            last_publish = time.monotonic()
+
+    def start(self):
+        """Start publishing in the background."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name="metricspublisher", daemon=True)
+            self.thread.start()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer():
+    """Serves the metrics of `registry` as text on http://`host`:`port`/metrics."""
+    def __init__(self, registry, host="127.0.0.1", port=9100):
+        self.registry = registry
+        self.address = (host, port)
+        self.server = None
+
+    def make_handler(self):
+        registry = self.registry
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def start(self):
+        """Start serving in the background. A port that is taken only costs
+        the endpoint, never the pipeline.
+        """
+        if self.server is not None:
+            return
+        try:
+            self.server = ThreadingHTTPServer(self.address, self.make_handler())
+        except OSError:
+            logging.exception("Could not serve the metrics on {0}:{1}".format(*self.address))
+            return
+        thread = threading.Thread(target=self.server.serve_forever, name="metricsserver", daemon=True)
+        thread.start()
@@ -16,7 +16,7 @@ import math
 import platform
 import cv2
 import numpy as np
-from itertools import product
+from concurrent.futures import ThreadPoolExecutor
 
 # Find any child directory that matches the four deployment targets (pi3,
 # pi3_64, aarch64, host) or begins with "model". For all these directories,
@@ -35,17 +35,9 @@ else:
     sys.path += [os.path.join(d, "build") for d in SEARCH_DIRS]
 
 
-def prepare_image_for_model(
-        image, width, height, reorder_to_rgb=False, ravel=True):
-    """Prepare an image for use with a model. Typically, this involves:
-        - Resize and center crop to the required width and height while
-          preserving the image's aspect ratio.
-          Simple resize may result in a stretched or squashed image which will
-          affect the model's ability to classify images.
-        - OpenCV gives the image in BGR order, so we may need to re-order the
-          channels to RGB.
-        - Optionally, convert the OpenCV result to a std::vector<float> for use
-          with the ELL model.
+def center_crop(image):
+    """Returns a view of the largest square at the center of `image`. No
+    pixels are copied.
     """
     if image.shape[0] > image.shape[1]:  # Tall (more rows than columns)
         row_start = int((image.shape[0] - image.shape[1]) / 2)
@@ -58,20 +50,115 @@ def prepare_image_for_model(
         col_start = int((image.shape[1] - image.shape[0]) / 2)
         col_end = col_start + image.shape[0]
 
+    return image[row_start:row_end, col_start:col_end]
+
+
+def prepare_image_for_model(
+        image, width, height, reorder_to_rgb=False, ravel=True, out=None,
+        scratch=None):
+    """Prepare an image for use with a model. Typically, this involves:
+        - Resize and center crop to the required width and height while
+          preserving the image's aspect ratio.
+          Simple resize may result in a stretched or squashed image which will
+          affect the model's ability to classify images.
+        - OpenCV gives the image in BGR order, so we may need to re-order the
+          channels to RGB.
+        - Optionally, convert the OpenCV result to a std::vector<float> for use
+          with the ELL model.
+
+    `out` is an optional C-contiguous float32 buffer holding
+    `height * width * channels` values. The result is converted straight into
+    it and a view of it is returned, so no float image is allocated.
+
+    `scratch` is an optional uint8 buffer of shape `(height, width, channels)`
+    that receives the resized image instead of a new allocation.
+    """
     # Center crop the image maintaining aspect ratio
-    cropped = image[row_start:row_end, col_start:col_end]
+    cropped = center_crop(image)
 
     # Resize to model's requirements
-    resized = cv2.resize(cropped, (height, width))
-
-    # Re-order color channels if needed
+    resized = cv2.resize(cropped, (width, height), scratch)
+
+    if out is None:
+        if not ravel:
+            # Re-order color channels if needed
+            if reorder_to_rgb:
+                resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+            return resized
+        out = np.empty(resized.shape, dtype=np.float32)
+    elif out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise ValueError("out must be a C-contiguous float32 buffer")
+
+    # A view of `out` in image layout, raises if the sizes do not match
+    target = out.reshape(resized.shape)
+    # Re-order in place on the small uint8 image. This is much cheaper than
+    # a float copy through a reversed channel stride
     if reorder_to_rgb:
-        resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, resized)
+    # Convert to float directly into the destination buffer
+    np.copyto(target, resized, casting="unsafe")
     if ravel:
         # Return as a vector of floats
-        result = resized.astype(np.float).ravel()
-        return result
-    return resized
+        return out.reshape(-1)
+    return target
+
+
+def prepare_images_for_model(
+        images, width, height, reorder_to_rgb=False, out=None, workers=1):
+    """Prepare a batch of images for use with a model. Each image goes through
+    `prepare_image_for_model` and becomes one row of an
+    `(N, height * width * channels)` float32 array, which is returned.
+
+    `out` is an optional C-contiguous float32 array of that shape to fill
+    instead of allocating one.
+
+    `workers` is the number of threads preparing images concurrently. OpenCV
+    releases the GIL while resizing, so this spreads a batch over the cores.
+    """
+    if out is None:
+        channels = images[0].shape[2] if images[0].ndim == 3 else 1
+        out = np.empty((len(images), height * width * channels),
+                       dtype=np.float32)
+
+    def prepare(index):
+        prepare_image_for_model(
+            images[index], width, height, reorder_to_rgb, out=out[index])
+
+    if workers > 1 and len(images) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume the results so exceptions raised by workers propagate
+            list(executor.map(prepare, range(len(images))))
+    else:
+        for index in range(len(images)):
+            prepare(index)
+    return out
+
+
+class ImagePreprocessor:
+    """ Helper class that prepares images for a model without allocating
+        anything per image. It owns the resize and float32 buffers, so every
+        call to `prepare` overwrites the result of the previous one.
+
+        `width` and `height` - the input size the model expects.
+
+        `reorder_to_rgb` - re-order OpenCV's BGR channels to RGB.
+    """
+    def __init__(self, width, height, reorder_to_rgb=False, channels=3):
+        self.width = width
+        self.height = height
+        self.reorder_to_rgb = reorder_to_rgb
+        self.scratch = np.empty((height, width, channels), dtype=np.uint8)
+        self.output = np.empty(height * width * channels, dtype=np.float32)
+
+    def prepare(self, image, out=None):
+        """Returns `image` prepared as a contiguous float32 vector. The result
+        is written to `out` if given, else to the preprocessor's own buffer.
+        """
+        if out is None:
+            out = self.output
+        return prepare_image_for_model(
+            image, self.width, self.height, self.reorder_to_rgb, out=out,
+            scratch=self.scratch)
 
 
 def get_top_n(predictions, n=5, threshold=0.20):
@@ -81,16 +168,65 @@ def get_top_n(predictions, n=5, threshold=0.20):
     prediction and the second element represents that probability or confidence
     value.
     """
-    filtered_predictions = [(i, predictions[i]) for i in
-                            range(len(predictions)) if predictions[i] >=
-                            threshold]
-    filtered_predictions.sort(key=lambda tup: tup[1], reverse=True)
-    result = filtered_predictions[:n]
-    return result
+    predictions = np.asarray(predictions).ravel()
+    if n <= 0:
+        return []
+    # Only the predictions that meet the threshold are considered at all
+    candidates = np.flatnonzero(predictions >= threshold)
+    if len(candidates) > n:
+        # Partial selection of the n-th largest value, no full sort of all
+        # classes. Ties at the cut keep the lower indices
+        values = predictions[candidates]
+        kth = np.partition(values, -n)[-n]
+        above = values > kth
+        tied = np.flatnonzero(values == kth)[:n - np.count_nonzero(above)]
+        above[tied] = True
+        candidates = candidates[above]
+    # Highest first, ties keep the lower index first
+    order = np.argsort(-predictions[candidates], kind="mergesort")
+    return [(int(i), predictions[i]) for i in candidates[order]]
+
+
+def get_top_n_batch(predictions, n=5, threshold=0.20):
+    """Return `get_top_n` for every row of an `(N, classes)` matrix of
+    predictions, as a list of N lists of tuples. The selection for all rows
+    is done at once.
+    """
+    predictions = np.atleast_2d(np.asarray(predictions))
+    rows, classes = predictions.shape
+    n = min(n, classes)
+    if n <= 0:
+        return [[] for _ in range(rows)]
+    if n < classes:
+        # Select the n largest values of every row by comparing against the
+        # n-th largest one. Ties at the cut keep the lower indices
+        kth = np.partition(predictions, -n, axis=1)[:, -n, np.newaxis]
+        above = predictions > kth
+        tied = predictions == kth
+        missing = n - np.count_nonzero(above, axis=1)[:, np.newaxis]
+        selected = above | tied
+        if np.any(np.count_nonzero(tied, axis=1)[:, np.newaxis] > missing):
+            selected = above | (tied & (np.cumsum(tied, axis=1) <= missing))
+        # Exactly n per row, in ascending column order
+        top = np.nonzero(selected)[1].reshape(rows, n)
+    else:
+        top = np.tile(np.arange(classes), (rows, 1))
+    row_index = np.arange(rows)[:, np.newaxis]
+    values = predictions[row_index, top]
+    # Highest first, ties keep the lower index first
+    order = np.lexsort((top, -values), axis=1)
+    top = top[row_index, order]
+    values = values[row_index, order]
+    passed = values >= threshold
+    return [[(int(i), v) for i, v in zip(top[r][passed[r]], values[r][passed[r]])]
+            for r in range(rows)]
 
 
 def get_mean_duration(accumulated, duration, max_accumulation_entries=30):
-    """Add a duration to an array and calculate the mean duration."""
+    """Add a duration to an array and calculate the mean duration.
+    Kept for older scripts, Edge.py records its stage durations with
+    edgemetrics.MetricsRegistry instead.
+    """
     accumulated.append(duration)
     if (len(accumulated) > max_accumulation_entries):
         accumulated.pop(0)
@@ -296,6 +432,70 @@ class Region:
                 'location = {0.location})').format(self)
 
 
+# Layout of the compact detections returned by `decode_regions`. `location`
+# holds the normalized x, y, width and height of the box like
+# `Region.location`
+DETECTION_DTYPE = np.dtype([("category", np.int32),
+                            ("probability", np.float32),
+                            ("location", np.float32, (4,))])
+
+
+def decode_regions(inference_output, num_categories, threshold, anchor_boxes):
+    """Returns a structured array of `DETECTION_DTYPE` with one entry per
+    detected object. The whole output tensor is decoded with array operations
+    and no Python object is created per grid cell.
+
+    `num_categories` is the number of categories the network detects.
+
+    The other arguments are the same as for `get_regions`.
+    """
+    inference_output = np.asarray(inference_output)
+    shape = inference_output.shape
+    # four values for the bounding box coordinates plus one for the confidence
+    # the rest of the values are the probabilities for the individual
+    # categories
+    box_size = 5 + num_categories
+    num_boxes = shape[2] // box_size
+    # One row of `[x, y, w, h, c, category probabilities...]` per region
+    boxes = inference_output[:, :, :num_boxes * box_size].reshape(
+        shape[0], shape[1], num_boxes, box_size)
+
+    # The `category_scores` have had softmax applied to them, so the largest
+    # one is the category of the region
+    category_scores = boxes[..., 5:]
+    probability = boxes[..., 4] * category_scores.max(axis=-1)
+
+    # Only keep the regions whose probability is greater than the threshold
+    keep = probability > threshold
+    i, j, c = np.nonzero(keep)
+    selected = boxes[keep]
+    anchors = np.asarray(anchor_boxes, dtype=np.float32)[:2 * num_boxes]
+    anchors = anchors.reshape(num_boxes, 2)
+
+    detections = np.empty(len(selected), dtype=DETECTION_DTYPE)
+    detections["category"] = category_scores[keep].argmax(axis=-1)
+    detections["probability"] = probability[keep]
+    # Get the final normalized values for the coordinates of the bounding
+    # boxes
+    location = detections["location"]
+    location[:, 0] = (j + selected[:, 0]) / shape[0]
+    location[:, 1] = (i + selected[:, 1]) / shape[1]
+    location[:, 2] = selected[:, 2] * anchors[c, 0] / shape[0]
+    location[:, 3] = selected[:, 3] * anchors[c, 1] / shape[1]
+    return detections
+
+
+def regions_from_detections(detections, categories):
+    """Returns a list of Region instances for the `detections` returned by
+    `decode_regions`, labelled with `categories`.
+    """
+    return [Region(categories[category], probability, location)
+            for category, probability, location in zip(
+                detections["category"].tolist(),
+                detections["probability"].tolist(),
+                detections["location"])]
+
+
 def get_regions(inference_output, categories, threshold, anchor_boxes):
     """Returns an array of Region instances that represent detected objects
     and their locations.
@@ -312,128 +512,193 @@ def get_regions(inference_output, categories, threshold, anchor_boxes):
 
     `anchor_boxes` is the list of anchor boxes that are used to augment the
     bounding boxes.
+
+    Callers that do not need Region objects should use `decode_regions`.
     """
+    detections = decode_regions(
+        inference_output, len(categories), threshold, anchor_boxes)
+    return regions_from_detections(detections, categories)
 
-    regions = []
-    shape = inference_output.shape
-    # four values for the bounding box coordinates plus one for the confidence
-    # the rest of the values are the probabilities for the individual
-    # categories
-    box_size = 5 + len(categories)
-    num_boxes = shape[2] // box_size
-    for i, j, c in product(range(shape[0]),
-                           range(shape[1]),
-                           range(num_boxes)):
-        # The coordinates and confidence values need to be "unpacked".
-        # The order for each region is `[x, y, w, h, c,
-        # category probabilities...]`. There are `num_boxes` regions for each
-        # `i, j` coordinate pair.
-        box_offset = c * box_size
-        predicted_x = inference_output[i, j, box_offset + 0]
-        predicted_y = inference_output[i, j, box_offset + 1]
-        predicted_width = inference_output[i, j, box_offset + 2]
-        predicted_height = inference_output[i, j, box_offset + 3]
-        predicted_confidence = inference_output[i, j, box_offset + 4]
-
-        # Get the final normalized values for the coordinates of the bounding
-        # box
-        x = (j + predicted_x) / shape[0]
-        y = (i + predicted_y) / shape[1]
-        w = predicted_width * anchor_boxes[2 * c + 0] / shape[0]
-        h = predicted_height * anchor_boxes[2 * c + 1] / shape[1]
-        confidence = predicted_confidence
-
-        # The `category_scores` have had softmax applied to them, so just
-        # find the index of the largest value and get the corresponding
-        # category label.
-        category_scores = inference_output[i,
-                                           j,
-                                           box_offset + 5 :
-                                           box_offset + box_size]
-        category_index = np.argmax(category_scores)
-        probability = confidence * category_scores[category_index]
-
-        # Only add to the list of returned regions if the probability is
-        # greater than the threshold
-        if probability > threshold:
-            regions.append(Region(categories[category_index], probability,
-                                  (x, y, w, h)))
-    return regions
-
-
-def non_max_suppression(regions, overlap_threshold, categories):
+
+# Above this many boxes the overlaps are computed one kept box at a time
+# instead of as a full `n * n` matrix, and categories are no longer batched
+# into a single pass since the overlaps across categories are wasted work
+NMS_MATRIX_LIMIT = 256
+
+
+def box_corners(locations):
+    """Converts an `(n, 4)` array of center x, y, width and height locations
+    to an `(n, 4)` array of x1, y1, x2, y2 corners.
+    """
+    locations = np.asarray(locations, dtype=np.float32)
+    half = locations[:, 2:] / 2
+    return np.hstack((locations[:, :2] - half, locations[:, :2] + half))
+
+
+def intersection_over_union(corners_a, corners_b):
+    """Returns the `(n, m)` matrix of the intersection over union of every
+    box in `corners_a` with every box in `corners_b`, both given as corners.
+    """
+    top_left = np.maximum(corners_a[:, np.newaxis, :2], corners_b[:, :2])
+    bottom_right = np.minimum(corners_a[:, np.newaxis, 2:], corners_b[:, 2:])
+    overlap = np.clip(bottom_right - top_left, 0, None)
+    intersection = overlap[..., 0] * overlap[..., 1]
+    area_a = np.prod(corners_a[:, 2:] - corners_a[:, :2], axis=1)
+    area_b = np.prod(corners_b[:, 2:] - corners_b[:, :2], axis=1)
+    union = area_a[:, np.newaxis] + area_b - intersection
+    return intersection / np.maximum(union, np.finfo(np.float32).tiny)
+
+
+def _suppress(corners, scores, overlap_threshold, soft, sigma,
+              score_threshold):
+    """Greedy suppression over boxes that may all overlap each other. Returns
+    the indices of the kept boxes, highest score first, and their scores.
+    """
+    # Visit the boxes from the highest score down
+    order = np.argsort(-scores, kind="mergesort")
+    corners = corners[order]
+    scores = scores[order]
+    count = len(order)
+
+    if not soft and count <= NMS_MATRIX_LIMIT:
+        # Every pairwise overlap at once. Row `p` flags the boxes that the
+        # `p`-th best box removes if it is kept
+        suppresses = intersection_over_union(corners, corners) > overlap_threshold
+        suppressed = np.zeros(count, dtype=bool)
+        keep = []
+        for position in range(count):
+            if not suppressed[position]:
+                keep.append(position)
+                suppressed |= suppresses[position]
+        keep = np.array(keep, dtype=np.intp)
+        return order[keep], scores[keep]
+
+    # Large scenes and soft-NMS only compare the best remaining box with the
+    # boxes still in the running, so the work shrinks as boxes drop out
+    remaining = np.arange(count)
+    keep = []
+    if soft:
+        # Overlapping boxes are not removed, their scores decay with a
+        # gaussian of the overlap until they fall under `score_threshold`
+        scores = scores.astype(np.float32)
+    while len(remaining):
+        best = np.argmax(scores[remaining]) if soft else 0
+        index = remaining[best]
+        keep.append(index)
+        remaining = np.delete(remaining, best)
+        overlap = intersection_over_union(
+            corners[index:index + 1], corners[remaining])[0]
+        if soft:
+            scores[remaining] *= np.exp(-np.square(overlap) / sigma)
+            remaining = remaining[scores[remaining] >= score_threshold]
+        else:
+            remaining = remaining[overlap <= overlap_threshold]
+    keep = np.array(keep, dtype=np.intp)
+    return order[keep], scores[keep]
+
+
+def suppress_detection_indices(
+        locations, scores, categories, overlap_threshold, batched=None,
+        soft=False, sigma=0.5, score_threshold=0.001):
+    """Non max suppression over boxes of several categories. Boxes only
+    suppress boxes of the same category. Returns the indices of the kept
+    boxes and their, possibly decayed, scores.
+
+    `locations` is an `(n, 4)` array of center x, y, width and height.
+
+    `scores` and `categories` hold the probability and category index of
+    every box.
+
+    `batched` shifts the boxes of every category to their own disjoint area
+    so all categories are handled in a single pass instead of one pass per
+    category. By default scenes of up to NMS_MATRIX_LIMIT boxes are batched.
+
+    `soft` selects soft-NMS with a gaussian decay of parameter `sigma`; boxes
+    are dropped once their score falls under `score_threshold`.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    categories = np.asarray(categories)
+    if len(scores) == 0:
+        return np.empty(0, dtype=np.intp), scores
+    corners = box_corners(locations)
+    if batched is None:
+        batched = len(scores) <= NMS_MATRIX_LIMIT
+
+    if batched:
+        # Boxes of different categories can never overlap after the shift
+        extent = float(corners.max() - corners.min()) + 1
+        offset = (categories * extent).astype(np.float32)
+        corners = corners + offset[:, np.newaxis]
+        return _suppress(corners, scores, overlap_threshold, soft, sigma,
+                         score_threshold)
+
+    kept = []
+    kept_scores = []
+    for category in np.unique(categories):
+        members = np.flatnonzero(categories == category)
+        keep, keep_scores = _suppress(
+            corners[members], scores[members], overlap_threshold, soft,
+            sigma, score_threshold)
+        kept.append(members[keep])
+        kept_scores.append(keep_scores)
+    keep = np.concatenate(kept)
+    keep_scores = np.concatenate(kept_scores)
+    # Same order as the batched pass, highest score first
+    order = np.argsort(-keep_scores, kind="mergesort")
+    return keep[order], keep_scores[order]
+
+
+def suppress_detections(detections, overlap_threshold, batched=None,
+                        soft=False, sigma=0.5, score_threshold=0.001):
+    """Non max suppression for the structured array returned by
+    `decode_regions`. Returns the kept detections, highest probability first.
+    With `soft` their probabilities are the decayed ones.
+    """
+    keep, scores = suppress_detection_indices(
+        detections["location"], detections["probability"],
+        detections["category"], overlap_threshold, batched, soft, sigma,
+        score_threshold)
+    kept = detections[keep]
+    kept["probability"] = scores
+    return kept
+
+
+def non_max_suppression(regions, overlap_threshold, categories, batched=None,
+                        soft=False, sigma=0.5):
     """Given a list of `regions` (returned by a call to `get_regions`), remove
     any overlapping bounding boxes for the same object.
 
-    `overlap_threshold` is the minimum amount of overlap needed between two
-    boxes for them to be considered the same.
+    `overlap_threshold` is the minimum intersection over union needed between
+    two boxes for them to be considered the same.
 
     `categories` is a list of categories that represent the type of objects to
     be detected.
+
+    `batched` and `soft` are described in `suppress_detection_indices`. With
+    `soft`, the returned regions carry their decayed probability.
     """
 
     if not regions:
         # If list of regions is empty, return an empty list
         return []
 
-    final_regions = []
-    for c in categories:
-        # Only look at regions that have found the same object
-        filtered_regions = [
-            region for region in regions if region.category == c]
-        if len(filtered_regions) < 2:
-            continue
-
-        # Get all the boxes that represent the object in question
-        boxes = np.array([region.location for region in filtered_regions])
-        w_half = (boxes[:, 2] / 2)
-        h_half = (boxes[:, 3] / 2)
-        x1 = boxes[:, 0] - w_half
-        y1 = boxes[:, 1] - h_half
-        x2 = boxes[:, 0] + w_half
-        y2 = boxes[:, 1] + h_half
-
-        # Calculate the areas once
-        areas = (boxes[:, 2] + 1) * (boxes[:, 3] + 1)
-
-        # `argsort` returns the indices in ascending order
-        # We want the regions with the highest probability to be considered
-        # the "main" regions
-        sorted_indices = np.argsort([r.probability for r in filtered_regions])
-        pick = []
-        while len(sorted_indices):
-            last = len(sorted_indices) - 1
-            i = sorted_indices[last]
-            pick.append(i)
-            suppress = [last]
-            for pos in range(last):
-                j = sorted_indices[pos]
-
-                xx1 = max(x1[i], x1[j])
-                yy1 = max(y1[i], y1[j])
-                xx2 = min(x2[i], x2[j])
-                yy2 = min(y2[i], y2[j])
-
-                overlap_width = xx2 - xx1 + 1
-                overlap_height = yy2 - yy1 + 1
-
-                # If either `overlap_width` or `overlap_height` are `<= 0`
-                # then that means there's no overlap
-                if overlap_width > 0 and overlap_height > 0:
-                    overlap = overlap_width * overlap_height / areas[j]
-
-                    # If there's enough overlap, we want to remove this box
-                    if overlap > overlap_threshold:
-                        suppress.append(pos)
-
-            # Remove all the values that are at the list of indices of
-            # `suppress` and return the resultant array
-            sorted_indices = np.delete(sorted_indices, suppress)
-
-        # Append to `final_regions` the main bounding boxes
-        final_regions += [filtered_regions[i] for i in pick]
-
-    return final_regions
+    # Only regions of the given categories are considered
+    category_index = {c: i for i, c in enumerate(categories)}
+    regions = [r for r in regions if r.category in category_index]
+    if not regions:
+        return []
+    locations = np.array([r.location for r in regions], dtype=np.float32)
+    scores = np.array([r.probability for r in regions], dtype=np.float32)
+    region_categories = np.array(
+        [category_index[r.category] for r in regions])
+
+    keep, keep_scores = suppress_detection_indices(
+        locations, scores, region_categories, overlap_threshold, batched,
+        soft, sigma)
+    if not soft:
+        return [regions[i] for i in keep]
+    return [Region(regions[i].category, float(score), regions[i].location)
+            for i, score in zip(keep, keep_scores)]
 
 
 def draw_regions_on_image(image, regions):
@@ -0,0 +1,172 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     eventjournal.py
+#  Description: Append-only log of the predictions and events of Edge.py.
+#   Every record is one json line in the file of the current day. Once the
+#   day is over, or the file reaches its size limit, it is compressed and
+#   handed over for upload as a single segment, so analytics read a few
+#   large blobs instead of one tiny blob per event. With a schema the lines
+#   are json arrays in the order of a header line instead of objects.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+JOURNAL_SUFFIX = ".jsonl"
+SEGMENT_SUFFIX = ".jsonl.gz"
+JOURNAL_VERSION = 1
+
+
+def read_records(lines):
+    """Returns the records of a journal as dicts, whether it was written
+    with a schema or not. `lines` are the decoded lines of the journal.
+    """
+    fields = None
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        value = json.loads(line)
+        if isinstance(value, dict) and "schema" in value:
+            fields = value["schema"]
+        elif isinstance(value, list):
+            records.append(dict(zip(fields, value)))
+        else:
+            records.append(value)
+    return records
+
+
+class EventJournal():
+    """Rotating json lines journal in `journal_dir`.
+
+    `on_segment` is called as `on_segment(segment_path)` with a finished,
+    gzip compressed journal named <prefix>-<date>-<time>.jsonl.gz. The file
+    belongs to the callback from then on.
+
+    `schema` is an optional sequence of field names. Each file then starts
+    with a {"schema": [...]} header and every record is written as an array
+    of its values in that order, fields it does not have as null.
+
+    A journal is rotated when the day changes or it reaches `max_bytes`.
+    """
+    def __init__(self, journal_dir, on_segment, schema=None, max_bytes=16 * 1024 * 1024, prefix="events"):
+        self.journal_dir = journal_dir
+        self.on_segment = on_segment
+        self.schema = list(schema) if schema else None
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.journal_path = None
+        self.journal_day = None
+        self.thread = None
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+
+    def header(self):
+        return json.dumps({"version": JOURNAL_VERSION, "schema": self.schema}, separators=(",", ":"))
+
+    def open_journal(self, now):
+        day = now.strftime("%Y%m%d")
+        name = "{0}-{1}-{2}{3}".format(self.prefix, day, now.strftime("%H%M%S%f"), JOURNAL_SUFFIX)
+        self.journal_path = os.path.join(self.journal_dir, name)
+        self.journal_file = open(self.journal_path, "a")
+        self.journal_day = day
+        if self.schema:
+            self.journal_file.write(self.header() + "\n")
+
+    def encode(self, record):
+        if self.schema:
+            record = [record.get(field) for field in self.schema]
+        return json.dumps(record, separators=(",", ":"), default=str)
+
+    def append(self, record):
+        """Add the json serializable dict `record` to the journal."""
+        line = self.encode(record) + "\n"
+        now = datetime.now()
+        with self.lock:
+            if self.journal_file is not None and self.journal_day != now.strftime("%Y%m%d"):
+                self.close_journal()
+            if self.journal_file is None:
+                self.open_journal(now)
+            self.journal_file.write(line)
+            # Every record is in the file once append returns, a crash loses at most the current line
+            self.journal_file.flush()
+            full = self.journal_file.tell() >= self.max_bytes
+            if full:
+                self.close_journal()
+
+    def close_journal(self):
+        # Called with the lock held, the compression runs on the rotation thread
+        self.journal_file.close()
+        self.journal_file = None
+        self.journal_path = None
+        self.journal_day = None
+
+    def compress(self, journal_path):
+        segment_path = journal_path[:-len(JOURNAL_SUFFIX)] + SEGMENT_SUFFIX
+        temp_path = "{0}.tmp".format(segment_path)
+        with open(journal_path, "rb") as journal_file, gzip.open(temp_path, "wb") as segment_file:
+            shutil.copyfileobj(journal_file, segment_file)
+        os.replace(temp_path, segment_path)
+        os.remove(journal_path)
+        return segment_path
+
+    def ship(self):
+        """Compress and hand over every closed journal, including those left
+        by a previous run.
+        """
+        # Chosen under the lock, a journal that append opens afterwards is never among them
+        with self.lock:
+            names = [name for name in sorted(os.listdir(self.journal_dir))
+                     if os.path.join(self.journal_dir, name) != self.journal_path]
+        for name in names:
+            path = os.path.join(self.journal_dir, name)
+            if name.endswith(".tmp"):
+                # An interrupted compression, the journal is still there
+                os.remove(path)
+                continue
+            if name.endswith(JOURNAL_SUFFIX):
+                if os.path.getsize(path) == 0:
+                    os.remove(path)
+                    continue
+                path = self.compress(path)
+            elif not name.endswith(SEGMENT_SUFFIX):
+                continue
+            logging.debug("Shipping {0}".format(os.path.basename(path)))
+            self.on_segment(path)
+
+    def rotate(self):
+        """Close the current journal and ship it."""
+        with self.lock:
+            if self.journal_file is not None:
+                self.close_journal()
+        self.ship()
+
+    def work(self):
+        """Ships the journals of past days, until the process ends."""
+        while True:
+            now = datetime.now()
+            with self.lock:
+                if self.journal_file is not None and self.journal_day != now.strftime("%Y%m%d"):
+                    self.close_journal()
+            try:
+                self.ship()
+            except Exception:
+                logging.exception("Shipping the event journal failed")
+            time.sleep(60.0)
+
+    def start(self):
+        """Start shipping journals in the background."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name="eventjournal", daemon=True)
+            self.thread.start()
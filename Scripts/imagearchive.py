@@ -0,0 +1,206 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     imagearchive.py
+#  Description: Collects small pictures into rolling tar segments so they go
+#   to Azure Blob Storage as one request per segment instead of one per
+#   picture. A segment is closed once it reaches a size or an age and is
+#   handed over together with a json index of its pictures and their
+#   metadata. Host.py expand turns segments back into single pictures.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import io
+import json
+import logging
+import os
+import tarfile
+import threading
+import time
+from datetime import datetime
+
+SEGMENT_SUFFIX = ".tar"
+INDEX_SUFFIX = ".json"
+PART_SUFFIX = ".part"
+INDEX_VERSION = 1
+
+
+def index_name(segment_name):
+    """Name of the index that belongs to the segment `segment_name`."""
+    return segment_name[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+def build_index(segment_name, entries):
+    return {"version": INDEX_VERSION, "segment": segment_name, "images": entries}
+
+
+def padded_size(size):
+    """Size of `size` bytes of member data in a tar file, padded to full blocks."""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def read_members(segment_path):
+    """Returns the index entries of the complete members of a tar file, even
+    if it was cut off in the middle of one.
+    """
+    entries = []
+    file_size = os.path.getsize(segment_path)
+    try:
+        with tarfile.open(segment_path, "r") as segment:
+            for member in segment:
+                # tarfile lists the last member even if its data was cut off
+                if member.offset_data + member.size > file_size:
+                    break
+                entries.append({"name": member.name, "offset": member.offset_data, "size": member.size,
+                                "time": member.mtime, "metadata": {}})
+    except (tarfile.ReadError, EOFError):
+        logging.debug("{0} is cut off after {1} images".format(segment_path, len(entries)))
+    return entries
+
+
+class ImageArchiver():
+    """Rolling tar segments of pictures in `archive_dir`.
+
+    `on_segment` is called as `on_segment(segment_path, index_path)` with a
+    closed segment and its index, named <prefix>-<time>.tar and .json. Both
+    files belong to the callback from then on.
+
+    A segment is closed once it holds `max_bytes` or its first picture is
+    `max_age` seconds old. A segment left open by a crash is closed and
+    handed over by `start`, with the pictures that were complete.
+    """
+    def __init__(self, archive_dir, on_segment, max_bytes=4 * 1024 * 1024, max_age=600.0, prefix="images"):
+        self.archive_dir = archive_dir
+        self.on_segment = on_segment
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_path = None
+        self.entries = []
+        self.opened = None
+        self.thread = None
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+
+    def open_segment(self):
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        self.segment_path = os.path.join(self.archive_dir, "{0}-{1}{2}{3}".format(
+            self.prefix, stamp, SEGMENT_SUFFIX, PART_SUFFIX))
+        self.segment = tarfile.open(self.segment_path, "w", format=tarfile.PAX_FORMAT)
+        self.entries = []
+        self.opened = time.monotonic()
+
+    def add(self, name, data, metadata=None):
+        """Append the picture `data` as `name`, e.g. badimages/image-1.jpg,
+        with a json serializable `metadata` dict for the index.
+        """
+        with self.lock:
+            if self.segment is None:
+                self.open_segment()
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = time.time()
+            self.segment.addfile(member, io.BytesIO(data))
+            # The data ends the segment so far, padded to a full tar block
+            self.entries.append({"name": name, "offset": self.segment.offset - padded_size(len(data)), "size": len(data),
+                                 "time": member.mtime, "metadata": metadata or {}})
+            self.segment.fileobj.flush()
+            full = self.segment.offset >= self.max_bytes
+        if full:
+            self.roll()
+
+    def finish_segment(self, part_path, entries):
+        # Drop .part, the segment is complete, and write its index next to it
+        segment_path = part_path[:-len(PART_SUFFIX)] if part_path.endswith(PART_SUFFIX) else part_path
+        os.replace(part_path, segment_path)
+        index_path = index_name(segment_path)
+        with open(index_path, "w") as index_file:
+            json.dump(build_index(os.path.basename(segment_path), entries), index_file)
+        logging.debug("Closed {0} with {1} images".format(os.path.basename(segment_path), len(entries)))
+        self.on_segment(segment_path, index_path)
+
+    def roll(self):
+        """Close the open segment, if any, and hand it over."""
+        with self.lock:
+            if self.segment is None:
+                return
+            self.segment.close()
+            part_path, entries = self.segment_path, self.entries
+            self.segment = None
+            self.segment_path = None
+            self.entries = []
+        if entries:
+            self.finish_segment(part_path, entries)
+        else:
+            os.remove(part_path)
+
+    def due(self):
+        with self.lock:
+            return self.segment is not None and time.monotonic() - self.opened >= self.max_age
+
+    def recover(self):
+        """Hand over the segments a previous run left open or did not get
+        to hand over. Their indexes are rebuilt from the tar headers.
+        """
+        for name in sorted(os.listdir(self.archive_dir)):
+            path = os.path.join(self.archive_dir, name)
+            if name.endswith(INDEX_SUFFIX):
+                os.remove(path)
+                continue
+            if not name.endswith((SEGMENT_SUFFIX, SEGMENT_SUFFIX + PART_SUFFIX)):
+                continue
+            entries = read_members(path)
+            if entries:
+                # Cut off a picture the crash left incomplete and end the archive after the last whole one
+                end = entries[-1]["offset"] + padded_size(entries[-1]["size"])
+                with open(path, "r+b") as segment_file:
+                    segment_file.truncate(end)
+                    segment_file.seek(end)
+                    segment_file.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+                self.finish_segment(path, entries)
+            else:
+                os.remove(path)
+
+    def work(self):
+        """Closes segments that got too old, until the process ends."""
+        while True:
+            time.sleep(min(self.max_age, 5.0))
+            try:
+                if self.due():
+                    self.roll()
+            except Exception:
+                logging.exception("Closing the image segment failed")
+
+    def start(self):
+        """Recover left over segments and start closing old ones in the background."""
+        if self.thread is None:
+            self.recover()
+            self.thread = threading.Thread(target=self.work, name="imagearchiver", daemon=True)
+            self.thread.start()
+
+
+def expand_segment(segment_path, output_dir, index=None):
+    """Write the pictures of the segment at `segment_path` to `output_dir`
+    under their archived names. Returns the index entries of the written
+    pictures, taken from `index` where it has them.
+    """
+    entries = dict((entry["name"], entry) for entry in (index or {}).get("images", []))
+    written = []
+    with tarfile.open(segment_path, "r") as segment:
+        for member in segment:
+            if not member.isfile():
+                continue
+            # Never write outside of output_dir, whatever the member is called
+            path = os.path.realpath(os.path.join(output_dir, member.name))
+            if not path.startswith(os.path.realpath(output_dir) + os.sep):
+                logging.warning("Skipping {0} in {1}".format(member.name, segment_path))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with segment.extractfile(member) as source, open(path, "wb") as image_file:
+                image_file.write(source.read())
+            written.append(entries.get(member.name, {"name": member.name, "size": member.size,
+                                                     "time": member.mtime, "metadata": {}}))
+    return written
@@ -0,0 +1,151 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     imagededup.py
+#  Description: Finds pictures that look like one that was uploaded recently.
+#   Every picture gets a 64 bit difference hash (dHash) and is compared with
+#   the hashes of the last uploads by Hamming distance. Near-duplicates are
+#   only counted against the picture they repeat, so a camera watching an
+#   empty hallway does not fill the retraining set with the same picture.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import json
+import logging
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+HASH_SIZE = 8
+INDEX_VERSION = 1
+
+
+def dhash(image):
+    """Returns the 64 bit difference hash of a BGR or grayscale `image`: one
+    bit per neighbouring pair of pixels of a 9x8 thumbnail, set where the
+    brightness goes up from left to right.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    thumbnail = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distances(hashes, value):
+    """Number of differing bits between each of the uint64 `hashes` and `value`."""
+    differences = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(differences.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ImageDedupIndex():
+    """Bounded index of the hashes of recently uploaded pictures.
+
+    `index_path` is the json file the index is kept in between runs.
+
+    `capacity` is the number of hashes kept. The least recently matched one
+    is dropped to make room for a new one.
+
+    `max_distance` is the Hamming distance up to which two hashes are taken
+    as the same picture. 0 only matches identical hashes.
+
+    `save_interval` is the least number of seconds between two writes of
+    the index to the SD card.
+    """
+    def __init__(self, index_path, capacity=1024, max_distance=4, save_interval=60.0):
+        self.index_path = index_path
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.save_interval = save_interval
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.names = [None] * capacity
+        self.size = 0
+        self.tick = 0
+        self.last_save = time.monotonic()
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("version") != INDEX_VERSION:
+                raise ValueError("Unknown index version {0}".format(index.get("version")))
+            # Keep the most recently used entries if the capacity went down
+            entries = sorted(index["entries"], key=lambda entry: entry[3])[-self.capacity:]
+        except (IOError, ValueError, KeyError, TypeError):
+            logging.exception("Could not read {0}, starting with an empty index".format(self.index_path))
+            return
+        for slot, (hash_hex, name, count, last_used) in enumerate(entries):
+            self.hashes[slot] = np.uint64(int(hash_hex, 16))
+            self.names[slot] = name
+            self.counts[slot] = count
+            self.last_used[slot] = last_used
+        self.size = len(entries)
+        self.tick = int(self.last_used[:self.size].max()) if self.size else 0
+
+    def save(self):
+        """Write the index to `index_path`, atomically."""
+        with self.lock:
+            entries = [["{0:016x}".format(int(self.hashes[slot])), self.names[slot],
+                        int(self.counts[slot]), int(self.last_used[slot])] for slot in range(self.size)]
+            self.dirty = False
+            self.last_save = time.monotonic()
+        temp_path = "{0}.tmp".format(self.index_path)
+        with open(temp_path, "w") as index_file:
+            json.dump({"version": INDEX_VERSION, "entries": entries}, index_file)
+        os.replace(temp_path, self.index_path)
+
+    def find(self, value):
+        """Returns the slot of the closest hash within `max_distance` of
+        `value`, or None.
+        """
+        if not self.size:
+            return None
+        distances = hamming_distances(self.hashes[:self.size], value)
+        slot = int(np.argmin(distances))
+        return slot if distances[slot] <= self.max_distance else None
+
+    def check(self, value, name):
+        """Record the picture `name` with hash `value`. Returns the name of
+        the picture it duplicates, or None if it is new and should be
+        uploaded.
+        """
+        with self.lock:
+            self.tick += 1
+            slot = self.find(value)
+            if slot is not None:
+                self.counts[slot] += 1
+                self.last_used[slot] = self.tick
+                original = self.names[slot]
+            else:
+                if self.size < self.capacity:
+                    slot = self.size
+                    self.size += 1
+                else:
+                    slot = int(np.argmin(self.last_used))
+                self.hashes[slot] = np.uint64(value)
+                self.names[slot] = name
+                self.counts[slot] = 1
+                self.last_used[slot] = self.tick
+                original = None
+            self.dirty = True
+            save_due = time.monotonic() - self.last_save >= self.save_interval
+        if save_due:
+            self.save()
+        return original
+
+    def references(self, name):
+        """Number of times the picture `name` was seen, itself included."""
+        with self.lock:
+            for slot in range(self.size):
+                if self.names[slot] == name:
+                    return int(self.counts[slot])
+        return 0
@@ -0,0 +1,379 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     inferencepool.py
+#  Description: Runs the model in worker processes so inference does not
+#   share the GIL with the camera, the uploads and Twilio, and uses more
+#   than one core of the Pi. The camera captures straight into a ring of
+#   frame slots in shared memory, the workers read the frames from there
+#   without a copy. Each worker gets the slot numbers and sends the labels
+#   back through its own pair of pipes, so a worker that dies takes nothing
+#   shared down with it. The workers are forked by a launcher process that
+#   is itself forked before Edge.py starts any thread.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import contextlib
+import glob
+import logging
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import numpy as np
+import modelsession
+from multiprocessing import reduction
+from modelsession import ModelSession
+
+# The launcher is forked, it and the workers start with the model the parent already loaded
+START_METHOD = "fork"
+STOP_SIGNAL = None
+# Seconds between two attempts to start a worker that could not be started
+WATCH_INTERVAL = 1.0
+# Seconds a worker gets to finish once it was told to stop
+STOP_TIMEOUT = 10.0
+# Frames live in a file in memory where there is one, e.g. on Raspbian
+SHARED_MEMORY_DIR = "/dev/shm"
+# Every worker copies the wrappers it loads into its own folder, removed with the worker
+SNAPSHOT_PREFIX = ".model-worker-"
+
+
+class StageClock():
+    """Stands in for a MetricsRegistry in a worker, keeps the durations of
+    the stages of the last frame so they can be sent back with its result.
+    """
+    def __init__(self):
+        self.durations = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage] = time.perf_counter() - start
+
+
+def inference_process(frame_memory, frame_shape, tasks, results, categories_path, model_dir, snapshot_root, generation):
+    """Worker loop: classifies the frames named by the `tasks` pipe and
+    sends the results through the `results` pipe until it gets STOP_SIGNAL
+    or the pool goes away.
+    """
+    frames = np.frombuffer(frame_memory, dtype=np.uint8).reshape(frame_shape)
+    clock = StageClock()
+    session = ModelSession(categories_path, model_dir, metrics=clock, snapshot_root=snapshot_root)
+    if generation:
+        # A new model was installed after the launcher was forked
+        session.reload()
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:
+            return
+        if task is STOP_SIGNAL:
+            return
+        slot, task_id, task_generation = task
+        if task_generation != generation:
+            # A new model was installed since this worker loaded its one
+            session.reload()
+            generation = task_generation
+        clock.durations = {}
+        try:
+            prediction = session.predict(frames[slot], 2)
+        except Exception:
+            logging.exception("Model Prediction Failed")
+            prediction = None
+        results.send((task_id, prediction, clock.durations))
+
+
+def run_worker(request, handles):
+    # In the worker, the handles are the frame memory, the tasks pipe and the results pipe
+    frame_shape, categories_path, model_dir, snapshot_root, generation = request
+    frame_handle, tasks_handle, results_handle = handles
+    frame_memory = mmap.mmap(frame_handle, int(np.prod(frame_shape)))
+    os.close(frame_handle)
+    tasks = multiprocessing.connection.Connection(tasks_handle, writable=False)
+    results = multiprocessing.connection.Connection(results_handle, readable=False)
+    inference_process(frame_memory, frame_shape, tasks, results, categories_path, model_dir, snapshot_root, generation)
+
+
+def launcher_process(connection):
+    """Launcher loop: forks a worker for every request on `connection`
+    until the process that started the launcher goes away.
+    """
+    # Workers are reaped as soon as they exit
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            request = connection.recv()
+            handles = [reduction.recv_handle(connection) for _ in range(3)]
+        except EOFError:
+            return
+        pid = os.fork()
+        if pid == 0:
+            connection.close()
+            exit_code = 0
+            try:
+                run_worker(request, handles)
+            except Exception:
+                logging.exception("Inference worker failed")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        for handle in handles:
+            os.close(handle)
+        connection.send(pid)
+
+
+class WorkerLauncher():
+    """Forks the inference workers for any number of pools.
+
+    A process forked while other threads run can wait forever on a lock one
+    of them held, e.g. that of a logging handler. `start` forks the launcher
+    once, before any thread is started, and every worker is forked from the
+    launcher from then on, also when one is replaced or a pool is recreated.
+    """
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Fork the launcher, a no-op once it runs."""
+        if self.process is not None:
+            return
+        # Worker folders a previous run did not get to remove
+        for path in glob.glob(os.path.join(modelsession.SCRIPT_DIR, SNAPSHOT_PREFIX + "*")):
+            shutil.rmtree(path, ignore_errors=True)
+        context = multiprocessing.get_context(START_METHOD)
+        parent_connection, child_connection = context.Pipe()
+        self.process = context.Process(target=launcher_process, name="inferencelauncher", args=(child_connection,))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+        self.connection = parent_connection
+
+    def launch(self, request, handles):
+        """Fork a worker for `request` with the file descriptors `handles`.
+        Returns its process id.
+        """
+        with self.lock:
+            self.connection.send(request)
+            for handle in handles:
+                reduction.send_handle(self.connection, handle, self.process.pid)
+            return self.connection.recv()
+
+
+class InferenceWorker():
+    """A worker process, its pipes, its model folder and the tasks it was sent."""
+    def __init__(self, pid, tasks, results, snapshot_root):
+        self.pid = pid
+        self.tasks = tasks
+        self.results = results
+        self.snapshot_root = snapshot_root
+        self.in_flight = set()
+
+
+class InferencePool():
+    """Shared memory frame slots and the worker processes classifying them.
+
+    `launcher` is the started WorkerLauncher the workers are forked by.
+
+    `frame_shape` is the (rows, columns, channels) of the frames, every slot
+    holds one.
+
+    `workers` is the number of worker processes, each with its own copy of
+    the model. A frame goes to the worker with the fewest frames in flight.
+
+    `slots` is the number of frames that can be held at once, by the camera,
+    the workers and whoever still needs the pixels after the prediction.
+    `acquire` blocks while all of them are in use.
+
+    `categories_path` and `model_dir` are handed to the ModelSession of each
+    worker. `generation` is the number of models installed since the
+    launcher was started, workers load the current one first if it is not 0.
+    """
+    def __init__(self, launcher, frame_shape, workers=2, slots=8, categories_path=None, model_dir=None, generation=0):
+        self.launcher = launcher
+        self.frame_shape = tuple(frame_shape)
+        self.workers = workers
+        self.slots = slots
+        self.categories_path = categories_path
+        self.model_dir = model_dir
+        self.generation = generation
+        # A file in memory rather than a multiprocessing array, the launcher hands it to workers forked later
+        frame_size = slots * int(np.prod(self.frame_shape))
+        self.frame_file = tempfile.TemporaryFile(dir=SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None)
+        self.frame_file.truncate(frame_size)
+        self.frame_memory = mmap.mmap(self.frame_file.fileno(), frame_size)
+        self.frames = np.frombuffer(self.frame_memory, dtype=np.uint8).reshape((slots,) + self.frame_shape)
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.next_task_id = 0
+        self.inference_workers = [None] * workers
+        self.collector = None
+        self.closed = False
+
+    def acquire(self):
+        """Returns a free slot and its frame, blocks until one is free."""
+        slot = self.free_slots.get()
+        return slot, self.frames[slot]
+
+    def release(self, slot):
+        """Give `slot` back once its frame is no longer needed."""
+        self.free_slots.put(slot)
+
+    def submit(self, slot, on_result):
+        """Classify the frame in `slot`. `on_result` is called as
+        `on_result(prediction, durations)`, with the (label, confidence) of
+        ModelSession.predict, or None if the prediction failed, and the
+        durations of its stages in seconds. It is called from the collector
+        thread, or right away if no worker could take the frame.
+        """
+        with self.condition:
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            self.pending[task_id] = on_result
+            workers = [worker for worker in self.inference_workers if worker is not None]
+            worker = min(workers, key=lambda worker: len(worker.in_flight)) if workers else None
+            if worker is not None:
+                try:
+                    worker.tasks.send((slot, task_id, self.generation))
+                    worker.in_flight.add(task_id)
+                except OSError:
+                    # The worker died, the collector replaces it
+                    worker = None
+        if worker is None:
+            logging.debug("No inference worker took frame {0}".format(task_id))
+            self.finish(task_id, None, {})
+
+    def reload_model(self):
+        """Have every worker load the newly installed model before its next frame."""
+        with self.condition:
+            self.generation += 1
+
+    def wait_idle(self):
+        """Wait until every submitted frame has its result."""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def finish(self, task_id, prediction, durations):
+        with self.condition:
+            on_result = self.pending.pop(task_id, None)
+        try:
+            if on_result is not None:
+                on_result(prediction, durations)
+        except Exception:
+            logging.exception("Handling the prediction failed")
+        finally:
+            with self.condition:
+                self.condition.notify_all()
+
+    def start_worker(self, index):
+        context = multiprocessing.get_context(START_METHOD)
+        task_reader, task_writer = context.Pipe(duplex=False)
+        result_reader, result_writer = context.Pipe(duplex=False)
+        snapshot_root = tempfile.mkdtemp(prefix=SNAPSHOT_PREFIX, dir=modelsession.SCRIPT_DIR)
+        with self.condition:
+            generation = self.generation
+        request = ((self.slots,) + self.frame_shape, self.categories_path, self.model_dir, snapshot_root, generation)
+        try:
+            pid = self.launcher.launch(request, [self.frame_file.fileno(), task_reader.fileno(), result_writer.fileno()])
+        except Exception:
+            task_writer.close()
+            result_reader.close()
+            shutil.rmtree(snapshot_root, ignore_errors=True)
+            raise
+        finally:
+            # The worker has its own copies of these ends
+            task_reader.close()
+            result_writer.close()
+        with self.condition:
+            self.inference_workers[index] = InferenceWorker(pid, task_writer, result_reader, snapshot_root)
+
+    def discard_worker(self, worker):
+        worker.tasks.close()
+        worker.results.close()
+        shutil.rmtree(worker.snapshot_root, ignore_errors=True)
+
+    def restart_worker(self, index):
+        try:
+            self.start_worker(index)
+        except Exception:
+            logging.exception("Could not start inference worker {0}, trying again".format(index))
+
+    def replace_worker(self, index):
+        # A worker that died, e.g. in the native model code, fails the frames it had
+        with self.condition:
+            worker = self.inference_workers[index]
+            self.inference_workers[index] = None
+            failed = list(worker.in_flight)
+        logging.error("Inference worker {0} (pid {1}) exited, restarting it".format(index, worker.pid))
+        self.discard_worker(worker)
+        for task_id in failed:
+            self.finish(task_id, None, {})
+        self.restart_worker(index)
+
+    def receive(self, index):
+        worker = self.inference_workers[index]
+        try:
+            task_id, prediction, durations = worker.results.recv()
+        except (EOFError, OSError):
+            # The results pipe only ends when the worker exits
+            if not self.closed:
+                self.replace_worker(index)
+            return
+        with self.condition:
+            worker.in_flight.discard(task_id)
+        self.finish(task_id, prediction, durations)
+
+    def collect(self):
+        """Collector loop, hands the results of the workers over."""
+        while not self.closed:
+            connections = dict((worker.results, index) for index, worker in enumerate(self.inference_workers)
+                               if worker is not None)
+            for connection in multiprocessing.connection.wait(list(connections), timeout=WATCH_INTERVAL):
+                self.receive(connections[connection])
+            for index, worker in enumerate(self.inference_workers):
+                if worker is None and not self.closed:
+                    self.restart_worker(index)
+
+    def start(self):
+        """Start the worker processes and the collector thread."""
+        for index in range(self.workers):
+            self.start_worker(index)
+        self.collector = threading.Thread(target=self.collect, name="inferencecollector", daemon=True)
+        self.collector.start()
+
+    def close(self):
+        """Stop the workers once they are done with the submitted frames."""
+        self.wait_idle()
+        self.closed = True
+        self.collector.join()
+        workers = [worker for worker in self.inference_workers if worker is not None]
+        for worker in workers:
+            try:
+                worker.tasks.send(STOP_SIGNAL)
+            except OSError:
+                pass
+        for worker in workers:
+            # The results pipe ends once the worker exited
+            try:
+                while worker.results.poll(STOP_TIMEOUT):
+                    worker.results.recv()
+            except (EOFError, OSError):
+                pass
+            self.discard_worker(worker)
+        self.inference_workers = [None] * self.workers
+        self.frame_file.close()
@@ -0,0 +1,151 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     modelpackage.py
+#  Description: The content-addressed model package shared by Host.py and
+#   pisetup.py. Host.py publishes every file of the pi3 folder once under
+#   its SHA-256 and a small manifest listing the files of the current model.
+#   pisetup.py compares that manifest with the installed one and only
+#   downloads the files that changed. Host.py can also publish the compiled
+#   Python wrapper per toolchain, so devices skip cmake and make.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import hashlib
+import json
+import os
+import sysconfig
+
+MANIFEST_VERSION = 1
+OBJECTS_DIR = "objects"
+# Written into an installed model folder, it is not part of the package
+INSTALLED_MANIFEST = ".manifest.json"
+# Generated on the device, never published
+EXCLUDED_DIRS = ("build",)
+CHUNK_SIZE = 1024 * 1024
+# Toolchain of the Raspbian Stretch Python 3.5 on each deployment target
+TARGET_TOOLCHAINS = {
+    "pi3": "cpython-35m-arm-linux-gnueabihf",
+    "pi3_64": "cpython-35m-aarch64-linux-gnu",
+    "aarch64": "cpython-35m-aarch64-linux-gnu",
+}
+
+
+def manifest_blob_name(model_dir):
+    return "{0}.manifest.json".format(model_dir)
+
+
+def object_blob_name(digest):
+    return "{0}/{1}".format(OBJECTS_DIR, digest)
+
+
+def hash_file(path):
+    """Returns the SHA-256 hex digest of the file at `path`."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as data_file:
+        for chunk in iter(lambda: data_file.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def list_files(model_dir_path):
+    """Returns the paths of the package files in `model_dir_path`, relative
+    and with forward slashes, in a stable order.
+    """
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(model_dir_path):
+        if dir_path == model_dir_path:
+            dir_names[:] = [d for d in dir_names if d not in EXCLUDED_DIRS]
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if dir_path == model_dir_path and file_name == INSTALLED_MANIFEST:
+                continue
+            path = os.path.join(dir_path, file_name)
+            paths.append(os.path.relpath(path, model_dir_path).replace(os.sep, "/"))
+    return paths
+
+
+def is_wrapper_file(name):
+    """True for the files of the built Python wrapper, the only ones
+    Edge.py needs from the build folder.
+    """
+    return name == "model.py" or name.startswith("_model")
+
+
+def toolchain_key():
+    """Names the interpreter ABI and platform of this machine, e.g.
+    cpython-35m-arm-linux-gnueabihf. A wrapper only loads where it matches.
+    """
+    suffix = sysconfig.get_config_var("EXT_SUFFIX") or ".so"
+    key = suffix.strip(".").rsplit(".", 1)[0]
+    return key if key != "so" else "cpython-{0}".format(sysconfig.get_config_var("py_version_nodot"))
+
+
+def file_entry(path):
+    return {"sha256": hash_file(path), "size": os.path.getsize(path)}
+
+
+def build_manifest(model_dir_path, categories_path):
+    """Describe the model folder and its categories.txt by content. Prebuilt
+    wrappers are added under "artifacts", keyed by toolchain.
+    """
+    files = {}
+    for relative_path in list_files(model_dir_path):
+        files[relative_path] = file_entry(os.path.join(model_dir_path, relative_path))
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "files": files,
+        "categories": file_entry(categories_path),
+    }
+    manifest["package"] = package_hash(manifest)
+    return manifest
+
+
+def package_hash(manifest):
+    """A single hash over the contents of the package, used to name the
+    installed folder. Identical packages always get the same name.
+    """
+    content = {"files": manifest["files"], "categories": manifest["categories"]}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def source_hash(manifest):
+    """A hash over the model sources alone. Builds depend on it and not on
+    categories.txt, so a change of categories never needs a rebuild.
+    """
+    return hashlib.sha256(json.dumps(manifest["files"], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def dumps(manifest):
+    return json.dumps(manifest, sort_keys=True, indent=1)
+
+
+def loads(data):
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    manifest = json.loads(data)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("Unsupported model manifest version {0}".format(manifest.get("version")))
+    if manifest.get("package") != package_hash(manifest):
+        raise ValueError("The model manifest does not match its package hash")
+    return manifest
+
+
+def load_installed(model_dir_path):
+    """Returns the manifest of the model installed in `model_dir_path`, or
+    None for a folder that was not installed from a manifest.
+    """
+    path = os.path.join(model_dir_path, INSTALLED_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as manifest_file:
+            return loads(manifest_file.read())
+    except ValueError:
+        return None
+
+
+def save_installed(model_dir_path, manifest):
+    with open(os.path.join(model_dir_path, INSTALLED_MANIFEST), "w") as manifest_file:
+        manifest_file.write(dumps(manifest))
@@ -0,0 +1,200 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     modelsession.py
+#  Description: Keeps the ELL model, its categories and its input shape loaded
+#   for the lifetime of Edge.py. A rebuilt model is imported in-process and
+#   swapped in between two frames, so model updates need no restart.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import importlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import numpy as np
+import ellmanager as emanager
+import modelpackage
+
+SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
+MODEL_MODULES = ("model", "_model")
+BATCH_SIZE = 16
+BATCH_WORKERS = os.cpu_count() or 1
+
+
+class ModelState():
+    """Everything a single prediction needs. A session swaps the whole state
+    as one reference, so a frame never sees a half-updated model.
+    """
+    def __init__(self, module, categories, input_shape, source_dir=None):
+        self.module = module
+        self.categories = categories
+        self.input_shape = input_shape
+        self.source_dir = source_dir
+        # Owns the preallocated model input, filled in place for every frame
+        self.preprocessor = emanager.ImagePreprocessor(
+            input_shape.columns, input_shape.rows,
+            channels=input_shape.channels)
+
+
+class ModelSession():
+    """Loads the ELL model once and serves predictions from it.
+
+    `categories_path` is the categories.txt used to label predictions.
+
+    `model_dir` is the directory the wrapped model is built in. `reload`
+    imports the wrapper from its `build` folder.
+
+    `metrics` is an optional edgemetrics.MetricsRegistry that `predict`
+    records its preprocess and predict times in.
+
+    `snapshot_root` is the directory the wrappers are copied to before they
+    are imported, SCRIPT_DIR by default.
+    """
+    def __init__(self, categories_path=None, model_dir=None, metrics=None, snapshot_root=None):
+        self.metrics = metrics
+        self.snapshot_root = snapshot_root or SCRIPT_DIR
+        self.categories_path = categories_path or os.path.join(SCRIPT_DIR, "categories.txt")
+        self.model_dir = model_dir or os.path.join(SCRIPT_DIR, "pi3")
+        self.reload_lock = threading.Lock()
+        self.snapshot_dir = None
+        # The first model comes from the regular import path set up by ellmanager
+        self.state = self.load_state(importlib.import_module("model"))
+
+    def load_categories(self):
+        with open(self.categories_path, "r") as cat_file:
+            return cat_file.read().splitlines()
+
+    def load_state(self, module, source_dir=None):
+        return ModelState(module, self.load_categories(),
+                          module.get_default_input_shape(), source_dir)
+
+    def import_model(self, build_dir):
+        """Import the wrapper in `build_dir` as a fresh module. The previous
+        modules stay registered if the import fails.
+        """
+        previous = {name: sys.modules.pop(name) for name in MODEL_MODULES if name in sys.modules}
+        sys.path.insert(0, build_dir)
+        importlib.invalidate_caches()
+        try:
+            return importlib.import_module("model")
+        except Exception:
+            sys.modules.update(previous)
+            raise
+        finally:
+            sys.path.remove(build_dir)
+
+    def snapshot_build(self, build_dir):
+        """Copy the wrapper out of `build_dir`. The interpreter and the dynamic
+        loader cache extensions by path, so a wrapper rebuilt in place is
+        only picked up from a path that was never loaded before.
+        """
+        snapshot_dir = tempfile.mkdtemp(prefix=".model-", dir=self.snapshot_root)
+        for name in os.listdir(build_dir):
+            if modelpackage.is_wrapper_file(name):
+                shutil.copy2(os.path.join(build_dir, name), snapshot_dir)
+        return snapshot_dir
+
+    def reload(self, model_dir=None):
+        """Import the model built in `model_dir` and swap it in atomically.
+        Returns False and keeps serving the current model if the new one
+        cannot be loaded.
+        """
+        with self.reload_lock:
+            model_dir = os.path.realpath(model_dir or self.model_dir)
+            build_dir = os.path.join(model_dir, "build")
+            previous_snapshot = self.snapshot_dir
+            snapshot_dir = None
+            try:
+                if build_dir == self.state.source_dir or self.state.source_dir is None:
+                    snapshot_dir = self.snapshot_build(build_dir)
+                    state = self.load_state(self.import_model(snapshot_dir), build_dir)
+                else:
+                    state = self.load_state(self.import_model(build_dir), build_dir)
+            except Exception:
+                logging.exception("Could not load the model in {0}, keeping the current one".format(build_dir))
+                if snapshot_dir is not None:
+                    shutil.rmtree(snapshot_dir, ignore_errors=True)
+                return False
+
+            # A single reference assignment, frames in flight finish on the old state
+            self.state = state
+            self.snapshot_dir = snapshot_dir
+            if previous_snapshot is not None:
+                # The old extension stays mapped, only its files go away
+                shutil.rmtree(previous_snapshot, ignore_errors=True)
+            logging.debug("Model Reloaded from {0}".format(build_dir))
+            return True
+
+    def label(self, state, top):
+        if len(top) < 1:
+            return None, None
+        # Something was recognized, give the name based on the categories file and give the value
+        return state.categories[top[0][0]], top[0][1]
+
+    def predict(self, image, top_n=2):
+        """Run the model on a BGR `image`. Returns the best label and its
+        confidence, or (None, None) when nothing passed the threshold.
+        """
+        state = self.state
+        if self.metrics is None:
+            # Get the given image ready for use with the model, no copies on the way
+            input_data = state.preprocessor.prepare(image)
+            # Make the Model Prediction
+            prediction = state.module.predict(input_data)
+        else:
+            with self.metrics.time("preprocess"):
+                input_data = state.preprocessor.prepare(image)
+            with self.metrics.time("predict"):
+                prediction = state.module.predict(input_data)
+        # Return the max top predictions if they exist
+        return self.label(state, emanager.get_top_n(prediction, top_n))
+
+    def predict_batch(self, images, top_n=2, workers=BATCH_WORKERS):
+        """Run the model on a batch of BGR `images`. Returns the
+        `(N, rows * columns * channels)` float32 model input and a list with
+        the best label and confidence of every image, in order.
+        """
+        state = self.state
+        input_shape = state.input_shape
+        # Preprocessing is spread over the cores, the ELL model runs one row at a time
+        batch = emanager.prepare_images_for_model(
+            images, input_shape.columns, input_shape.rows, workers=workers)
+        predictions = np.array([state.module.predict(input_data) for input_data in batch])
+        # Top predictions of the whole batch in one go
+        results = [self.label(state, top) for top in emanager.get_top_n_batch(predictions, top_n)]
+        return batch, results
+
+
+def main():
+    """Classify archived images in batches, e.g. to backfill labels:
+    python3 modelsession.py image1.jpg image2.jpg ...
+    """
+    import cv2
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    session = ModelSession()
+    paths = sys.argv[1:]
+    for start in range(0, len(paths), BATCH_SIZE):
+        batch_paths = []
+        images = []
+        for path in paths[start:start + BATCH_SIZE]:
+            image = cv2.imread(path)
+            if image is None:
+                logging.warning("Could not read {0}, skipping it".format(path))
+                continue
+            batch_paths.append(path)
+            images.append(image)
+        if not images:
+            continue
+        _, results = session.predict_batch(images)
+        for path, (word, predict_value) in zip(batch_paths, results):
+            print("{0}\t{1}\t{2}".format(path, word, predict_value))
+
+
+if __name__ == '__main__':
+    main()
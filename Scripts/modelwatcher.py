@@ -0,0 +1,148 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     modelwatcher.py
+#  Description: Watches the model package on Azure Blob Storage from a
+#   background thread. Every check is a single conditional properties request
+#   on the package blob, and Edge.py is only signalled when a new model is
+#   actually available. Checks run on an interval or on demand, for example
+#   from an IoT Hub direct method.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import json
+import logging
+import os
+import threading
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+
+HTTP_NOT_MODIFIED = 304
+
+
+class ModelUpdateWatcher():
+    """Polls the model package blob and raises `update_available` when it
+    changed since the last applied update.
+
+    `block_blob_service` is the BlockBlobService used for the checks.
+
+    `container` is the blob container of the model package, `edgemodels`
+    by default.
+
+    `blob_names` are the blobs that announce a new package, in order of
+    preference. The first one that exists is watched, so devices follow the
+    manifest once Host.py publishes one and the zipped folder before that.
+
+    `history_path` is updatehistory.json. It records the blob, its ETag and
+    its last modified time for the package that is installed.
+
+    `interval` is the number of seconds between two checks.
+    """
+    def __init__(self, block_blob_service, history_path, container='edgemodels',
+                 blob_names=('zippedpi3',), interval=300.0):
+        self.block_blob_service = block_blob_service
+        self.history_path = history_path
+        self.container = container
+        self.blob_names = tuple(blob_names)
+        self.interval = interval
+        self.update_available = threading.Event()
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.history = self.load_history()
+        self.pending = None
+        self.thread = None
+
+    def load_history(self):
+        if not os.path.exists(self.history_path) or os.stat(self.history_path).st_size == 0:
+            return {}
+        try:
+            with open(self.history_path, "r") as history_file:
+                return json.load(history_file)
+        except ValueError:
+            logging.warning("Unreadable {0}, the model will be updated".format(self.history_path))
+            return {}
+
+    def save_history(self, history):
+        # Write a temporary file and rename it, a crash never leaves half a file
+        temp_path = "{0}.tmp".format(self.history_path)
+        with open(temp_path, "w") as history_file:
+            json.dump(history, history_file)
+        os.replace(temp_path, self.history_path)
+
+    def check(self):
+        """Check the package once. Returns True if a new model is available."""
+        with self.lock:
+            # Histories written before several blobs were watched are about the zipped folder
+            installed_blob = self.history.get("blob", "zippedpi3")
+            for blob_name in self.blob_names:
+                etag = self.history.get("etag") if blob_name == installed_blob else None
+                try:
+                    # The service answers 304 without a body while the ETag still matches
+                    blob = self.block_blob_service.get_blob_properties(
+                        self.container, blob_name, if_none_match=etag)
+                except AzureMissingResourceHttpError:
+                    continue
+                except AzureHttpError as error:
+                    if error.status_code == HTTP_NOT_MODIFIED:
+                        return False
+                    raise
+                break
+            else:
+                logging.debug("No model was found on Azure. Re-run Host.py and make sure your Azure Blob Storage Account is up to date")
+                return False
+
+            last_modified = str(blob.properties.last_modified)
+            if etag is None and blob_name == installed_blob and self.history.get("lastupdate") == last_modified:
+                # A history written before ETags were recorded, adopt the ETag
+                self.history["blob"] = blob_name
+                self.history["etag"] = blob.properties.etag
+                self.save_history(self.history)
+                return False
+
+            self.pending = {"blob": blob_name, "etag": blob.properties.etag, "lastupdate": last_modified}
+        logging.debug("A new model is available on Azure")
+        self.update_available.set()
+        return True
+
+    def applied(self):
+        """Called once the pending model is installed and loaded."""
+        with self.lock:
+            self.update_available.clear()
+            if self.pending is None:
+                return
+            self.history.update(self.pending)
+            self.save_history(self.history)
+            self.pending = None
+
+    def failed(self):
+        """Called when installing the pending model failed. The next check
+        finds the same package again and retries.
+        """
+        with self.lock:
+            self.update_available.clear()
+            self.pending = None
+
+    def check_now(self):
+        """Run a check right away instead of waiting for the interval."""
+        self.wake.set()
+
+    def set_interval(self, interval):
+        self.interval = interval
+        self.wake.set()
+
+    def watch(self):
+        """Worker loop, checks the package until the process ends."""
+        while True:
+            if not self.update_available.is_set():
+                try:
+                    self.check()
+                except Exception:
+                    logging.exception("Checking for a model update failed")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def start(self):
+        """Start the background watcher."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.watch, name="modelwatcher", daemon=True)
+            self.thread.start()
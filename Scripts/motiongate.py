@@ -0,0 +1,82 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     motiongate.py
+#  Description: Decides whether a captured frame is worth running the model
+#   on. Each frame is compared against a running background of the scene on
+#   a small grayscale copy, so a camera watching an empty room neither
+#   classifies nor uploads the same picture over and over. A heartbeat still
+#   lets a frame through every so often.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import time
+import cv2
+import numpy as np
+
+GATE_WIDTH = 160
+BLUR_SIZE = (5, 5)
+
+
+class MotionGate():
+    """Running background model of the scene.
+
+    `sensitivity` is the fraction of the pixels that must differ from the
+    background for a frame to count as changed. 0 lets every frame through.
+
+    `pixel_threshold` is the difference in gray levels from which a pixel
+    counts as changed, it keeps sensor noise out.
+
+    `heartbeat` is the number of seconds after which a frame is let through
+    even if nothing changed.
+
+    `learning_rate` is how fast the background takes up lasting changes,
+    e.g. a light that was switched on.
+    """
+    def __init__(self, sensitivity=0.01, pixel_threshold=25, heartbeat=60.0, learning_rate=0.05):
+        self.sensitivity = sensitivity
+        self.pixel_threshold = pixel_threshold
+        self.heartbeat = heartbeat
+        self.learning_rate = learning_rate
+        self.background = None
+        self.last_passed = None
+
+    def prepare(self, image):
+        # The gate only needs the rough layout of the scene, a small gray copy is plenty
+        height = max(1, image.shape[0] * GATE_WIDTH // image.shape[1])
+        small = cv2.resize(image, (GATE_WIDTH, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        return cv2.GaussianBlur(gray, BLUR_SIZE, 0)
+
+    def changed_fraction(self, image):
+        """Returns the fraction of the pixels of the BGR `image` that differ
+        from the background and adds the frame to the background.
+        """
+        gray = self.prepare(image)
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray.astype(np.float32)
+            return 1.0
+        difference = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+        return np.count_nonzero(difference > self.pixel_threshold) / float(difference.size)
+
+    def passes(self, image, now=None):
+        """True if `image` should be classified: the scene changed or the
+        heartbeat is due.
+        """
+        now = time.monotonic() if now is None else now
+        if self.sensitivity <= 0:
+            self.last_passed = now
+            return True
+        fraction = self.changed_fraction(image)
+        heartbeat_due = self.last_passed is None or now - self.last_passed >= self.heartbeat
+        if fraction >= self.sensitivity or heartbeat_due:
+            self.last_passed = now
+            return True
+        return False
+
+    def reset(self):
+        """Forget the background, the next frame passes."""
+        self.background = None
+        self.last_passed = None
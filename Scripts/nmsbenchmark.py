@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     nmsbenchmark.py
+#  Description: Times ellmanager.non_max_suppression against the previous
+#   loop based implementation on synthetic scenes of 10 to 5,000 boxes.
+#   Run it on the target device: python3 nmsbenchmark.py
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import sys
+import time
+import numpy as np
+import ellmanager as emanager
+
+SCENE_SIZES = [10, 50, 100, 500, 1000, 2000, 5000]
+NUM_CATEGORIES = 20
+OVERLAP_THRESHOLD = 0.5
+# Give up on timing a slow implementation once a single run takes this long
+MAX_SECONDS_PER_RUN = 30.0
+
+
+def legacy_non_max_suppression(regions, overlap_threshold, categories):
+    """The loop based implementation ellmanager used before, kept as the
+    baseline. It measures overlap against the area of the suppressed box and
+    skips categories with a single region.
+    """
+    if not regions:
+        return []
+
+    final_regions = []
+    for c in categories:
+        filtered_regions = [
+            region for region in regions if region.category == c]
+        if len(filtered_regions) < 2:
+            continue
+
+        boxes = np.array([region.location for region in filtered_regions])
+        w_half = (boxes[:, 2] / 2)
+        h_half = (boxes[:, 3] / 2)
+        x1 = boxes[:, 0] - w_half
+        y1 = boxes[:, 1] - h_half
+        x2 = boxes[:, 0] + w_half
+        y2 = boxes[:, 1] + h_half
+
+        areas = (boxes[:, 2] + 1) * (boxes[:, 3] + 1)
+
+        sorted_indices = np.argsort([r.probability for r in filtered_regions])
+        pick = []
+        while len(sorted_indices):
+            last = len(sorted_indices) - 1
+            i = sorted_indices[last]
+            pick.append(i)
+            suppress = [last]
+            for pos in range(last):
+                j = sorted_indices[pos]
+
+                xx1 = max(x1[i], x1[j])
+                yy1 = max(y1[i], y1[j])
+                xx2 = min(x2[i], x2[j])
+                yy2 = min(y2[i], y2[j])
+
+                overlap_width = xx2 - xx1 + 1
+                overlap_height = yy2 - yy1 + 1
+
+                if overlap_width > 0 and overlap_height > 0:
+                    overlap = overlap_width * overlap_height / areas[j]
+                    if overlap > overlap_threshold:
+                        suppress.append(pos)
+
+            sorted_indices = np.delete(sorted_indices, suppress)
+
+        final_regions += [filtered_regions[i] for i in pick]
+
+    return final_regions
+
+
+def make_scene(num_boxes, random_state):
+    """Returns `num_boxes` regions clustered around a few objects the way a
+    detector reports them: several jittered boxes per object.
+    """
+    categories = ["category{0}".format(i) for i in range(NUM_CATEGORIES)]
+    num_objects = max(1, num_boxes // 10)
+    centers = random_state.uniform(0.1, 0.9, (num_objects, 2))
+    sizes = random_state.uniform(0.05, 0.3, (num_objects, 2))
+    object_categories = random_state.randint(0, NUM_CATEGORIES, num_objects)
+
+    owner = random_state.randint(0, num_objects, num_boxes)
+    jitter = random_state.normal(0, 0.02, (num_boxes, 4))
+    locations = np.hstack((centers[owner], sizes[owner])) + jitter
+    locations[:, 2:] = np.abs(locations[:, 2:]) + 0.01
+    probabilities = random_state.uniform(0.3, 1.0, num_boxes)
+    regions = [emanager.Region(categories[object_categories[o]], p, l)
+               for o, p, l in zip(owner, probabilities, locations)]
+    return regions, categories
+
+
+def time_call(function, repeats):
+    """Returns the best time of `repeats` calls, or None once a single call
+    is slower than MAX_SECONDS_PER_RUN, and the result of the last call.
+    """
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if elapsed > MAX_SECONDS_PER_RUN:
+            return None, result
+    return best, result
+
+
+def format_result(seconds, kept):
+    """Time and number of kept boxes. Implementations that keep fewer boxes
+    do less work, so the two only compare together.
+    """
+    if seconds is None:
+        return "{0:>18}".format("skipped")
+    return "{0:>10.3f}ms {1:>5}".format(seconds * 1000, "({0})".format(kept))
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SCENE_SIZES
+    random_state = np.random.RandomState(0)
+    implementations = [
+        ("legacy", lambda r, c: legacy_non_max_suppression(r, OVERLAP_THRESHOLD, c)),
+        ("per-class", lambda r, c: emanager.non_max_suppression(r, OVERLAP_THRESHOLD, c, batched=False)),
+        ("batched", lambda r, c: emanager.non_max_suppression(r, OVERLAP_THRESHOLD, c, batched=True)),
+        ("default", lambda r, c: emanager.non_max_suppression(r, OVERLAP_THRESHOLD, c)),
+        ("soft", lambda r, c: emanager.non_max_suppression(r, OVERLAP_THRESHOLD, c, soft=True)),
+    ]
+
+    print("{0:>6} {1}".format("boxes", " ".join("{0:>18}".format(name) for name, _ in implementations)))
+    skip = set()
+    for size in sizes:
+        regions, categories = make_scene(size, random_state)
+        repeats = 3 if size >= 1000 else 10
+        results = []
+        for name, function in implementations:
+            if name in skip:
+                results.append(format_result(None, None))
+                continue
+            elapsed, kept = time_call(lambda: function(regions, categories), repeats)
+            if elapsed is None:
+                # Larger scenes would only be slower
+                skip.add(name)
+            results.append(format_result(elapsed, len(kept)))
+        print("{0:>6} {1}".format(size, " ".join(results)))
+
+
+if __name__ == '__main__':
+    main()
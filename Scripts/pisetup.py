@@ -6,9 +6,14 @@
 #  File:     pisetup.py
 #  Authors:  David (Seun) Odun-Ayo
 #  Emails:   dodunayo@nd.edu | dave_seun@yahoo.com
-#  Description: This script gets the latest version of the pi3 folder  and 
-#   categories.txt from azure blob storage and then makes it for use on the 
-#   project 
+#  Description: This script gets the latest version of the pi3 folder  and
+#   categories.txt from azure blob storage and then makes it for use on the
+#   project. Models published with a manifest are downloaded incrementally
+#   into their own pi3-<hash> folder and pi3 is switched to it atomically.
+#   A prebuilt wrapper or a cached build is used instead of cmake and make
+#   whenever one matches the sources and the toolchain of the device.
+#   Downloads are streamed to disk, zipped folders are extracted while they
+#   arrive, and checksums are verified on the fly
 #  Requires: Python 3.x
 #
 ###############################################################################
@@ -16,44 +21,359 @@
 import logging
 import os
 import shutil
+import struct
+import subprocess
 import sys
+import time
 import zipfile
+import zlib
+import blobstream
+import modelpackage
+from azure.common import AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService, ContentSettings, PublicAccess
 
 SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
+# Installed versions kept on the SD card, the one in use and one to roll back to
+KEEP_VERSIONS = 2
+# Builds kept in the build cache
+KEEP_BUILDS = 4
+# Zip records read by the streaming extractor
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_LOCAL_SIGNATURE = 0x04034b50
+ZIP_CENTRAL_SIGNATURES = (0x02014b50, 0x06054b50)
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
 
-def azure_download_from_path(model_container_name, model_dir_path, compressed_model_dir_path, compressed_model_name):
-    # Define categories variables and get categories.txt
+class UnsupportedStream(Exception):
+    # The zip needs random access, e.g. it was written with data descriptors
+    pass
+
+def read_exactly(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise ValueError("The archive ended unexpectedly")
+    return data
+
+def extract_zip_stream(reader, model_dir_path):
+    # Extract each entry from its local header while the archive is still downloading
+    os.makedirs(model_dir_path)
+    root_dir_path = os.path.realpath(model_dir_path)
+    while True:
+        signature = struct.unpack("<I", read_exactly(reader, 4))[0]
+        if signature in ZIP_CENTRAL_SIGNATURES:
+            # The central directory only repeats what the local headers said
+            reader.drain()
+            return
+        if signature != ZIP_LOCAL_SIGNATURE:
+            raise ValueError("Not a zip archive")
+        header = ZIP_LOCAL_HEADER.unpack(struct.pack("<I", signature) + read_exactly(reader, ZIP_LOCAL_HEADER.size - 4))
+        _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = header
+        if flags & ZIP_DATA_DESCRIPTOR_FLAG or 0xFFFFFFFF in (compressed_size, size) or method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise UnsupportedStream()
+        name = read_exactly(reader, name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        read_exactly(reader, extra_length)
+
+        # Never write outside the model folder
+        path = os.path.realpath(os.path.join(model_dir_path, name))
+        if not path.startswith(root_dir_path + os.sep) and path != root_dir_path:
+            raise ValueError("Unsafe path {0} in the archive".format(name))
+        if name.endswith("/"):
+            if not os.path.exists(path):
+                os.makedirs(path)
+            read_exactly(reader, compressed_size)
+            continue
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == ZIP_DEFLATED else None
+        checksum = 0
+        remaining = compressed_size
+        with open(path, "wb") as entry_file:
+            while remaining:
+                data = read_exactly(reader, min(remaining, blobstream.CHUNK_SIZE))
+                remaining -= len(data)
+                if decompressor is not None:
+                    data = decompressor.decompress(data)
+                checksum = zlib.crc32(data, checksum)
+                entry_file.write(data)
+            if decompressor is not None:
+                data = decompressor.flush()
+                checksum = zlib.crc32(data, checksum)
+                entry_file.write(data)
+        if checksum & 0xFFFFFFFF != crc:
+            raise ValueError("{0} is corrupt".format(name))
+
+def verify_checksum(reader):
+    # Host.py publishes the SHA-256 of the archive as blob metadata
+    expected = reader.metadata.get("sha256")
+    if expected is None:
+        logging.debug('{0} has no published checksum'.format(reader.blob_name))
+    elif reader.hexdigest() != expected:
+        raise ValueError("{0} does not match its published checksum".format(reader.blob_name))
+
+def azure_download_from_path(model_container_name, model_dir_path, compressed_model_dir_path, compressed_model_name, categories_path):
+    # Get categories.txt, it is only swapped in once the new model is ready
     categories_dir = "categories.txt"
-    categories_path = "{0}/{1}".format(SCRIPT_DIR, categories_dir)
     block_blob_service.get_blob_to_path(model_container_name, categories_dir, categories_path)
-        
-    #Download Azure Version to the Raspberry pi
-    block_blob_service.get_blob_to_path(model_container_name, compressed_model_name, compressed_model_dir_path)
-    os.makedirs(model_dir_path)
-    zf = zipfile.ZipFile(compressed_model_dir_path)
-    zf.extractall(model_dir_path)
-    os.remove(compressed_model_dir_path)
 
+    #Download Azure Version to the Raspberry pi, extracting it as it arrives
+    try:
+        with blobstream.BlobReader(block_blob_service, model_container_name, compressed_model_name) as reader:
+            extract_zip_stream(reader, model_dir_path)
+            verify_checksum(reader)
+        return
+    except UnsupportedStream:
+        logging.debug('{0} cannot be streamed, downloading it first'.format(compressed_model_name))
+        shutil.rmtree(model_dir_path, ignore_errors=True)
+
+    with blobstream.BlobReader(block_blob_service, model_container_name, compressed_model_name) as reader:
+        with open(compressed_model_dir_path, "wb") as compressed_file:
+            for data in iter(lambda: reader.read(blobstream.CHUNK_SIZE), b""):
+                compressed_file.write(data)
+        verify_checksum(reader)
+    try:
+        os.makedirs(model_dir_path)
+        zf = zipfile.ZipFile(compressed_model_dir_path)
+        zf.extractall(model_dir_path)
+    finally:
+        os.remove(compressed_model_dir_path)
+
+def azure_download_manifest(model_container_name, model_dir):
+    # Models published before manifests existed only have the zipped folder
+    try:
+        blob = block_blob_service.get_blob_to_bytes(model_container_name, modelpackage.manifest_blob_name(model_dir))
+    except AzureMissingResourceHttpError:
+        return None
+    return modelpackage.loads(blob.content)
+
+def azure_download_object(model_container_name, entry, path):
+    # Stream a single file of the package to disk and make sure it is the one the manifest asks for
+    temp_path = "{0}.tmp".format(path)
+    object_name = modelpackage.object_blob_name(entry["sha256"])
+    with blobstream.BlobReader(block_blob_service, model_container_name, object_name, progress=entry["size"] >= blobstream.CHUNK_SIZE) as reader:
+        with open(temp_path, "wb") as object_file:
+            for data in iter(lambda: reader.read(blobstream.CHUNK_SIZE), b""):
+                object_file.write(data)
+    if reader.hexdigest() != entry["sha256"]:
+        os.remove(temp_path)
+        raise ValueError("Downloaded {0} does not match its hash".format(path))
+    os.replace(temp_path, path)
+
+def index_installed_files(installed_dir_path):
+    # Map the content hash of every file in the installed model to its path
+    index = {}
+    if installed_dir_path is None or not os.path.isdir(installed_dir_path):
+        return index
+    installed_manifest = modelpackage.load_installed(installed_dir_path)
+    if installed_manifest is not None:
+        for relative_path, entry in installed_manifest["files"].items():
+            path = os.path.join(installed_dir_path, relative_path)
+            if os.path.exists(path) and os.path.getsize(path) == entry["size"]:
+                index[entry["sha256"]] = path
+    else:
+        # A folder from before manifests, hash what is there
+        for relative_path in modelpackage.list_files(installed_dir_path):
+            path = os.path.join(installed_dir_path, relative_path)
+            index[modelpackage.hash_file(path)] = path
+    return index
+
+def link_or_copy(source_path, path):
+    # A hard link costs no SD card writes, fall back to a copy where links are not supported
+    try:
+        os.link(source_path, path)
+    except OSError:
+        shutil.copy2(source_path, path)
 
+def download_package_files(model_container_name, manifest, staging_dir_path, installed_dir_path):
+    # Put every file of the manifest into the staging folder, linking the ones an installed version already has
+    index = index_installed_files(installed_dir_path)
+    downloaded = 0
+    downloaded_bytes = 0
+    start_time = time.monotonic()
+    for relative_path, entry in sorted(manifest["files"].items()):
+        path = os.path.join(staging_dir_path, *relative_path.split("/"))
+        parent_dir_path = os.path.dirname(path)
+        if not os.path.exists(parent_dir_path):
+            os.makedirs(parent_dir_path)
+        if entry["sha256"] in index:
+            link_or_copy(index[entry["sha256"]], path)
+        else:
+            azure_download_object(model_container_name, entry, path)
+            downloaded += 1
+            downloaded_bytes += entry["size"]
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+    logging.debug('Downloaded {0} of {1} files ({2} bytes) at {3:.2f} MB/s'.format(
+        downloaded, len(manifest["files"]), downloaded_bytes, downloaded_bytes / elapsed / (1024.0 * 1024.0)))
+
+def azure_download_package(model_container_name, manifest, install_dir_path, installed_dir_path):
+    # Fill a staging folder with the files of the manifest, reusing the installed ones. Returns the folder the
+    # package was installed to, an existing one is never replaced as Edge.py may be using it
+    if os.path.exists(install_dir_path):
+        install_dir_path = "{0}-{1}".format(install_dir_path, time.strftime("%Y%m%d%H%M%S"))
+    staging_dir_path = "{0}.partial".format(install_dir_path)
+    if os.path.exists(staging_dir_path):
+        shutil.rmtree(staging_dir_path)
+    os.makedirs(staging_dir_path)
+    try:
+        download_package_files(model_container_name, manifest, staging_dir_path, installed_dir_path)
+        # The folder only gets its final name once it is complete
+        modelpackage.save_installed(staging_dir_path, manifest)
+        os.rename(staging_dir_path, install_dir_path)
+    except Exception:
+        shutil.rmtree(staging_dir_path, ignore_errors=True)
+        raise
+    return install_dir_path
+
+def azure_download_categories(model_container_name, manifest, categories_path, new_categories_path):
+    # Returns False if the installed categories.txt is already the published one
+    entry = manifest["categories"]
+    if os.path.exists(categories_path) and modelpackage.hash_file(categories_path) == entry["sha256"]:
+        return False
+    azure_download_object(model_container_name, entry, new_categories_path)
+    return True
+
+def build_model(model_dir_path):
+    # Create a build Folder
+    logging.debug('Creating Build Folder')
+    build_dir_path = "{0}/{1}".format(model_dir_path, "build")
+    if not os.path.exists(build_dir_path):
+        os.makedirs(build_dir_path)
+
+    # Change into the 'build' folder
+    current_dir = os.getcwd()
+    os.chdir(build_dir_path)
+
+    logging.debug('Running make on Pi3 Building Folder')
+    try:
+        # Call the OS to run the 'cmake' command and the essential 'make' command
+        return os.system('cmake .. -DCMAKE_BUILD_TYPE=Release') == 0 and os.system('make') == 0
+    finally:
+        # Change back into our current scripts Directory
+        os.chdir(current_dir)
+
+def copy_wrapper_files(source_dir_path, build_dir_path):
+    # Returns False if `source_dir_path` holds no wrapper
+    names = [name for name in os.listdir(source_dir_path) if modelpackage.is_wrapper_file(name)]
+    if not names:
+        return False
+    if not os.path.exists(build_dir_path):
+        os.makedirs(build_dir_path)
+    for name in names:
+        shutil.copy2(os.path.join(source_dir_path, name), build_dir_path)
+    return True
+
+def azure_download_wrapper(model_container_name, manifest, toolchain, build_dir_path):
+    # Download the wrapper Host.py built for this toolchain, returns False if there is none
+    artifacts = manifest.get("artifacts", {}).get(toolchain)
+    if not artifacts:
+        return False
+    if not os.path.exists(build_dir_path):
+        os.makedirs(build_dir_path)
+    for name, entry in sorted(artifacts.items()):
+        azure_download_object(model_container_name, entry, os.path.join(build_dir_path, name))
+    return True
+
+def wrapper_loads(build_dir_path):
+    # Import the wrapper in a separate interpreter, one built for another platform must never be switched to
+    command = [sys.executable, "-c", "import sys; sys.path.insert(0, sys.argv[1]); import model", build_dir_path]
+    return subprocess.call(command, cwd=build_dir_path) == 0
+
+def save_build(build_dir_path, cache_dir_path):
+    # Keep the built wrapper under the hash of its sources and the toolchain
+    staging_dir_path = "{0}.partial".format(cache_dir_path)
+    if os.path.exists(staging_dir_path):
+        shutil.rmtree(staging_dir_path)
+    if not copy_wrapper_files(build_dir_path, staging_dir_path):
+        return
+    if os.path.exists(cache_dir_path):
+        shutil.rmtree(cache_dir_path)
+    os.rename(staging_dir_path, cache_dir_path)
+
+def remove_old_builds(build_cache_dir_path, keep):
+    # Delete the least recently used builds beyond the newest `keep`
+    builds = [os.path.join(build_cache_dir_path, name) for name in os.listdir(build_cache_dir_path)]
+    for path in sorted(builds, key=os.path.getmtime, reverse=True)[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def install_wrapper(model_container_name, manifest, model_dir, install_dir_path, build_cache_dir_path):
+    # Get the Python wrapper into the build folder: from the build cache, as a prebuilt artifact, or by building it
+    toolchain = modelpackage.toolchain_key()
+    build_dir_path = "{0}/{1}".format(install_dir_path, "build")
+    cache_dir_path = "{0}/{1}-{2}-{3}".format(build_cache_dir_path, model_dir, modelpackage.source_hash(manifest)[:16], toolchain)
+    if not os.path.exists(build_cache_dir_path):
+        os.makedirs(build_cache_dir_path)
+
+    if os.path.isdir(cache_dir_path) and copy_wrapper_files(cache_dir_path, build_dir_path):
+        if wrapper_loads(build_dir_path):
+            logging.debug('Using the cached build for {0}'.format(toolchain))
+            # Mark it as recently used
+            os.utime(cache_dir_path)
+            return True
+        logging.debug('The cached build for {0} does not load, removing it'.format(toolchain))
+        shutil.rmtree(cache_dir_path, ignore_errors=True)
+        shutil.rmtree(build_dir_path, ignore_errors=True)
+
+    if azure_download_wrapper(model_container_name, manifest, toolchain, build_dir_path):
+        if wrapper_loads(build_dir_path):
+            logging.debug('Using the prebuilt wrapper for {0}'.format(toolchain))
+            save_build(build_dir_path, cache_dir_path)
+            remove_old_builds(build_cache_dir_path, KEEP_BUILDS)
+            return True
+        logging.debug('The prebuilt wrapper for {0} does not load, building it here'.format(toolchain))
+        shutil.rmtree(build_dir_path, ignore_errors=True)
+
+    if not build_model(install_dir_path):
+        return False
+    save_build(build_dir_path, cache_dir_path)
+    remove_old_builds(build_cache_dir_path, KEEP_BUILDS)
+    return True
+
+def switch_model_dir(model_dir_path, install_dir_path):
+    # Point the model folder at the new version with a single rename, Edge.py never sees a half installed model
+    link_path = "{0}.link".format(model_dir_path)
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(install_dir_path), link_path)
+    if os.path.isdir(model_dir_path) and not os.path.islink(model_dir_path):
+        # A folder from before versioned installs is moved aside once
+        legacy_dir_path = "{0}-legacy".format(model_dir_path)
+        if os.path.exists(legacy_dir_path):
+            shutil.rmtree(legacy_dir_path)
+        os.rename(model_dir_path, legacy_dir_path)
+    os.replace(link_path, model_dir_path)
+
+def remove_old_versions(model_dir_path, keep):
+    # Delete installed versions beyond the newest `keep`, the one in use always stays
+    prefix = "{0}-".format(os.path.basename(model_dir_path))
+    parent_dir_path = os.path.dirname(model_dir_path)
+    current_dir_path = os.path.realpath(model_dir_path)
+    versions = []
+    for name in os.listdir(parent_dir_path):
+        path = os.path.join(parent_dir_path, name)
+        if name.startswith(prefix) and os.path.isdir(path) and not os.path.islink(path) and path != current_dir_path:
+            versions.append((os.path.getmtime(path), path))
+    for _, path in sorted(versions, reverse=True)[keep - 1:]:
+        logging.debug('Removing old model {0}'.format(path))
+        shutil.rmtree(path, ignore_errors=True)
 
 def main():
     # Define Globals
     global block_blob_service
 
-    # Define Locals
+    # Define Locals, the deployment target can be given on the command line
     model_container_name = 'edgemodels'
-    current_dir = os.getcwd()
-    model_dir = "pi3"
-    build_dir = "build"
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "pi3"
     model_dir_path = "{0}/{1}".format(SCRIPT_DIR, model_dir)
-    build_dir_path = "{0}/{1}".format(model_dir_path, build_dir)
     compressed_model_name = "zipped{0}".format(model_dir)
     compressed_model_dir_path ="{0}/{1}.zip".format(SCRIPT_DIR, compressed_model_name)
+    categories_path = "{0}/{1}".format(SCRIPT_DIR, "categories.txt")
+    build_cache_dir_path = "{0}/{1}".format(SCRIPT_DIR, "buildcache")
+    new_categories_path = "{0}.new".format(categories_path)
 
     # Intialize Log Properties
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s') 
-   
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
     # Get Login Credentials
     azure_key_name = os.environ.get('AZURE_BLOBCONTAINER_NAME')
     azure_key = os.environ.get('AZURE_BLOBCONTAINER_KEY')
@@ -69,43 +389,74 @@ def main():
     if azure_key and azure_key_name is not None:
         logging.debug('Everything worked fine')
 
-        
+
     # Set up Azure Credentials
     block_blob_service = BlockBlobService(account_name = azure_key_name, account_key = azure_key)
     if block_blob_service is None:
         logging.debug("No Azure Storage Account Connected")
         sys.exit(1)
-    
-    # Delete the current version on the Raspberry Pi if there is one
-    if os.path.exists(model_dir_path):
-        shutil.rmtree(model_dir_path)
+
+    # The version currently in use, if any
+    installed_dir_path = os.path.realpath(model_dir_path) if os.path.exists(model_dir_path) else None
 
     # Download Pi3 from Azure
     logging.debug('Downloading from Azure Blob Storage')
-    azure_download_from_path(model_container_name, model_dir_path, compressed_model_dir_path, compressed_model_name)
-    
-    # Azure should catch this issue but still check one more time to make sure that the correct directory has been downloaded
-    if os.path.exists(model_dir_path):
-        os.chdir(model_dir_path)
+    manifest = azure_download_manifest(model_container_name, model_dir)
+    if manifest is not None:
+        install_dir_path = "{0}-{1}".format(model_dir_path, manifest["package"][:16])
+        installed_manifest = modelpackage.load_installed(installed_dir_path) if installed_dir_path is not None else None
+        if installed_manifest is not None and installed_manifest["package"] == manifest["package"]:
+            # The version in use, possibly reinstalled into a folder of its own
+            install_dir_path = installed_dir_path
+        else:
+            installed_manifest = modelpackage.load_installed(install_dir_path) if os.path.isdir(install_dir_path) else None
+        new_categories = azure_download_categories(model_container_name, manifest, categories_path, new_categories_path)
+        if installed_manifest is not None and installed_manifest["package"] == manifest["package"] \
+                and os.path.exists("{0}/{1}".format(install_dir_path, "build")) \
+                and wrapper_loads("{0}/{1}".format(install_dir_path, "build")):
+            # Already on the SD card, e.g. when rolling back to the previous model
+            logging.debug('Model {0} is already installed'.format(manifest["package"][:16]))
+            built = True
+        else:
+            install_dir_path = azure_download_package(model_container_name, manifest, install_dir_path, installed_dir_path)
+            built = False
+            try:
+                built = install_wrapper(model_container_name, manifest, model_dir, install_dir_path, build_cache_dir_path)
+            finally:
+                # The new folder is never switched to without a wrapper that loads
+                if not built:
+                    shutil.rmtree(install_dir_path, ignore_errors=True)
+    else:
+        # Models published before manifests are downloaded in full
+        install_dir_path = "{0}-zip-{1}".format(model_dir_path, time.strftime("%Y%m%d%H%M%S"))
+        staging_dir_path = "{0}.partial".format(install_dir_path)
+        if os.path.exists(staging_dir_path):
+            shutil.rmtree(staging_dir_path)
+        new_categories = True
+        built = False
+        try:
+            azure_download_from_path(model_container_name, staging_dir_path, compressed_model_dir_path, compressed_model_name, new_categories_path)
+            os.rename(staging_dir_path, install_dir_path)
+            built = build_model(install_dir_path)
+        finally:
+            # Neither a partial download nor a model that did not build is kept
+            if not built:
+                shutil.rmtree(staging_dir_path, ignore_errors=True)
+                shutil.rmtree(install_dir_path, ignore_errors=True)
 
-    # Create a build Folder
-    logging.debug('Creating Build Folder')
-    while not os.path.exists(build_dir_path):
-        os.makedirs(build_dir_path)
-   
-    # Change into the 'build' folder
-    os.chdir(build_dir_path)
-    
-    logging.debug('Running make on Pi3 Building Folder')
-    
-    # Call the OS to run the 'cmake' command
-    os.system('cmake .. -DCMAKE_BUILD_TYPE=Release')
+    # Built before switching, the current model stays in use if the build fails
+    if not built:
+        logging.debug('Building {0} Failed, keeping the current model'.format(install_dir_path))
+        if os.path.exists(new_categories_path):
+            os.remove(new_categories_path)
+        sys.exit(1)
 
-    # Call the OS to run the essential 'make' command
-    os.system('make')
+    if installed_dir_path != os.path.realpath(install_dir_path):
+        switch_model_dir(model_dir_path, install_dir_path)
+    if new_categories:
+        os.replace(new_categories_path, categories_path)
 
-    # Change back into our current scripts Directory
-    os.chdir(current_dir)
+    remove_old_versions(model_dir_path, KEEP_VERSIONS)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,51 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     azurestub.py
+#  Description: Lets the tests import the scripts that use the Azure Storage
+#   SDK on machines without it. The tests hand those scripts fake services,
+#   the stand-ins only provide the names that are imported.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import sys
+import types
+
+
+class AzureMissingResourceHttpError(Exception):
+    pass
+
+
+class BlobBlock():
+    def __init__(self, id=None, state=None):
+        self.id = id
+        self.state = state
+
+
+class ContentSettings():
+    def __init__(self, content_type=None, **kwargs):
+        self.content_type = content_type
+
+
+def install():
+    """Registers the stand-ins unless the SDK is installed."""
+    try:
+        import azure.common
+        import azure.storage.blob
+        return
+    except ImportError:
+        pass
+    common = types.ModuleType("azure.common")
+    common.AzureMissingResourceHttpError = AzureMissingResourceHttpError
+    blob = types.ModuleType("azure.storage.blob")
+    blob.BlobBlock = BlobBlock
+    blob.BlockBlobService = object
+    blob.ContentSettings = ContentSettings
+    blob.PublicAccess = types.SimpleNamespace(Container="container", Blob="blob")
+    sys.modules.update({
+        "azure": types.ModuleType("azure"),
+        "azure.common": common,
+        "azure.storage": types.ModuleType("azure.storage"),
+        "azure.storage.blob": blob,
+    })
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_blobstream.py
+#  Description: Checks the block bookkeeping of BlockBlobWriter: blocks stay
+#   in memory while the network keeps up, spill to disk when it falls
+#   behind, and a failed commit leaves a staged blocks file commit_staged
+#   finishes the blob from.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from tests import azurestub
+
+azurestub.install()
+import blobstream
+
+
+class BlockStorage():
+    """Staged blocks and committed blobs in memory. Every request fails
+    while `failing` is set, put_block_list also while `failing_commit` is,
+    and put_block waits while `open` is cleared.
+    """
+    def __init__(self):
+        self.staged = {}
+        self.blobs = {}
+        self.put_blocks = 0
+        self.failing = False
+        self.failing_commit = False
+        self.fail_after = None
+        self.open = threading.Event()
+        self.open.set()
+
+    def put_block(self, container, blob_name, block, block_id, **kwargs):
+        self.open.wait()
+        if self.failing or (self.fail_after is not None and self.put_blocks >= self.fail_after):
+            raise IOError("network is down")
+        self.put_blocks += 1
+        self.staged[(container, blob_name, block_id)] = bytes(block)
+
+    def put_block_list(self, container, blob_name, block_list, content_settings=None, **kwargs):
+        if self.failing or self.failing_commit:
+            raise IOError("network is down")
+        self.blobs[(container, blob_name)] = (b"".join(self.staged[(container, blob_name, block.id)]
+                                                       for block in block_list), content_settings.content_type)
+
+
+class BlockBlobWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.staged_path = os.path.join(self.temp_dir, "video.h264.staged")
+        self.storage = BlockStorage()
+        # No back-off between the attempts of a failing block
+        patcher = mock.patch("blobstream.time.sleep")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def writer(self, pending=2):
+        return blobstream.BlockBlobWriter(self.storage, "edgevideos", "video.h264", "video/h264", self.temp_dir,
+                                          block_size=4, pending=pending)
+
+    def write_event(self, writer):
+        # Like get_video: the live recording starts before the pre-roll is copied
+        before = writer.open_segment()
+        after = writer.open_segment()
+        after.write(b"after-data")
+        before.write(b"before-data")
+        before.close()
+        after.write(b"-more")
+        return b"before-data" + b"after-data-more"
+
+    def committed(self):
+        return self.storage.blobs.get(("edgevideos", "video.h264"))
+
+    def test_segments_are_joined_in_order(self):
+        writer = self.writer()
+        expected = self.write_event(writer)
+        self.assertTrue(writer.commit(self.staged_path))
+        self.assertEqual((expected, "video/h264"), self.committed())
+        self.assertEqual(sorted(writer.block_ids()), writer.block_ids())
+        self.assertEqual(len(expected), writer.staged_bytes)
+        self.assertEqual(0, writer.blocks_in_memory)
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_only_blocks_beyond_pending_are_spilled(self):
+        self.storage.open.clear()
+        writer = self.writer(pending=2)
+        segment = writer.open_segment()
+        segment.write(b"0123456789abcdefghij")
+        # Five blocks while nothing gets staged, two of them stay in memory
+        self.assertEqual(2, writer.blocks_in_memory)
+        self.assertEqual(3, len(writer.spilled))
+        self.assertEqual([4, 4, 4], [size for _, size in writer.spilled.values()])
+        self.assertTrue(os.path.exists(writer.spill_path))
+
+        self.storage.open.set()
+        self.assertTrue(writer.commit(self.staged_path))
+        self.assertEqual((b"0123456789abcdefghij", "video/h264"), self.committed())
+        self.assertEqual({}, writer.spilled)
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_network_down_from_the_start(self):
+        self.storage.failing = True
+        writer = self.writer()
+        expected = self.write_event(writer)
+        self.assertFalse(writer.commit(self.staged_path))
+        self.assertIsNone(self.committed())
+        self.assertEqual(["video.h264.staged"], os.listdir(self.temp_dir))
+
+        self.storage.failing = False
+        blobstream.commit_staged(self.storage, "edgevideos", "video.h264", self.staged_path)
+        self.assertEqual((expected, "video/h264"), self.committed())
+
+    def test_network_lost_midway(self):
+        self.storage.fail_after = 3
+        writer = self.writer()
+        expected = self.write_event(writer)
+        self.assertFalse(writer.commit(self.staged_path))
+
+        # The staged blocks file only holds the data of the blocks that are not staged yet
+        with open(self.staged_path, "rb") as staged_file:
+            header = json.loads(staged_file.readline().decode("utf-8"))
+            data = staged_file.read()
+        self.assertEqual(writer.block_ids(), [block[0] for block in header["blocks"]])
+        unstaged = [block for block in header["blocks"] if block[1] is not None]
+        self.assertEqual(len(writer.block_ids()) - 3, len(unstaged))
+        self.assertEqual(sum(block[2] for block in unstaged), len(data))
+
+        self.storage.fail_after = None
+        blobstream.commit_staged(self.storage, "edgevideos", "video.h264", self.staged_path)
+        self.assertEqual(len(writer.block_ids()), self.storage.put_blocks)
+        self.assertEqual((expected, "video/h264"), self.committed())
+
+    def test_failed_block_list_keeps_the_staged_blocks(self):
+        writer = self.writer()
+        expected = self.write_event(writer)
+        self.storage.failing_commit = True
+        self.assertFalse(writer.commit(self.staged_path))
+        with open(self.staged_path, "rb") as staged_file:
+            header = json.loads(staged_file.readline().decode("utf-8"))
+        # Every block is staged already, only the commit is missing
+        self.assertTrue(all(block[1] is None for block in header["blocks"]))
+
+        self.storage.failing_commit = False
+        blobstream.commit_staged(self.storage, "edgevideos", "video.h264", self.staged_path)
+        self.assertEqual((expected, "video/h264"), self.committed())
+
+    def test_unknown_staged_version(self):
+        with open(self.staged_path, "wb") as staged_file:
+            staged_file.write(json.dumps({"version": blobstream.STAGED_BLOCKS_VERSION + 1}).encode("utf-8") + b"\n")
+        with self.assertRaises(ValueError):
+            blobstream.commit_staged(self.storage, "edgevideos", "video.h264", self.staged_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
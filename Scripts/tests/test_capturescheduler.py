@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_capturescheduler.py
+#  Description: Checks the capture pacing and the achieved rate on a fake
+#   clock.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import unittest
+from unittest import mock
+from capturescheduler import CaptureScheduler
+
+
+class CaptureSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("capturescheduler.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_frame_waits_for_the_preroll(self):
+        scheduler = CaptureScheduler(target_rate=2.0, preroll=5, cycle_length=60.0)
+        self.assertEqual(5.0, scheduler.delay())
+        self.now += 5
+        self.assertEqual(0.0, scheduler.delay())
+        self.assertFalse(scheduler.cycle_over())
+        self.now += 60
+        self.assertTrue(scheduler.cycle_over())
+
+    def test_frames_follow_the_target_rate(self):
+        scheduler = CaptureScheduler(target_rate=4.0)
+        scheduler.captured()
+        self.assertEqual(0.25, scheduler.delay())
+        self.now += 0.1
+        scheduler.captured()
+        # Scheduled from the due time, not from when the frame was taken
+        self.assertAlmostEqual(0.4, scheduler.delay())
+
+    def test_missed_frames_are_not_made_up(self):
+        scheduler = CaptureScheduler(target_rate=4.0)
+        scheduler.captured()
+        # The pipeline stalled for several intervals
+        self.now += 2.0
+        scheduler.captured()
+        self.assertEqual(0.0, scheduler.delay())
+        scheduler.captured()
+        self.assertEqual(0.25, scheduler.delay())
+
+    def test_zero_rate_never_waits(self):
+        scheduler = CaptureScheduler(target_rate=0.0)
+        for _ in range(3):
+            scheduler.captured()
+            self.assertEqual(0.0, scheduler.delay())
+
+    def test_achieved_rate_over_the_window(self):
+        scheduler = CaptureScheduler(window=5)
+        self.assertEqual(0.0, scheduler.achieved_rate())
+        for _ in range(10):
+            scheduler.predicted()
+            self.now += 0.5
+        self.assertEqual(2.0, scheduler.achieved_rate())
+        # Only the last predictions count
+        for _ in range(5):
+            scheduler.predicted()
+            self.now += 0.25
+        self.assertEqual(4.0, scheduler.achieved_rate())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_ellmanager.py
+#  Description: Checks the vectorized get_top_n, get_top_n_batch and
+#   non_max_suppression against the loop based implementations ellmanager
+#   used before.
+#   Run from the Scripts folder: python3 -m unittest discover -s tests -t .
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import unittest
+from unittest import mock
+import numpy as np
+import ellmanager as emanager
+from nmsbenchmark import legacy_non_max_suppression, make_scene
+
+
+def legacy_get_top_n(predictions, n=5, threshold=0.20):
+    """The loop based get_top_n ellmanager used before, kept as the reference."""
+    filtered_predictions = [(i, predictions[i]) for i in
+                            range(len(predictions)) if predictions[i] >=
+                            threshold]
+    filtered_predictions.sort(key=lambda tup: tup[1], reverse=True)
+    result = filtered_predictions[:n]
+    return result
+
+
+class TopNTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+
+    def assert_same_top_n(self, expected, actual):
+        self.assertEqual([i for i, _ in expected], [i for i, _ in actual])
+        self.assertEqual([float(v) for _, v in expected], [float(v) for _, v in actual])
+
+    def test_matches_legacy(self):
+        for _ in range(200):
+            classes = self.random_state.randint(1, 50)
+            predictions = self.random_state.rand(classes).astype(np.float32)
+            n = self.random_state.randint(0, classes + 2)
+            threshold = self.random_state.choice([0.0, 0.2, 0.5])
+            self.assert_same_top_n(legacy_get_top_n(predictions, n, threshold),
+                                   emanager.get_top_n(predictions, n, threshold))
+
+    def test_ties_at_the_cut_keep_the_lower_index(self):
+        # Few distinct values, so most selections cut through a run of ties
+        for _ in range(200):
+            predictions = self.random_state.randint(0, 4, 12).astype(np.float32) / 4
+            n = self.random_state.randint(1, 8)
+            self.assert_same_top_n(legacy_get_top_n(predictions, n, 0.2),
+                                   emanager.get_top_n(predictions, n, 0.2))
+
+    def test_nothing_meets_the_threshold(self):
+        self.assertEqual([], emanager.get_top_n(np.full(10, 0.1, dtype=np.float32), 3, 0.2))
+
+    def test_batch_matches_single_rows(self):
+        for n in (0, 1, 2, 5, 12, 20):
+            predictions = self.random_state.randint(0, 6, (16, 12)).astype(np.float32) / 6
+            batch = emanager.get_top_n_batch(predictions, n, 0.2)
+            self.assertEqual(len(predictions), len(batch))
+            for row, top in zip(predictions, batch):
+                self.assert_same_top_n(legacy_get_top_n(row, n, 0.2), top)
+
+
+def reference_non_max_suppression(regions, overlap_threshold, categories):
+    """Greedy intersection over union suppression one pair at a time, the
+    behaviour non_max_suppression implements with array operations.
+    """
+    def corners(region):
+        x, y, width, height = [float(v) for v in region.location]
+        return x - width / 2, y - height / 2, x + width / 2, y + height / 2
+
+    def overlap(a, b):
+        a, b = corners(a), corners(b)
+        width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+        height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+        intersection = width * height
+        union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+        return intersection / union
+
+    kept = []
+    for region in sorted((r for r in regions if r.category in categories), key=lambda r: -r.probability):
+        if all(k.category != region.category or overlap(k, region) <= overlap_threshold for k in kept):
+            kept.append(region)
+    return kept
+
+
+def make_pixel_scene(num_objects, random_state):
+    """Returns clusters of nearly identical boxes on a pixel grid, far apart
+    from each other. The old overlap measure and intersection over union agree
+    on these, so both implementations must keep the same boxes.
+    """
+    categories = ["category{0}".format(i) for i in range(3)]
+    regions = []
+    for index in range(num_objects):
+        # Objects sit on a grid with gaps much larger than the jitter
+        center = np.array([100.0 * (index % 10) + 50, 100.0 * (index // 10) + 50])
+        category = categories[random_state.randint(len(categories))]
+        # The old code dropped categories with a single box, every cluster has several
+        for _ in range(random_state.randint(2, 6)):
+            location = np.concatenate((center + random_state.uniform(-1, 1, 2), random_state.uniform(40, 42, 2)))
+            regions.append(emanager.Region(category, random_state.uniform(0.3, 1.0), location))
+    return regions, categories
+
+
+class NonMaxSuppressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+
+    def assert_same_regions(self, expected, actual):
+        self.assertEqual(sorted(id(r) for r in expected), sorted(id(r) for r in actual))
+
+    def test_matches_legacy_on_separated_objects(self):
+        for _ in range(20):
+            regions, categories = make_pixel_scene(self.random_state.randint(1, 40), self.random_state)
+            expected = legacy_non_max_suppression(regions, 0.5, categories)
+            self.assertEqual(len(set(id(r) for r in expected)), len(expected))
+            for batched in (None, True, False):
+                self.assert_same_regions(expected, emanager.non_max_suppression(regions, 0.5, categories, batched=batched))
+
+    def test_matches_reference(self):
+        for size in (1, 10, 100, 300):
+            regions, categories = make_scene(size, self.random_state)
+            expected = reference_non_max_suppression(regions, 0.5, categories)
+            for batched in (None, True, False):
+                kept = emanager.non_max_suppression(regions, 0.5, categories, batched=batched)
+                self.assert_same_regions(expected, kept)
+                # Highest probability first
+                self.assertEqual(sorted(kept, key=lambda r: -r.probability), kept)
+
+    def test_large_scenes_match_the_matrix_pass(self):
+        regions, categories = make_scene(200, self.random_state)
+        expected = emanager.non_max_suppression(regions, 0.5, categories, batched=False)
+        with mock.patch.object(emanager, "NMS_MATRIX_LIMIT", 0):
+            self.assertEqual([id(r) for r in expected],
+                             [id(r) for r in emanager.non_max_suppression(regions, 0.5, categories, batched=False)])
+
+    def test_single_region_and_unknown_categories(self):
+        region = emanager.Region("cat", 0.9, [0.5, 0.5, 0.2, 0.2])
+        other = emanager.Region("dog", 0.8, [0.5, 0.5, 0.2, 0.2])
+        self.assertEqual([region], emanager.non_max_suppression([region, other], 0.5, ["cat"]))
+        self.assertEqual([], emanager.non_max_suppression([], 0.5, ["cat"]))
+
+    def test_soft_decays_instead_of_removing(self):
+        best = emanager.Region("cat", 0.9, [0.5, 0.5, 0.2, 0.2])
+        overlapping = emanager.Region("cat", 0.8, [0.52, 0.5, 0.2, 0.2])
+        self.assertEqual([best], emanager.non_max_suppression([best, overlapping], 0.5, ["cat"]))
+        kept = emanager.non_max_suppression([best, overlapping], 0.5, ["cat"], soft=True)
+        self.assertEqual(2, len(kept))
+        self.assertAlmostEqual(0.9, kept[0].probability, places=6)
+        self.assertLess(kept[1].probability, 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_imagearchive.py
+#  Description: Checks the rolling image segments, their indexes, recovery
+#   after a crash and that expanding a segment never writes outside of the
+#   output folder.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import imagearchive
+from imagearchive import ImageArchiver
+
+
+class ImageArchiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.archive_dir = os.path.join(self.temp_dir, "imagearchive")
+        self.output_dir = os.path.join(self.temp_dir, "expanded")
+        self.closed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def on_segment(self, segment_path, index_path):
+        with open(index_path, "r") as index_file:
+            self.closed.append((segment_path, json.load(index_file)))
+
+    def test_index_points_at_the_pictures(self):
+        archiver = ImageArchiver(self.archive_dir, self.on_segment)
+        pictures = [("badimages/image-{0}.jpg".format(i), os.urandom(700 * i + 1)) for i in range(4)]
+        for name, data in pictures:
+            archiver.add(name, data, {"prediction": None})
+        archiver.roll()
+
+        self.assertEqual(1, len(self.closed))
+        segment_path, index = self.closed[0]
+        self.assertTrue(segment_path.endswith(imagearchive.SEGMENT_SUFFIX))
+        self.assertEqual(os.path.basename(segment_path), index["segment"])
+        with open(segment_path, "rb") as segment_file:
+            segment = segment_file.read()
+        for (name, data), entry in zip(pictures, index["images"]):
+            self.assertEqual(name, entry["name"])
+            self.assertEqual({"prediction": None}, entry["metadata"])
+            self.assertEqual(data, segment[entry["offset"]:entry["offset"] + entry["size"]])
+
+    def test_segments_roll_at_max_bytes(self):
+        archiver = ImageArchiver(self.archive_dir, self.on_segment, max_bytes=4096)
+        for i in range(6):
+            archiver.add("badimages/image-{0}.jpg".format(i), b"x" * 1500)
+        archiver.roll()
+        self.assertEqual([2, 2, 2], [len(index["images"]) for _, index in self.closed])
+        # Nothing is left open, and an empty roll hands nothing over
+        archiver.roll()
+        self.assertEqual(3, len(self.closed))
+
+    def test_recovers_a_segment_cut_off_by_a_crash(self):
+        archiver = ImageArchiver(self.archive_dir, self.on_segment)
+        archiver.add("badimages/a.jpg", b"a" * 1000)
+        archiver.add("badimages/b.jpg", b"b" * 3000)
+        part_path = archiver.segment_path
+        archiver.segment.fileobj.flush()
+        # The crash cut the second picture short
+        with open(part_path, "r+b") as part_file:
+            part_file.truncate(os.path.getsize(part_path) - 2000)
+
+        ImageArchiver(self.archive_dir, self.on_segment).recover()
+        self.assertEqual(1, len(self.closed))
+        segment_path, index = self.closed[0]
+        self.assertEqual(["badimages/a.jpg"], [entry["name"] for entry in index["images"]])
+        self.assertFalse(os.path.exists(part_path))
+
+        written = imagearchive.expand_segment(segment_path, self.output_dir, index)
+        self.assertEqual(["badimages/a.jpg"], [entry["name"] for entry in written])
+        with open(os.path.join(self.output_dir, "badimages", "a.jpg"), "rb") as image_file:
+            self.assertEqual(b"a" * 1000, image_file.read())
+
+    def test_expand_skips_members_outside_the_output_folder(self):
+        segment_path = os.path.join(self.temp_dir, "images-1.tar")
+        with tarfile.open(segment_path, "w") as segment:
+            for name in ("badimages/good.jpg", "../evil.jpg", "badimages/../../evil.jpg",
+                         os.path.join(self.temp_dir, "evil.jpg")):
+                member = tarfile.TarInfo(name)
+                member.size = 4
+                segment.addfile(member, io.BytesIO(b"data"))
+            link = tarfile.TarInfo("badimages/link.jpg")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/passwd"
+            segment.addfile(link)
+
+        written = imagearchive.expand_segment(segment_path, self.output_dir)
+        self.assertEqual(["badimages/good.jpg"], [entry["name"] for entry in written])
+        self.assertEqual(sorted(["expanded", "images-1.tar"]), sorted(os.listdir(self.temp_dir)))
+        self.assertEqual(["good.jpg"], os.listdir(os.path.join(self.output_dir, "badimages")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_imagededup.py
+#  Description: Checks the difference hash and the bounded index of the
+#   badimages pictures that were already uploaded.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import imagededup
+from imagededup import ImageDedupIndex
+
+
+class DifferenceHashTest(unittest.TestCase):
+
+    def picture(self, phase):
+        # Stripes that change brightness across the picture, like a scene with some structure
+        columns = np.sin(np.arange(256) / 256.0 * 6 * np.pi + phase) * 100 + 128
+        rows = np.linspace(0, 40, 256)
+        gray = np.add.outer(rows, columns)
+        return np.repeat(gray[:, :, np.newaxis], 3, axis=2).clip(0, 255).astype(np.uint8)
+
+    def distance(self, a, b):
+        return bin(imagededup.dhash(a) ^ imagededup.dhash(b)).count("1")
+
+    def test_similar_pictures_have_close_hashes(self):
+        image = self.picture(0.0)
+        random_state = np.random.RandomState(0)
+        brighter = np.clip(image.astype(np.int32) + 20 + random_state.randint(-5, 5, image.shape), 0, 255)
+        self.assertLessEqual(self.distance(image, brighter.astype(np.uint8)), 4)
+        self.assertGreater(self.distance(image, self.picture(np.pi)), 10)
+
+    def test_hamming_distances(self):
+        hashes = np.array([0, 0xFF, 0xFFFFFFFFFFFFFFFF], dtype=np.uint64)
+        self.assertEqual([0, 8, 64], list(imagededup.hamming_distances(hashes, 0)))
+
+
+class ImageDedupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.temp_dir, "badimagesindex.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_duplicates_refer_to_the_first_picture(self):
+        index = ImageDedupIndex(self.index_path, max_distance=2)
+        self.assertIsNone(index.check(0b1111, "a.jpg"))
+        self.assertEqual("a.jpg", index.check(0b1100, "b.jpg"))
+        self.assertIsNone(index.check(0b1100000, "c.jpg"))
+        self.assertEqual(2, index.references("a.jpg"))
+        self.assertEqual(0, index.references("b.jpg"))
+
+    def test_least_recently_matched_is_dropped(self):
+        index = ImageDedupIndex(self.index_path, capacity=2, max_distance=0)
+        index.check(1, "a.jpg")
+        index.check(2, "b.jpg")
+        index.check(1, "a-again.jpg")
+        # b.jpg was matched longest ago
+        index.check(4, "c.jpg")
+        self.assertEqual(2, index.references("a.jpg"))
+        self.assertEqual(0, index.references("b.jpg"))
+        self.assertIsNone(index.check(2, "b-again.jpg"))
+
+    def test_survives_a_restart(self):
+        index = ImageDedupIndex(self.index_path, max_distance=0, save_interval=3600.0)
+        index.check(0xFFFFFFFFFFFFFFFF, "a.jpg")
+        index.check(0xFFFFFFFFFFFFFFFF, "b.jpg")
+        index.check(7, "c.jpg")
+        # Nothing written before the save interval is over
+        self.assertFalse(os.path.exists(self.index_path))
+        index.save()
+
+        # A smaller capacity keeps the most recently used entries
+        reloaded = ImageDedupIndex(self.index_path, capacity=1, max_distance=0)
+        self.assertEqual("c.jpg", reloaded.check(7, "d.jpg"))
+        self.assertIsNone(reloaded.check(0xFFFFFFFFFFFFFFFF, "e.jpg"))
+
+    def test_unreadable_index_starts_empty(self):
+        with open(self.index_path, "w") as index_file:
+            index_file.write("{")
+        index = ImageDedupIndex(self.index_path)
+        self.assertEqual(0, index.size)
+        self.assertIsNone(index.check(1, "a.jpg"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_modelpackage.py
+#  Description: Checks the model manifest and that Host.py and pisetup.py
+#   only transfer the files whose content changed.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import modelpackage
+from tests import azurestub
+
+azurestub.install()
+import Host
+import pisetup
+
+
+class ModelPackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.model_dir_path = os.path.join(self.temp_dir, "pi3")
+        self.categories_path = os.path.join(self.temp_dir, "categories.txt")
+        self.write("model.ll", b"model")
+        self.write("include/model.h", b"header")
+        self.write_categories(b"cat\ndog\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def write(self, relative_path, data, root=None):
+        path = os.path.join(root or self.model_dir_path, *relative_path.split("/"))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as data_file:
+            data_file.write(data)
+        return path
+
+    def write_categories(self, data):
+        with open(self.categories_path, "wb") as categories_file:
+            categories_file.write(data)
+
+    def manifest(self):
+        return modelpackage.build_manifest(self.model_dir_path, self.categories_path)
+
+    def test_build_folder_and_installed_manifest_are_not_packaged(self):
+        self.write("build/_model.so", b"built")
+        self.write(modelpackage.INSTALLED_MANIFEST, b"{}")
+        self.assertEqual(["model.ll", "include/model.h"], modelpackage.list_files(self.model_dir_path))
+
+    def test_hashes(self):
+        manifest = self.manifest()
+        self.assertEqual(manifest["package"], self.manifest()["package"])
+
+        # New categories make a new package from the same sources
+        self.write_categories(b"cat\nbird\n")
+        relabelled = self.manifest()
+        self.assertNotEqual(manifest["package"], relabelled["package"])
+        self.assertEqual(modelpackage.source_hash(manifest), modelpackage.source_hash(relabelled))
+
+        self.write("model.ll", b"retrained")
+        self.assertNotEqual(modelpackage.source_hash(manifest), modelpackage.source_hash(self.manifest()))
+
+        # Prebuilt wrappers are not part of the package
+        manifest["artifacts"] = {"cpython-35m-arm-linux-gnueabihf": {}}
+        self.assertEqual(manifest["package"], modelpackage.package_hash(manifest))
+
+    def test_loads_rejects_tampered_and_unknown_manifests(self):
+        manifest = self.manifest()
+        self.assertEqual(manifest, modelpackage.loads(modelpackage.dumps(manifest).encode("utf-8")))
+        tampered = dict(manifest, categories={"sha256": "0" * 64, "size": 1})
+        with self.assertRaises(ValueError):
+            modelpackage.loads(modelpackage.dumps(tampered))
+        with self.assertRaises(ValueError):
+            modelpackage.loads(modelpackage.dumps(dict(manifest, version=modelpackage.MANIFEST_VERSION + 1)))
+
+    def test_load_installed(self):
+        self.assertIsNone(modelpackage.load_installed(self.model_dir_path))
+        manifest = self.manifest()
+        modelpackage.save_installed(self.model_dir_path, manifest)
+        self.assertEqual(manifest, modelpackage.load_installed(self.model_dir_path))
+        self.write(modelpackage.INSTALLED_MANIFEST, b"{")
+        self.assertIsNone(modelpackage.load_installed(self.model_dir_path))
+
+    def test_device_downloads_only_changed_files(self):
+        installed_dir_path = os.path.join(self.temp_dir, "pi3-old")
+        shutil.copytree(self.model_dir_path, installed_dir_path)
+        modelpackage.save_installed(installed_dir_path, self.manifest())
+
+        self.write("model.ll", b"retrained")
+        self.write("weights.bin", b"weights")
+        manifest = self.manifest()
+
+        downloaded = []
+        def download_object(model_container_name, entry, path):
+            downloaded.append(os.path.basename(path))
+            shutil.copyfile(os.path.join(self.model_dir_path, os.path.basename(path)), path)
+
+        with mock.patch.object(pisetup, "azure_download_object", side_effect=download_object):
+            install_dir_path = pisetup.azure_download_package(
+                "edgemodels", manifest, os.path.join(self.temp_dir, "pi3-new"), installed_dir_path)
+
+        self.assertEqual(["model.ll", "weights.bin"], sorted(downloaded))
+        self.assertEqual(manifest, modelpackage.load_installed(install_dir_path))
+        for relative_path, entry in manifest["files"].items():
+            self.assertEqual(entry["sha256"], modelpackage.hash_file(os.path.join(install_dir_path, relative_path)))
+        # The unchanged header is shared with the installed version, not copied
+        self.assertTrue(os.path.samefile(os.path.join(installed_dir_path, "include", "model.h"),
+                                         os.path.join(install_dir_path, "include", "model.h")))
+
+    def test_existing_version_folder_is_never_replaced(self):
+        manifest = self.manifest()
+        in_use_dir_path = os.path.join(self.temp_dir, "pi3-in-use")
+        shutil.copytree(self.model_dir_path, in_use_dir_path)
+        self.write("build/model.py", b"in use", root=in_use_dir_path)
+
+        install_dir_path = pisetup.azure_download_package("edgemodels", manifest, in_use_dir_path, self.model_dir_path)
+        self.assertNotEqual(in_use_dir_path, install_dir_path)
+        self.assertTrue(os.path.exists(os.path.join(in_use_dir_path, "build", "model.py")))
+        self.assertEqual(manifest, modelpackage.load_installed(install_dir_path))
+
+    def test_failed_download_leaves_nothing_behind(self):
+        manifest = self.manifest()
+        install_dir_path = os.path.join(self.temp_dir, "pi3-new")
+        with mock.patch.object(pisetup, "azure_download_object", side_effect=IOError("network is down")):
+            with self.assertRaises(IOError):
+                pisetup.azure_download_package("edgemodels", manifest, install_dir_path, None)
+        self.assertEqual(sorted(["categories.txt", "pi3"]), sorted(os.listdir(self.temp_dir)))
+
+    def test_host_uploads_only_missing_objects(self):
+        manifest = self.manifest()
+        paths = {manifest["categories"]["sha256"]: self.categories_path}
+        for relative_path, entry in manifest["files"].items():
+            paths[entry["sha256"]] = os.path.join(self.model_dir_path, relative_path)
+        published_objects = set([modelpackage.object_blob_name(manifest["files"]["model.ll"]["sha256"])])
+
+        service = mock.Mock()
+        with mock.patch.object(Host, "block_blob_service", service, create=True):
+            self.assertEqual(2, Host.azure_upload_objects("edgemodels", paths, published_objects, 4))
+            self.assertEqual(0, Host.azure_upload_objects("edgemodels", paths, published_objects, 4))
+
+        uploaded = sorted(call[0][1] for call in service.create_blob_from_path.call_args_list)
+        expected = [manifest["categories"]["sha256"], manifest["files"]["include/model.h"]["sha256"]]
+        self.assertEqual(sorted(modelpackage.object_blob_name(digest) for digest in expected), uploaded)
+        # Two files at once share the four connections
+        self.assertEqual([2, 2], [call[1]["max_connections"] for call in service.create_blob_from_path.call_args_list])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_motiongate.py
+#  Description: Checks which frames the motion gate lets through to the
+#   model.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import unittest
+import numpy as np
+from motiongate import MotionGate
+
+
+def scene(square_left=None, shape=(256, 256, 3)):
+    """A gray gradient with a white square at `square_left` if given."""
+    rows, columns = shape[:2]
+    gradient = np.add.outer(np.arange(rows) * 100 // rows, np.arange(columns) * 100 // columns)
+    image = np.repeat(gradient[:, :, np.newaxis], shape[2], axis=2).astype(np.uint8)
+    if square_left is not None:
+        size = rows // 4
+        image[size:2 * size, square_left:square_left + size] = 255
+    return image
+
+
+class MotionGateTest(unittest.TestCase):
+
+    def test_static_scene_is_skipped_until_the_heartbeat(self):
+        gate = MotionGate(heartbeat=60.0)
+        self.assertTrue(gate.passes(scene(), now=0.0))
+        self.assertFalse(gate.passes(scene(), now=1.0))
+        self.assertFalse(gate.passes(scene(), now=59.0))
+        self.assertTrue(gate.passes(scene(), now=60.0))
+        self.assertFalse(gate.passes(scene(), now=61.0))
+
+    def test_movement_passes(self):
+        gate = MotionGate()
+        self.assertTrue(gate.passes(scene(), now=0.0))
+        self.assertTrue(gate.passes(scene(square_left=100), now=1.0))
+
+    def test_sensor_noise_does_not_pass(self):
+        gate = MotionGate()
+        random_state = np.random.RandomState(0)
+        self.assertTrue(gate.passes(scene(), now=0.0))
+        for second in range(1, 10):
+            noisy = scene() + random_state.randint(0, 10, (256, 256, 3)).astype(np.uint8)
+            self.assertFalse(gate.passes(noisy, now=float(second)))
+
+    def test_lasting_changes_become_background(self):
+        gate = MotionGate(heartbeat=1000.0, learning_rate=0.5)
+        self.assertTrue(gate.passes(scene(), now=0.0))
+        moved = scene(square_left=100)
+        results = [gate.passes(moved, now=float(second)) for second in range(1, 20)]
+        self.assertTrue(results[0])
+        self.assertFalse(results[-1])
+
+    def test_zero_sensitivity_passes_everything(self):
+        gate = MotionGate(sensitivity=0)
+        self.assertTrue(all(gate.passes(scene(), now=float(second)) for second in range(5)))
+
+    def test_new_frame_size_and_reset_start_over(self):
+        gate = MotionGate()
+        self.assertTrue(gate.passes(scene(), now=0.0))
+        self.assertTrue(gate.passes(scene(shape=(720, 1280, 3)), now=1.0))
+        self.assertFalse(gate.passes(scene(shape=(720, 1280, 3)), now=2.0))
+        gate.reset()
+        self.assertTrue(gate.passes(scene(shape=(720, 1280, 3)), now=3.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
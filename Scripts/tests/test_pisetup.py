@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_pisetup.py
+#  Description: Checks that the streaming zip extractor of pisetup.py
+#   restores the model folder like zipfile does, and never writes outside
+#   of it.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from tests import azurestub
+
+azurestub.install()
+import pisetup
+
+
+class StreamReader():
+    """Hands out the archive like blobstream.BlobReader, `size` bytes per
+    read except at the end.
+    """
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.drained = False
+
+    def read(self, size):
+        return self.stream.read(size)
+
+    def drain(self):
+        self.stream.read()
+        self.drained = True
+
+
+class Unseekable(io.RawIOBase):
+    """Output that cannot seek, zipfile then writes data descriptors."""
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def make_zip(entries, output=None):
+    output = output if output is not None else io.BytesIO()
+    with zipfile.ZipFile(output, "w") as archive:
+        for name, data, method in entries:
+            archive.writestr(zipfile.ZipInfo(name), data, compress_type=method)
+    return bytes(output.getvalue() if isinstance(output, io.BytesIO) else output.data)
+
+
+class ExtractZipStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.model_dir_path = os.path.join(self.temp_dir, "pi3")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def read(self, relative_path):
+        with open(os.path.join(self.model_dir_path, relative_path), "rb") as data_file:
+            return data_file.read()
+
+    def test_extracts_stored_and_deflated_entries(self):
+        model = os.urandom(1000) + b"\0" * 5000
+        reader = StreamReader(make_zip([
+            ("model.ll", model, zipfile.ZIP_DEFLATED),
+            ("include/", b"", zipfile.ZIP_STORED),
+            ("include/model.h", b"header", zipfile.ZIP_STORED),
+            ("empty.txt", b"", zipfile.ZIP_DEFLATED),
+        ]))
+        pisetup.extract_zip_stream(reader, self.model_dir_path)
+        self.assertTrue(reader.drained)
+        self.assertEqual(model, self.read("model.ll"))
+        self.assertEqual(b"header", self.read("include/model.h"))
+        self.assertEqual(b"", self.read("empty.txt"))
+
+    def test_rejects_paths_outside_the_model_folder(self):
+        for name in ("../evil.py", "include/../../evil.py", os.path.join(self.temp_dir, "evil.py")):
+            shutil.rmtree(self.model_dir_path, ignore_errors=True)
+            reader = StreamReader(make_zip([("model.ll", b"model", zipfile.ZIP_STORED),
+                                            (name, b"evil", zipfile.ZIP_STORED)]))
+            with self.assertRaises(ValueError):
+                pisetup.extract_zip_stream(reader, self.model_dir_path)
+            self.assertEqual(["pi3"], os.listdir(self.temp_dir))
+
+    def test_corrupt_entry(self):
+        data = bytearray(make_zip([("model.ll", b"model" * 100, zipfile.ZIP_STORED)]))
+        offset = data.index(b"modelmodel")
+        data[offset] ^= 0xFF
+        with self.assertRaises(ValueError):
+            pisetup.extract_zip_stream(StreamReader(bytes(data)), self.model_dir_path)
+
+    def test_truncated_archive(self):
+        data = make_zip([("model.ll", b"model" * 100, zipfile.ZIP_STORED)])
+        with self.assertRaises(ValueError):
+            pisetup.extract_zip_stream(StreamReader(data[:100]), self.model_dir_path)
+
+    def test_data_descriptors_need_a_download_first(self):
+        data = make_zip([("model.ll", b"model", zipfile.ZIP_DEFLATED)], Unseekable())
+        with self.assertRaises(pisetup.UnsupportedStream):
+            pisetup.extract_zip_stream(StreamReader(data), self.model_dir_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
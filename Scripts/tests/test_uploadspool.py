@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     test_uploadspool.py
+#  Description: Checks that the upload spool survives a restart, cleans up
+#   after interrupted writes and backs off exponentially on failures.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from uploadspool import UploadSpool
+
+
+class Uploads():
+    """Records the uploads, failing the first `failures` of them."""
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.uploaded = []
+        self.attempts = 0
+        self.done = threading.Event()
+
+    def upload(self, container, blob_name, source, content_type):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise IOError("network is down")
+        if not isinstance(source, bytes):
+            with open(source, "rb") as source_file:
+                source = source_file.read()
+        self.uploaded.append((container, blob_name, source, content_type))
+        self.done.set()
+
+
+class UploadSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.temp_dir, "spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "wb") as data_file:
+            data_file.write(data)
+        return path
+
+    def test_recovers_pending_uploads_in_order(self):
+        spool = UploadSpool(self.spool_dir, Uploads().upload)
+        first = spool.enqueue("pictures", "first.jpg", self.make_file("first.jpg", b"1"), "image/jpeg")
+        second = spool.enqueue("pictures", "second.jpg", self.make_file("second.jpg", b"22"), "image/jpeg")
+
+        # Left overs of interrupted writes: a temporary record, a record whose file
+        # never arrived, a file without its record and an unreadable record
+        with open(os.path.join(spool.index_dir, "partial.json.tmp"), "w") as record_file:
+            record_file.write("{")
+        spool.write_record("no-data", spool.new_entry("pictures", "lost.jpg", "image/jpeg", 1)[1])
+        with open(spool.data_path("no-record"), "wb") as data_file:
+            data_file.write(b"x")
+        with open(spool.record_path("broken"), "w") as record_file:
+            record_file.write("{")
+        with open(spool.data_path("broken"), "wb") as data_file:
+            data_file.write(b"x")
+
+        recovered = UploadSpool(self.spool_dir, Uploads().upload)
+        self.assertEqual([first, second], sorted(recovered.pending))
+        self.assertEqual(3, recovered.spooled_bytes)
+        self.assertEqual(sorted(["{0}.json".format(first), "{0}.json".format(second)]),
+                         sorted(os.listdir(recovered.index_dir)))
+        self.assertEqual(sorted([first, second]), sorted(os.listdir(recovered.data_dir)))
+        self.assertEqual(first, recovered.next_entry()[0])
+
+    def test_back_off_doubles_up_to_the_limit(self):
+        spool = UploadSpool(self.spool_dir, Uploads().upload, base_delay=5.0, max_delay=30.0)
+        entry_id = spool.enqueue("pictures", "a.jpg", self.make_file("a.jpg", b"a"), "image/jpeg")
+        delays = []
+        _, record = spool.next_entry()
+        with mock.patch("uploadspool.random.uniform", return_value=1.0):
+            for _ in range(5):
+                before = time.time()
+                spool.retry_later(entry_id, dict(record), IOError("down"))
+                record = spool.pending[entry_id]
+                delays.append(round(record["nextAttempt"] - before))
+        self.assertEqual([5, 10, 20, 30, 30], delays)
+
+        # The attempts survive a restart
+        recovered = UploadSpool(self.spool_dir, Uploads().upload)
+        self.assertEqual(5, recovered.pending[entry_id]["attempts"])
+        self.assertGreater(recovered.pending[entry_id]["nextAttempt"], time.time())
+
+    def test_jitter_only_shortens_the_delay(self):
+        spool = UploadSpool(self.spool_dir, Uploads().upload, base_delay=8.0)
+        entry_id = spool.enqueue("pictures", "a.jpg", self.make_file("a.jpg", b"a"), "image/jpeg")
+        _, record = spool.next_entry()
+        before = time.time()
+        spool.retry_later(entry_id, record, IOError("down"))
+        delay = spool.pending[entry_id]["nextAttempt"] - before
+        self.assertTrue(4.0 <= delay <= 8.1, delay)
+
+    def test_retries_until_uploaded(self):
+        uploads = Uploads(failures=2)
+        spool = UploadSpool(self.spool_dir, uploads.upload, base_delay=0.01, max_delay=0.05)
+        spool.enqueue("pictures", "a.jpg", self.make_file("a.jpg", b"picture"), "image/jpeg")
+        spool.start()
+        self.assertTrue(uploads.done.wait(5))
+        self.assertEqual([("pictures", "a.jpg", b"picture", "image/jpeg")], uploads.uploaded)
+        self.assertEqual(3, uploads.attempts)
+        deadline = time.time() + 5
+        while len(spool) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(0, len(spool))
+        self.assertEqual([], os.listdir(spool.data_dir))
+
+    def test_bytes_stay_in_memory_until_an_upload_fails(self):
+        uploads = Uploads(failures=1)
+        spool = UploadSpool(self.spool_dir, uploads.upload, uploads.upload, base_delay=60.0)
+        entry_id = spool.enqueue_bytes("pictures", "a.jpg", b"picture", "image/jpeg")
+        self.assertEqual([], os.listdir(spool.data_dir))
+
+        # The failed first attempt moves it to disk, where a restart finds it
+        spool.start()
+        deadline = time.time() + 5
+        while spool.pending[entry_id]["attempts"] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([entry_id], os.listdir(spool.data_dir))
+        recovered = UploadSpool(self.spool_dir, uploads.upload)
+        self.assertEqual([entry_id], list(recovered.pending))
+        self.assertEqual(1, recovered.pending[entry_id]["attempts"])
+
+    def test_full_spool_drops_the_oldest(self):
+        spool = UploadSpool(self.spool_dir, Uploads().upload, max_bytes=5)
+        oldest = spool.enqueue("pictures", "a.jpg", self.make_file("a.jpg", b"aaa"), "image/jpeg")
+        newest = spool.enqueue("pictures", "b.jpg", self.make_file("b.jpg", b"bbb"), "image/jpeg")
+        self.assertEqual([newest], list(spool.pending))
+        self.assertFalse(os.path.exists(spool.data_path(oldest)))
+        self.assertEqual(3, spool.spooled_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+###############################################################################
+#
+#  Project:  MLontheEdgeCodeStory
+#  File:     uploadspool.py
+#  Description: A crash-safe upload queue on the SD card. Edge.py moves the
+#   files it wants on Azure Blob Storage into the spool and returns at once.
+#   Background workers drain the spool with exponential back-off, and
+#   whatever is left over is picked up again after a reboot. Small uploads
+#   held in memory only touch the SD card when their first attempt fails.
+#  Requires: Python 3.5.3
+#
+###############################################################################
+
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+
+
+class UploadSpool():
+    """Durable queue of blob uploads.
+
+    `spool_dir` holds a `data` folder with the queued files and an `index`
+    folder with one small json record per file describing where it goes.
+
+    `upload_function` is called as `upload_function(container, blob_name,
+    path, content_type)` by the workers and must raise on failure.
+
+    `upload_bytes_function` is called the same way with the data instead of
+    a path for uploads queued with `enqueue_bytes`.
+
+    `max_workers` bounds the number of concurrent uploads.
+
+    `base_delay` and `max_delay` are the first and the largest wait in
+    seconds before a failed upload is retried.
+
+    `max_bytes` optionally bounds the size of the spool. The oldest files are
+    dropped once it is exceeded.
+
+    `max_memory_entries` bounds the uploads held in memory. Beyond it,
+    `enqueue_bytes` writes straight to disk.
+    """
+    def __init__(self, spool_dir, upload_function, upload_bytes_function=None, max_workers=2,
+                 base_delay=5.0, max_delay=600.0, max_bytes=None, max_memory_entries=16):
+        self.data_dir = os.path.join(spool_dir, "data")
+        self.index_dir = os.path.join(spool_dir, "index")
+        self.upload_function = upload_function
+        self.upload_bytes_function = upload_bytes_function
+        self.max_memory_entries = max_memory_entries
+        self.max_workers = max_workers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.memory = {}
+        self.in_flight = set()
+        self.spooled_bytes = 0
+        self.workers = []
+
+        for directory in (self.data_dir, self.index_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        self.recover()
+
+    def data_path(self, entry_id):
+        return os.path.join(self.data_dir, entry_id)
+
+    def record_path(self, entry_id):
+        return os.path.join(self.index_dir, "{0}.json".format(entry_id))
+
+    def write_record(self, entry_id, record):
+        # Write a temporary record and rename it, a crash never leaves half a record
+        record_path = self.record_path(entry_id)
+        temp_path = "{0}.tmp".format(record_path)
+        with open(temp_path, "w") as record_file:
+            json.dump(record, record_file)
+            record_file.flush()
+            os.fsync(record_file.fileno())
+        os.replace(temp_path, record_path)
+
+    def remove_entry(self, entry_id):
+        record = self.pending.pop(entry_id, None)
+        if self.memory.pop(entry_id, None) is not None:
+            return
+        if record is not None:
+            self.spooled_bytes -= record.get("size", 0)
+        for path in (self.record_path(entry_id), self.data_path(entry_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def recover(self):
+        """Load the records left by a previous run. Records without their
+        file and files without their record are cleaned up.
+        """
+        for name in sorted(os.listdir(self.index_dir)):
+            path = os.path.join(self.index_dir, name)
+            if not name.endswith(".json"):
+                # A temporary record from an interrupted write
+                os.remove(path)
+                continue
+            entry_id = name[:-len(".json")]
+            try:
+                with open(path, "r") as record_file:
+                    record = json.load(record_file)
+            except ValueError:
+                logging.warning("Dropping unreadable spool record {0}".format(name))
+                self.remove_entry(entry_id)
+                continue
+            if not os.path.exists(self.data_path(entry_id)):
+                logging.warning("Dropping spool record {0} without data".format(name))
+                self.remove_entry(entry_id)
+                continue
+            self.pending[entry_id] = record
+            self.spooled_bytes += record.get("size", 0)
+
+        for entry_id in os.listdir(self.data_dir):
+            if entry_id not in self.pending:
+                os.remove(self.data_path(entry_id))
+
+        if self.pending:
+            logging.debug("Resuming {0} spooled uploads".format(len(self.pending)))
+
+    def new_entry(self, container, blob_name, content_type, size):
+        # Entry ids sort by creation time so older files go first
+        entry_id = "{0:017.6f}-{1}".format(time.time(), uuid.uuid4().hex[:8])
+        record = {
+            "container": container,
+            "blobName": blob_name,
+            "contentType": content_type,
+            "size": size,
+            "attempts": 0,
+            "nextAttempt": 0,
+        }
+        return entry_id, record
+
+    def add_pending(self, entry_id, record, data=None):
+        with self.condition:
+            self.pending[entry_id] = record
+            if data is None:
+                self.spooled_bytes += record["size"]
+                self.enforce_limit()
+            else:
+                self.memory[entry_id] = data
+            self.condition.notify()
+
+    def write_data(self, entry_id, data):
+        # Same temporary file and rename as the records
+        data_path = self.data_path(entry_id)
+        temp_path = "{0}.tmp".format(data_path)
+        with open(temp_path, "wb") as data_file:
+            data_file.write(data)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        os.replace(temp_path, data_path)
+
+    def enqueue_bytes(self, container, blob_name, data, content_type):
+        """Queue `data` for upload as `blob_name` in `container`. The data is
+        kept in memory and only written to the spool if the first upload
+        fails or too many uploads are already held in memory.
+        """
+        entry_id, record = self.new_entry(container, blob_name, content_type, len(data))
+        with self.condition:
+            in_memory = self.upload_bytes_function is not None and len(self.memory) < self.max_memory_entries
+        if in_memory:
+            self.add_pending(entry_id, record, data)
+        else:
+            self.write_record(entry_id, record)
+            self.write_data(entry_id, data)
+            self.add_pending(entry_id, record)
+        return entry_id
+
+    def persist(self, entry_id, record):
+        """Move an entry held in memory to disk after its upload failed."""
+        with self.condition:
+            data = self.memory.get(entry_id)
+        if data is None:
+            return
+        self.write_record(entry_id, record)
+        self.write_data(entry_id, data)
+        with self.condition:
+            if self.memory.pop(entry_id, None) is not None:
+                self.spooled_bytes += record["size"]
+
+    def enqueue(self, container, blob_name, path, content_type):
+        """Move the file at `path` into the spool for upload as `blob_name`
+        in `container`. Returns as soon as the file is safely on disk.
+        """
+        entry_id, record = self.new_entry(container, blob_name, content_type, os.path.getsize(path))
+        # The record goes first, a crash before the move leaves a record
+        # without data, which recover drops
+        self.write_record(entry_id, record)
+        data_path = self.data_path(entry_id)
+        shutil.move(path, data_path)
+        with open(data_path, "rb") as data_file:
+            os.fsync(data_file.fileno())
+        self.add_pending(entry_id, record)
+        return entry_id
+
+    def enforce_limit(self):
+        # Called with the condition held
+        if self.max_bytes is None:
+            return
+        for entry_id in sorted(self.pending):
+            if self.spooled_bytes <= self.max_bytes:
+                return
+            if entry_id in self.in_flight or entry_id in self.memory:
+                continue
+            logging.warning("Upload spool is full, dropping {0}".format(self.pending[entry_id]["blobName"]))
+            self.remove_entry(entry_id)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+    def next_entry(self):
+        """Block until an entry is due and claim it for the calling worker."""
+        with self.condition:
+            while True:
+                now = time.time()
+                due = None
+                wait = None
+                for entry_id in sorted(self.pending):
+                    if entry_id in self.in_flight:
+                        continue
+                    delay = self.pending[entry_id]["nextAttempt"] - now
+                    if delay <= 0:
+                        due = entry_id
+                        break
+                    wait = delay if wait is None else min(wait, delay)
+                if due is not None:
+                    self.in_flight.add(due)
+                    return due, dict(self.pending[due])
+                self.condition.wait(wait)
+
+    def retry_later(self, entry_id, record, error):
+        attempts = record["attempts"] + 1
+        # Exponential back-off with jitter so devices do not retry in lockstep
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        delay = delay * random.uniform(0.5, 1.0)
+        record["attempts"] = attempts
+        record["nextAttempt"] = time.time() + delay
+        logging.debug("Upload of {0} failed ({1}), retry {2} in {3:.0f}s".format(
+            record["blobName"], error, attempts, delay))
+        with self.condition:
+            self.in_flight.discard(entry_id)
+            if entry_id in self.pending:
+                self.write_record(entry_id, record)
+                self.pending[entry_id] = record
+            self.condition.notify()
+
+    def complete(self, entry_id):
+        with self.condition:
+            self.in_flight.discard(entry_id)
+            self.remove_entry(entry_id)
+
+    def drain(self):
+        """Worker loop, uploads the spooled files until the process ends."""
+        while True:
+            entry_id, record = self.next_entry()
+            with self.condition:
+                data = self.memory.get(entry_id)
+            try:
+                if data is not None:
+                    self.upload_bytes_function(record["container"], record["blobName"],
+                                               data, record["contentType"])
+                else:
+                    self.upload_function(record["container"], record["blobName"],
+                                         self.data_path(entry_id), record["contentType"])
+            except Exception as error:
+                if data is not None:
+                    # Keep it safe on disk until the network is back
+                    self.persist(entry_id, record)
+                self.retry_later(entry_id, record, error)
+            else:
+                self.complete(entry_id)
+
+    def start(self):
+        """Start the background workers."""
+        for index in range(self.max_workers - len(self.workers)):
+            worker = threading.Thread(target=self.drain, name="uploadspool", daemon=True)
+            worker.start()
+            self.workers.append(worker)